@@ -36,6 +36,18 @@ def get_audit_records(audit_data, generator, item_name, fields=None, post_proces
 		pass
 	return items
 
+# The following open the package themselves and return plain lists so they can be handed to a process pool
+
+def get_package_audit_records(acquisition_package_path, generator, item_name, fields=None, post_process=None, **static_values):
+	with AuditPackage(acquisition_package_path) as audit_package:
+		audit_data = audit_package.get_audit(generator=generator, open_only=True)
+		if audit_data:
+			try:
+				return get_audit_records(audit_data, generator, item_name, fields=fields, post_process=post_process, **static_values)
+			finally:
+				audit_data.close()
+	return None
+
 class EmptyAuditException(Exception): pass
 
 class AuditPackage:
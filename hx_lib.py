@@ -9,25 +9,685 @@
 
 try:
 	import requests
-	from requests.packages.urllib3.exceptions import InsecureRequestWarning
+	from requests.adapters import HTTPAdapter
+	from requests.packages.urllib3.exceptions import InsecureRequestWarning, ProtocolError, EmptyPoolError
+	from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 except ImportError:
 	print("HXTool requires the 'requests' module, please install it.")
 	exit(1)
 	
+import os
+import re
 import urllib
 import base64
+import hashlib
+import heapq
+from operator import itemgetter
 import json
 import logging
 import datetime
 import pickle
-import shutil
+import threading
+import time
+import types
+import asyncio
+import functools
+import random
+import email.utils
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Raised by the HXAPI.iter* generators when a page can't be fetched
+class HXAPIPagingError(Exception):
+	def __init__(self, response_code, response_data, offset):
+		super(HXAPIPagingError, self).__init__("Failed to fetch the page at offset {}, response code: {}, response: {}".format(offset, response_code, response_data))
+		self.response_code = response_code
+		self.response_data = response_data
+		self.offset = offset
+
+# Connection usage of an HXAPIPoolAdapter, shared by the connection pools it creates
+class HXAPIPoolStats:
+	def __init__(self, size):
+		self._lock = threading.Lock()
+		self.size = size
+		self.checkouts = 0
+		self.waits = 0
+		self.wait_time = 0.0
+		self.max_wait = 0.0
+		self.in_use = 0
+		self.peak_in_use = 0
+		self.timeouts = 0
+	
+	def timed_out(self):
+		with self._lock:
+			self.timeouts += 1
+	
+	def checked_out(self, waited):
+		with self._lock:
+			self.checkouts += 1
+			self.in_use += 1
+			self.peak_in_use = max(self.peak_in_use, self.in_use)
+			# Anything over a millisecond was spent waiting for another thread to return a connection
+			if waited > 0.001:
+				self.waits += 1
+				self.wait_time += waited
+				self.max_wait = max(self.max_wait, waited)
+	
+	def returned(self):
+		with self._lock:
+			self.in_use = max(0, self.in_use - 1)
+	
+	def to_dict(self):
+		with self._lock:
+			return {
+				'size' : self.size,
+				'in_use' : self.in_use,
+				'peak_in_use' : self.peak_in_use,
+				'utilization' : float(self.in_use) / self.size if self.size else 0.0,
+				'checkouts' : self.checkouts,
+				'waits' : self.waits,
+				'wait_time' : self.wait_time,
+				'max_wait' : self.max_wait,
+				'timeouts' : self.timeouts
+			}
+
+class _timed_pool_mixin(object):
+	pool_stats = None
+	pool_timeout = None
+	
+	def _get_conn(self, timeout = None):
+		start = time.perf_counter()
+		try:
+			conn = super(_timed_pool_mixin, self)._get_conn(timeout = self.pool_timeout if timeout is None else timeout)
+		except EmptyPoolError:
+			self.pool_stats.timed_out()
+			raise
+		self.pool_stats.checked_out(time.perf_counter() - start)
+		return conn
+	
+	def _put_conn(self, conn):
+		self.pool_stats.returned()
+		return super(_timed_pool_mixin, self)._put_conn(conn)
+
+# Raised when no pooled connection to the controller was free within the pool timeout. The controller is fine, we
+# are just busy, so it is a ConnectionError that callers and task_module.can_retry() treat as worth retrying later.
+class HXAPIPoolTimeoutError(requests.ConnectionError):
+	pass
+
+# Transport adapter with a fixed size, blocking, connection pool. Threads wait for a free connection rather
+# than opening throwaway ones, up to pool_timeout seconds (forever when None), and the time they spend
+# waiting is recorded in pool_stats.
+class HXAPIPoolAdapter(HTTPAdapter):
+	def __init__(self, pool_size, pool_timeout = None, **kwargs):
+		self.pool_stats = HXAPIPoolStats(pool_size)
+		self.pool_timeout = pool_timeout
+		super(HXAPIPoolAdapter, self).__init__(pool_connections = 1, pool_maxsize = pool_size, pool_block = True, **kwargs)
+	
+	def init_poolmanager(self, connections, maxsize, block = False, **pool_kwargs):
+		super(HXAPIPoolAdapter, self).init_poolmanager(connections, maxsize, block = block, **pool_kwargs)
+		self.poolmanager.pool_classes_by_scheme = {
+			'http' : type('HXAPIHTTPConnectionPool', (_timed_pool_mixin, HTTPConnectionPool), {'pool_stats' : self.pool_stats, 'pool_timeout' : self.pool_timeout}),
+			'https' : type('HXAPIHTTPSConnectionPool', (_timed_pool_mixin, HTTPSConnectionPool), {'pool_stats' : self.pool_stats, 'pool_timeout' : self.pool_timeout})
+		}
+	
+	def send(self, request, **kwargs):
+		try:
+			return super(HXAPIPoolAdapter, self).send(request, **kwargs)
+		except EmptyPoolError as e:
+			raise HXAPIPoolTimeoutError("No connection to the controller was free within {} seconds: {}".format(self.pool_timeout, e), request = request)
+	
+	def __getstate__(self):
+		state = super(HXAPIPoolAdapter, self).__getstate__()
+		state['pool_timeout'] = self.pool_timeout
+		return state
+	
+	def __setstate__(self, state):
+		self.pool_stats = HXAPIPoolStats(state.get('_pool_maxsize'))
+		self.pool_timeout = state.pop('pool_timeout', None)
+		super(HXAPIPoolAdapter, self).__setstate__(state)
+
+# Raised instead of sending a background request to a controller whose circuit breaker is open. It is a
+# ConnectionError so that callers, and task_module.can_retry(), treat it like the controller being unreachable.
+class HXAPICircuitOpenError(requests.ConnectionError):
+	pass
+
+# When and how often a failed request is sent again. Only idempotent methods are retried, on a connection
+# error or one of retry_statuses, waiting a jittered exponential backoff or what Retry-After asks for.
+class HXAPIRetryPolicy:
+	IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+	
+	def __init__(self, retries = 3, backoff_factor = 0.5, backoff_max = 8, retry_statuses = (429, 502, 503, 504)):
+		self.retries = retries
+		self.backoff_factor = backoff_factor
+		self.backoff_max = backoff_max
+		self.retry_statuses = frozenset(retry_statuses)
+	
+	def can_retry(self, method, attempt):
+		return attempt < self.retries and method in self.IDEMPOTENT_METHODS
+	
+	# "Full jitter", a random wait up to the exponential backoff, so clients that failed together don't retry together
+	def backoff(self, attempt):
+		return random.uniform(0, min(self.backoff_max, self.backoff_factor * (2 ** attempt)))
+	
+	# Seconds to wait as asked for by the Retry-After header (seconds or an HTTP date), None if there isn't one
+	@staticmethod
+	def retry_after(response):
+		value = response.headers.get('Retry-After')
+		if not value:
+			return None
+		try:
+			return max(0.0, float(value))
+		except ValueError:
+			pass
+		try:
+			return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+		except (TypeError, ValueError):
+			return None
+
+# Per controller circuit breaker.
+#
+# The outcome of every request to the controller in the last window seconds is kept. Once there are at least
+# min_requests of them and error_threshold of those failed (a connection error or a 5xx/429 response) the
+# breaker opens: background requests fail fast with HXAPICircuitOpenError and nothing is retried. Interactive
+# requests are still sent, a user is waiting for them. After cooldown seconds a single request is let through as
+# a probe, the breaker closes if it succeeds and opens again if it doesn't.
+class HXAPICircuitBreaker:
+	CLOSED = 'closed'
+	OPEN = 'open'
+	HALF_OPEN = 'half_open'
+	
+	def __init__(self, name, window = 60, min_requests = 20, error_threshold = 0.5, cooldown = 30, logger = None):
+		self.name = name
+		self.window = window
+		self.min_requests = min_requests
+		self.error_threshold = error_threshold
+		self.cooldown = cooldown
+		self.logger = logger or logging.getLogger(__name__)
+		self.state = self.CLOSED
+		self._lock = threading.Lock()
+		# (monotonic time, failed)
+		self._outcomes = deque()
+		self._failures = 0
+		self._opened_at = None
+		self._probe_in_flight = False
+		self._probe_thread = None
+		self.counters = {
+			'requests' : 0,
+			'failures' : 0,
+			'retries' : 0,
+			'shed' : 0,
+			'trips' : 0
+		}
+		self.last_trip = None
+	
+	def allow(self, background = False):
+		with self._lock:
+			if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+				self.state = self.HALF_OPEN
+				self._probe_in_flight = False
+			if self.state == self.CLOSED:
+				return True
+			if self.state == self.HALF_OPEN and not self._probe_in_flight:
+				self._probe_in_flight = True
+				self._probe_thread = threading.get_ident()
+				return True
+			if not background:
+				return True
+			self.counters['shed'] += 1
+			return False
+	
+	@property
+	def closed(self):
+		return self.state == self.CLOSED
+	
+	def record(self, failed):
+		with self._lock:
+			now = time.monotonic()
+			self.counters['requests'] += 1
+			if failed:
+				self.counters['failures'] += 1
+			
+			if self.state == self.HALF_OPEN:
+				if failed:
+					self._open(now)
+				else:
+					self.state = self.CLOSED
+					self._outcomes.clear()
+					self._failures = 0
+					self.logger.warning("Circuit breaker for %s closed, the controller is responding again.", self.name)
+				return
+			
+			self._outcomes.append((now, failed))
+			self._failures += failed
+			while self._outcomes and now - self._outcomes[0][0] > self.window:
+				self._failures -= self._outcomes.popleft()[1]
+			
+			if self.state == self.CLOSED and len(self._outcomes) >= self.min_requests and self._failures >= self.error_threshold * len(self._outcomes):
+				self._open(now)
+	
+	# Gives up the half open probe taken by this thread without recording an outcome, for a request that never
+	# reached the controller. The next request is let through as the probe instead.
+	def release_probe(self):
+		with self._lock:
+			if self.state == self.HALF_OPEN and self._probe_in_flight and self._probe_thread == threading.get_ident():
+				self._probe_in_flight = False
+				self._probe_thread = None
+	
+	def record_retry(self):
+		with self._lock:
+			self.counters['retries'] += 1
+	
+	def _open(self, now):
+		self.logger.warning("Circuit breaker for %s opened after %d of the last %d requests failed, background requests are shed for %d seconds.", self.name, self._failures, len(self._outcomes), self.cooldown)
+		self.state = self.OPEN
+		self._opened_at = now
+		self._probe_in_flight = False
+		self.counters['trips'] += 1
+		self.last_trip = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+	
+	def stats(self):
+		with self._lock:
+			return dict(self.counters,
+						state = self.state,
+						error_rate = float(self._failures) / len(self._outcomes) if self._outcomes else 0.0,
+						last_trip = self.last_trip)
+
+# Per endpoint statistics of the requests sent by HXAPI objects, enabled with HXAPI.set_tracer().
+#
+# Requests are grouped by profile, caller, method and route template, the path with the IDs replaced by {id}:
+# the segments that follow a collection in ID_SEGMENTS and anything else that looks like an ID. Past MAX_ROUTES
+# groups, requests to routes not seen before are counted under {other}. The profile and caller come from
+# set_context(), HXTool sets them to the profile and Flask endpoint of a web request and to the profile and
+# module of a task, and clears them with clear_context() when it is done.
+class HXAPITracer:
+	LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+	MAX_ROUTES = 2000
+	# Collection -> number of ID segments after it, unless the next segment is one of ROUTE_KEYWORDS
+	ID_SEGMENTS = {
+		'hosts' : 1,
+		'host_sets' : 1,
+		'alerts' : 1,
+		'source_alerts' : 1,
+		'searches' : 1,
+		'scripts' : 1,
+		'quarantines' : 1,
+		'conditions' : 1,
+		'execution' : 1,
+		'presence' : 1,
+		'bulk' : 1,
+		'files' : 1,
+		'triages' : 1,
+		'live' : 1,
+		'channels' : 1,
+		'indicator_categories' : 1,
+		'indicators' : 2
+	}
+	ROUTE_KEYWORDS = frozenset(['filter', 'static', 'dynamic', 'actions', 'summary', 'execution', 'presence'])
+	_context = threading.local()
+	_digit = re.compile(r'\d')
+	
+	class _route_stats:
+		__slots__ = ['calls', 'statuses', 'retries', 'bytes', 'latency_total', 'latency_max', 'histogram']
+		
+		def __init__(self, buckets):
+			self.calls = 0
+			self.statuses = {}
+			self.retries = 0
+			self.bytes = 0
+			self.latency_total = 0.0
+			self.latency_max = 0.0
+			self.histogram = [0] * (buckets + 1)
+	
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._routes = {}
+		self.since = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+	
+	@staticmethod
+	def set_context(profile, caller):
+		HXAPITracer._context.value = (profile, caller)
+	
+	@staticmethod
+	def clear_context():
+		HXAPITracer._context.value = None
+	
+	@staticmethod
+	def get_context():
+		return getattr(HXAPITracer._context, 'value', None)
+	
+	# Wraps f to run with the context of the calling thread, for handing calls to worker threads
+	@staticmethod
+	def bind(f):
+		context = HXAPITracer.get_context()
+		if context is None:
+			return f
+		def bound(*args, **kwargs):
+			HXAPITracer._context.value = context
+			try:
+				return f(*args, **kwargs)
+			finally:
+				HXAPITracer._context.value = None
+		return bound
+	
+	@staticmethod
+	def route_template(path):
+		segments = path.split('?', 1)[0].split('/')
+		ids = 0
+		for i, segment in enumerate(segments):
+			if (ids and segment and segment not in HXAPITracer.ROUTE_KEYWORDS) or segment.isdigit() or (len(segment) >= 8 and HXAPITracer._digit.search(segment)):
+				(name, dot, extension) = segment.rpartition('.')
+				segments[i] = '{id}' + (dot + extension if name and len(extension) <= 4 else '')
+				ids = max(0, ids - 1)
+			else:
+				ids = HXAPITracer.ID_SEGMENTS.get(segment, 0)
+		return '/'.join(segments)
+	
+	# status is the response status code, or 'error' or 'shed' when the request wasn't answered
+	def record(self, hx_api_object, request, status, latency, response_bytes, retries):
+		(profile, caller) = self.get_context() or ("{}:{}".format(hx_api_object.hx_host, hx_api_object.hx_port), None)
+		key = (profile, caller, hx_api_object.background, request.method, self.route_template(request.path_url))
+		latency_ms = latency * 1000
+		bucket = len(self.LATENCY_BUCKETS_MS)
+		for i, upper in enumerate(self.LATENCY_BUCKETS_MS):
+			if latency_ms <= upper:
+				bucket = i
+				break
+		with self._lock:
+			route = self._routes.get(key)
+			if route is None and len(self._routes) >= self.MAX_ROUTES:
+				key = key[:4] + ('{other}',)
+				route = self._routes.get(key)
+			if route is None:
+				route = self._routes[key] = HXAPITracer._route_stats(len(self.LATENCY_BUCKETS_MS))
+			route.calls += 1
+			route.statuses[status] = route.statuses.get(status, 0) + 1
+			route.retries += retries
+			route.bytes += response_bytes
+			route.latency_total += latency_ms
+			route.latency_max = max(route.latency_max, latency_ms)
+			route.histogram[bucket] += 1
+		return route
+	
+	# For streamed responses, whose size is only known once they have been read
+	def add_bytes(self, route, response_bytes):
+		with self._lock:
+			route.bytes += response_bytes
+	
+	def reset(self):
+		with self._lock:
+			self._routes = {}
+			self.since = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+	
+	# Percentiles are the upper bound of the histogram bucket they fall in
+	def _percentile(self, route, p):
+		target = p / 100.0 * route.calls
+		count = 0
+		for i, n in enumerate(route.histogram):
+			count += n
+			if count >= target and n:
+				return self.LATENCY_BUCKETS_MS[i] if i < len(self.LATENCY_BUCKETS_MS) else route.latency_max
+		return route.latency_max
+	
+	def stats(self):
+		r = []
+		with self._lock:
+			for (profile, caller, background, method, route_template), route in self._routes.items():
+				r.append({
+					'profile' : profile,
+					'caller' : caller,
+					'background' : background,
+					'method' : method,
+					'route' : route_template,
+					'calls' : route.calls,
+					'statuses' : { str(k) : v for k, v in route.statuses.items() },
+					'retries' : route.retries,
+					'bytes' : route.bytes,
+					'latency_ms' : {
+						'mean' : route.latency_total / route.calls,
+						'p50' : self._percentile(route, 50),
+						'p90' : self._percentile(route, 90),
+						'p99' : self._percentile(route, 99),
+						'max' : route.latency_max
+					},
+					'histogram' : dict(zip(['<={}'.format(_) for _ in self.LATENCY_BUCKETS_MS] + ['>{}'.format(self.LATENCY_BUCKETS_MS[-1])], route.histogram))
+				})
+		return sorted(r, key = lambda _: _['calls'], reverse = True)
+
+# A download split into byte ranges that are fetched in parallel into path.part. Progress is kept in
+# path.part.json so an interrupted download carries on where it stopped. The SHA-256 of the file is computed
+# in order as the ranges come in, the partial file is only read back to catch up on data that arrived ahead
+# of the range being hashed, while it is still in the page cache. One segment thread at a time does the
+# hashing, the others carry on writing.
+class _segmented_download:
+	def __init__(self, path, url, size, segment_count, state = None):
+		self.path = path
+		self.part_path = path + '.part'
+		self.state_path = path + '.part.json'
+		self.url = url
+		self.size = size
+		self.resumed = state is not None
+		self._lock = threading.Lock()
+		self._hash_lock = threading.Lock()
+		self._state_lock = threading.Lock()
+		self._sha256 = hashlib.sha256()
+		self._hashed = 0
+		if state:
+			self.segments = state['segments']
+		else:
+			segment_size = -(-size // segment_count)
+			# [first byte, last byte, bytes written]
+			self.segments = [[start, min(start + segment_size, size) - 1, 0] for start in range(0, size, segment_size)]
+			with open(self.part_path, 'wb') as f:
+				f.truncate(size)
+			self.save_state()
+	
+	@staticmethod
+	def load_state(path, url, size):
+		try:
+			with open(path + '.part.json', 'r') as f:
+				state = json.load(f)
+			if state['url'] == url and state['size'] == size and os.path.getsize(path + '.part') == size:
+				return state
+		except (OSError, ValueError, KeyError):
+			pass
+		return None
+	
+	def save_state(self):
+		with self._state_lock:
+			with open(self.state_path + '.tmp', 'w') as f:
+				json.dump({'url' : self.url, 'size' : self.size, 'segments' : self.segments}, f)
+			os.replace(self.state_path + '.tmp', self.state_path)
+	
+	def pending(self):
+		return [i for i, (start, end, written) in enumerate(self.segments) if start + written <= end]
+	
+	# f is the segment's unbuffered handle on the partial file, positioned where data goes
+	def write(self, f, index, data):
+		start, end, written = self.segments[index]
+		position = start + written
+		data = data[:end + 1 - position]
+		f.write(data)
+		with self._lock:
+			self.segments[index][2] += len(data)
+		# Whoever is hashing picks this data up as well, failing that the next write or finish() does
+		if self._hash_lock.acquire(blocking = False):
+			try:
+				if position == self._hashed:
+					self._sha256.update(data)
+					self._hashed += len(data)
+				self._catch_up()
+			finally:
+				self._hash_lock.release()
+		return len(data)
+	
+	# End of the data written from the start of the file on
+	def _contiguous(self):
+		with self._lock:
+			contiguous = 0
+			for start, end, written in self.segments:
+				contiguous = start + written
+				if contiguous <= end:
+					break
+			return contiguous
+	
+	# Hash whatever has been written right after the data hashed so far. Must be called with self._hash_lock
+	# held, the partial file is read without self._lock so the other segments aren't held up.
+	def _catch_up(self):
+		contiguous = self._contiguous()
+		while contiguous > self._hashed:
+			with open(self.part_path, 'rb') as f:
+				f.seek(self._hashed)
+				while self._hashed < contiguous:
+					data = f.read(min(HXAPI.DOWNLOAD_CHUNK_SIZE, contiguous - self._hashed))
+					self._sha256.update(data)
+					self._hashed += len(data)
+			contiguous = self._contiguous()
+	
+	def finish(self):
+		with self._hash_lock:
+			self._catch_up()
+		os.replace(self.part_path, self.path)
+		os.remove(self.state_path)
+		return self._sha256.hexdigest()
+
+_ENTRIES_START = object()
+
+# Incremental decoder for list responses, {..., "data" : {..., "entries" : [...], ...}, ...}, read from an
+# iterator of text chunks. Iterating over it yields the entries one at a time, envelope holds everything else:
+# the fields in front of the entries as soon as the stream is created, the rest once the entries are consumed.
+class HXAPIJSONEntryStream:
+	def __init__(self, chunks, on_close = None):
+		self._chunks = iter(chunks)
+		self._on_close = on_close
+		self._buffer = ''
+		self._pos = 0
+		self._decoder = json.JSONDecoder()
+		self.envelope = {}
+		self._parser = self._parse()
+		# Read up to the entries
+		self.has_entries = next(self._parser, None) is _ENTRIES_START
+		if not self.has_entries:
+			self.close()
+	
+	def __iter__(self):
+		try:
+			for entry in self._parser:
+				yield entry
+		finally:
+			self.close()
+	
+	def close(self):
+		if self._on_close:
+			self._on_close()
+			self._on_close = None
+	
+	def __del__(self):
+		self.close()
+	
+	def _fill(self):
+		for chunk in self._chunks:
+			if chunk:
+				self._buffer = self._buffer[self._pos:] + chunk
+				self._pos = 0
+				return True
+		return False
+	
+	# Returns the next non-whitespace character without consuming it, None at the end of the stream
+	def _peek(self):
+		while True:
+			while self._pos < len(self._buffer) and self._buffer[self._pos] in ' \t\r\n':
+				self._pos += 1
+			if self._pos < len(self._buffer):
+				return self._buffer[self._pos]
+			if not self._fill():
+				return None
+	
+	def _expect(self, c):
+		if self._peek() != c:
+			raise ValueError("Expected '{}' at position {} of the response.".format(c, self._pos))
+		self._pos += 1
+	
+	def _value(self):
+		self._peek()
+		while True:
+			try:
+				(value, end) = self._decoder.raw_decode(self._buffer, self._pos)
+				# A value that runs up to the end of the buffer may continue in the next chunk, i.e. a number
+				if end < len(self._buffer) or not self._fill():
+					self._pos = end
+					return value
+			except ValueError:
+				if not self._fill():
+					raise
+	
+	def _object(self, target, path):
+		self._expect('{')
+		while True:
+			c = self._peek()
+			if c == '}':
+				self._pos += 1
+				return
+			elif c == ',':
+				self._pos += 1
+				continue
+			key = self._value()
+			self._expect(':')
+			c = self._peek()
+			if path == () and key == 'data' and c == '{':
+				target[key] = {}
+				for _ in self._object(target[key], ('data',)):
+					yield _
+			elif path == ('data',) and key == 'entries' and c == '[':
+				self._pos += 1
+				yield _ENTRIES_START
+				while True:
+					c = self._peek()
+					if c == ']':
+						self._pos += 1
+						break
+					elif c == ',':
+						self._pos += 1
+						continue
+					elif c is None:
+						raise ValueError("The response ended inside the entries.")
+					yield self._value()
+			else:
+				target[key] = self._value()
+	
+	def _parse(self):
+		for _ in self._object(self.envelope, ()):
+			yield _
 
 class HXAPI:
 	HX_DEFAULT_PORT = 3000
 	HX_MIN_API_VERSION = 2
 	DEFAULT_LIMIT = 100000
+	DEFAULT_PAGE_SIZE = 1000
+	# Responses smaller than this are decoded in one go even when streaming the entries was asked for
+	STREAM_ENTRIES_MIN_SIZE = 1048576
+	STREAM_CHUNK_SIZE = 65536
+	# Downloads of at least two DOWNLOAD_SEGMENT_MIN_SIZE are fetched in up to DOWNLOAD_SEGMENTS parallel ranges
+	DOWNLOAD_SEGMENTS = 4
+	DOWNLOAD_SEGMENT_MIN_SIZE = 33554432
+	DOWNLOAD_CHUNK_SIZE = 1048576
+	# Progress of a ranged download is saved every this many bytes of a segment
+	DOWNLOAD_STATE_INTERVAL = 16777216
+	
+	# Set with set_tracer(), None when tracing is disabled
+	tracer = None
+	
+	# Retry and circuit breaker settings shared by all HXAPI objects, see configure_resilience()
+	retry_policy = HXAPIRetryPolicy()
+	circuit_breaker_settings = {}
+	_circuit_breakers = {}
+	_circuit_breakers_lock = threading.Lock()
 	
-	def __init__(self, hx_host, hx_port = HX_DEFAULT_PORT, headers = None, cookies = None, proxies = None, disable_certificate_verification = True, logger_name = None, default_encoding = 'utf-8'):
+	# pool_size is the number of connections kept to the controller, which is also the most requests that
+	# can be in flight at once. By default requests keeps 10 and opens extra short lived ones past that.
+	# A request that can't get one of them within pool_timeout seconds fails with HXAPIPoolTimeoutError.
+	# background marks the object as used by the scheduler, its requests are shed when the controller's
+	# circuit breaker is open.
+	def __init__(self, hx_host, hx_port = HX_DEFAULT_PORT, headers = None, cookies = None, proxies = None, disable_certificate_verification = True, logger_name = None, default_encoding = 'utf-8', pool_size = None, pool_timeout = None, background = False):
 		if logger_name:
 			self.logger = logging.getLogger(logger_name)
 		else:
@@ -55,6 +715,16 @@ class HXAPI:
 				self._session.proxies = proxies
 			self.logger.info("Proxy support enabled.")
 		
+		self._pool_adapter = None
+		if pool_size:
+			self._pool_adapter = HXAPIPoolAdapter(pool_size, pool_timeout = pool_timeout)
+			self._session.mount('https://', self._pool_adapter)
+			self._session.mount('http://', self._pool_adapter)
+		
+		# Serializes token checks and renewals between threads sharing this object
+		self._token_lock = threading.Lock()
+		
+		self.background = background
 		
 		if headers:
 			self.logger.debug('Appending additional headers passed to __init__')
@@ -93,17 +763,79 @@ class HXAPI:
 	def deserialize(base64_pickle):
 		return pickle.loads(HXAPI.b64(base64_pickle, True))
 	
-	# Loggers don't pickle nicely	
+	# The part of a logged in API object worth keeping between requests, without the password or the
+	# requests session. from_session_state() turns it back into a working object.
+	def session_state(self):
+		return {
+			'hx_host' : self.hx_host,
+			'hx_port' : self.hx_port,
+			'hx_user' : self.hx_user,
+			'token' : self.fe_token['token'] if self.fe_token else None,
+			'grant_timestamp' : self.fe_token['grant_timestamp'] if self.fe_token else None,
+			'api_version' : self.api_version,
+			'hx_version' : self.hx_version
+		}
+	
+	# kwargs are passed to the constructor, i.e. proxies, headers and cookies
+	@staticmethod
+	def from_session_state(state, **kwargs):
+		o = HXAPI(state['hx_host'], hx_port = state['hx_port'], **kwargs)
+		o.hx_user = state['hx_user']
+		if state['token']:
+			o.fe_token = {'token' : state['token'], 'grant_timestamp' : state['grant_timestamp'], 'last_use_timestamp' : state['grant_timestamp']}
+		o.api_version = state['api_version']
+		o.hx_version = state['hx_version']
+		return o
+	
+	# settings is the network.api_resilience configuration item
+	@staticmethod
+	def configure_resilience(settings):
+		settings = settings or {}
+		HXAPI.retry_policy = HXAPIRetryPolicy(**{ k : v for k, v in settings.items() if k in ('retries', 'backoff_factor', 'backoff_max', 'retry_statuses') })
+		HXAPI.circuit_breaker_settings = { k[8:] : v for k, v in settings.items() if k.startswith('breaker_') }
+		with HXAPI._circuit_breakers_lock:
+			HXAPI._circuit_breakers.clear()
+	
+	@staticmethod
+	def set_tracer(tracer):
+		HXAPI.tracer = tracer
+	
+	@staticmethod
+	def circuit_breaker_stats():
+		with HXAPI._circuit_breakers_lock:
+			breakers = dict(HXAPI._circuit_breakers)
+		return { name : breaker.stats() for name, breaker in breakers.items() }
+	
+	# One breaker per controller, shared by every HXAPI object talking to it
+	def circuit_breaker(self):
+		name = "{}:{}".format(self.hx_host, self.hx_port)
+		with HXAPI._circuit_breakers_lock:
+			breaker = HXAPI._circuit_breakers.get(name)
+			if breaker is None:
+				breaker = HXAPI._circuit_breakers[name] = HXAPICircuitBreaker(name, logger = self.logger, **HXAPI.circuit_breaker_settings)
+			return breaker
+	
+	def pool_stats(self):
+		return self._pool_adapter.pool_stats.to_dict() if self._pool_adapter else None
+	
+	# Loggers and locks don't pickle nicely	
 	def __getstate__(self):
 		d = self.__dict__.copy()
 		if 'logger' in d.keys():
 			d['logger'] = d['logger'].name
+		d.pop('_token_lock', None)
 		return d
 
 	def __setstate__(self, d):
 		if 'logger' in d.keys():
 			d['logger'] = logging.getLogger(d['logger'])
+		d.setdefault('_pool_adapter', None)
+		d.setdefault('background', False)
 		self.__dict__.update(d)
+		self._token_lock = threading.Lock()
+		# The unpickled session has new adapters
+		if self._pool_adapter is not None:
+			self._pool_adapter = self._session.get_adapter('https://')
 		if not self._session.verify:
 			self.suppress_requests_insecure_warning()	
 
@@ -146,14 +878,92 @@ class HXAPI:
 	def build_module_api_route(self, module_name, api_endpoint, min_api_version):
 		return '/hx/api/plugins/{0}/v{1}/{2}'.format(module_name, min_api_version, api_endpoint)
 		
-	def handle_response(self, request, multiline_json = False, multiline_json_limit = DEFAULT_LIMIT, stream = False):
+	# Sends the request through the retry policy and the controller's circuit breaker
+	def send_request(self, request, stream = False):
+		tracer = HXAPI.tracer
+		if tracer is None:
+			return self._send_request(request, stream)
+		
+		trace = {'retries' : 0}
+		start = time.perf_counter()
+		try:
+			response = self._send_request(request, stream, trace = trace)
+		except requests.ConnectionError as e:
+			tracer.record(self, request, 'shed' if isinstance(e, HXAPICircuitOpenError) else 'error', time.perf_counter() - start, 0, trace['retries'])
+			raise
+		
+		content_length = response.headers.get('Content-Length')
+		if content_length is not None and content_length.isdigit():
+			response_bytes = int(content_length)
+		elif not stream:
+			response_bytes = len(response.content)
+		else:
+			response_bytes = None
+		route = tracer.record(self, request, response.status_code, time.perf_counter() - start, response_bytes or 0, trace['retries'])
+		
+		if response_bytes is None:
+			close = response.close
+			def traced_close():
+				if response.raw is not None and not getattr(response, '_hxapi_traced', False):
+					response._hxapi_traced = True
+					tracer.add_bytes(route, response.raw.tell())
+				close()
+			response.close = traced_close
+		return response
+	
+	def _send_request(self, request, stream, trace = None):
+		breaker = self.circuit_breaker()
+		attempt = 0
+		while True:
+			if not breaker.allow(self.background):
+				raise HXAPICircuitOpenError("The circuit breaker for {} is open, not sending background request {} {}".format(breaker.name, request.method, request.path_url))
+			delay = None
+			try:
+				response = self._session.send(request, stream = stream)
+			except HXAPIPoolTimeoutError:
+				# Says nothing about the controller, and retrying here would only add to the wait
+				breaker.release_probe()
+				raise
+			except requests.ConnectionError as e:
+				breaker.record(True)
+				if not (breaker.closed and self.retry_policy.can_retry(request.method, attempt)):
+					raise
+				self.logger.info("%s %s failed: %s, retrying.", request.method, request.path_url, e)
+			except BaseException:
+				breaker.release_probe()
+				raise
+			else:
+				breaker.record(response.status_code >= 500 or response.status_code == 429)
+				if response.status_code not in self.retry_policy.retry_statuses or not (breaker.closed and self.retry_policy.can_retry(request.method, attempt)):
+					return response
+				delay = self.retry_policy.retry_after(response)
+				# Don't keep a user, or a task thread, waiting longer than we would have backed off
+				if delay is not None and delay > self.retry_policy.backoff_max:
+					return response
+				response.close()
+				self.logger.info("%s %s returned %d, retrying.", request.method, request.path_url, response.status_code)
+			
+			if delay is None:
+				delay = self.retry_policy.backoff(attempt)
+			breaker.record_retry()
+			attempt += 1
+			if trace is not None:
+				trace['retries'] = attempt
+			time.sleep(delay)
+	
+	# With stream_entries, a large list response is decoded as it is read and response_data['data']['entries'] is
+	# an HXAPIJSONEntryStream rather than a list. The connection stays open until the entries have been consumed.
+	# Likewise with multiline_json_stream, response_data is a generator of the objects of a multiline JSON response.
+	def handle_response(self, request, multiline_json = False, multiline_json_limit = DEFAULT_LIMIT, stream = False, stream_entries = False, multiline_json_stream = False):
 		
 		response = None
 		response_data = None
+		entry_stream = None
+		keep_open = False
 		
 		try:
 			self.logger.debug("Sending request, awaiting response")
-			response = self._session.send(request, stream = stream)
+			response = self.send_request(request, stream = stream or stream_entries)
 			self.logger.debug("Have response.")
 
 			if not response.ok:
@@ -173,13 +983,21 @@ class HXAPI:
 				self.logger.info("Request Accept header '%s' does not match response Content-Type '%s'", request.headers['Accept'].lower(), content_type.lower())
 			
 			if content_type is not None and 'json' in content_type.lower():
-				if multiline_json:
+				if multiline_json and multiline_json_stream:
+					response_data = HXAPI._iter_multiline_json(response)
+					keep_open = True
+				elif multiline_json:
 					response_data = []
 					for l in response.iter_lines(chunk_size = 4096, decode_unicode = True):
 						if l.startswith('{'):
 							response_data.append(json.loads(l))
 							if len(response_data) >= multiline_json_limit:
 								break
+				elif stream_entries and int(response.headers.get('Content-Length', self.STREAM_ENTRIES_MIN_SIZE)) >= self.STREAM_ENTRIES_MIN_SIZE:
+					entry_stream = HXAPIJSONEntryStream(response.iter_content(chunk_size = self.STREAM_CHUNK_SIZE, decode_unicode = True), on_close = response.close)
+					response_data = entry_stream.envelope
+					if entry_stream.has_entries:
+						response_data['data']['entries'] = entry_stream
 				else:
 					response_data = response.json()
 			else:
@@ -206,8 +1024,17 @@ class HXAPI:
 				return(False, response.status_code, response_data, response.headers)
 			return(False, None, e, None)
 		finally:
-			if response:
+			if response and not (entry_stream and entry_stream.has_entries) and not keep_open:
 				response.close()
+	
+	@staticmethod
+	def _iter_multiline_json(response):
+		try:
+			for l in response.iter_lines(chunk_size = 4096, decode_unicode = True):
+				if l.startswith('{'):
+					yield json.loads(l)
+		finally:
+			response.close()
 		
 
 	def set_token(self, token):
@@ -250,6 +1077,84 @@ class HXAPI:
 	###################
 	## Generic URL Function
 	###################
+	##########
+	# Paging #
+	##########
+	
+	# Generator over the pages of a list endpoint, yields the entries of each page as a list.
+	# list_function is one of the restList*/restGet* functions that take limit and offset, when prefetch
+	# is set the next page is requested on a background thread while the caller works on the current one.
+	def iterPages(self, list_function, page_size = DEFAULT_PAGE_SIZE, prefetch = True, **kwargs):
+		executor = ThreadPoolExecutor(max_workers = 1) if prefetch else None
+		
+		@HXAPITracer.bind
+		def fetch(offset):
+			return list_function(limit = page_size, offset = offset, **kwargs)
+		
+		try:
+			offset = 0
+			pending = executor.submit(fetch, offset) if executor else None
+			while True:
+				(ret, response_code, response_data) = pending.result() if executor else fetch(offset)
+				if not ret:
+					raise HXAPIPagingError(response_code, response_data, offset)
+				
+				entries = response_data['data']['entries']
+				total = response_data['data'].get('total', None)
+				offset += len(entries)
+				more = len(entries) >= page_size and (total is None or offset < total)
+				if more and executor:
+					pending = executor.submit(fetch, offset)
+				
+				if entries:
+					yield entries
+				if not more:
+					break
+		finally:
+			if executor:
+				executor.shutdown(wait = False)
+	
+	def _iter_entries(self, list_function, page_size, prefetch, **kwargs):
+		for entries in self.iterPages(list_function, page_size = page_size, prefetch = prefetch, **kwargs):
+			for entry in entries:
+				yield entry
+	
+	def iterHosts(self, page_size = DEFAULT_PAGE_SIZE, prefetch = True, **kwargs):
+		return self._iter_entries(self.restListHosts, page_size, prefetch, **kwargs)
+	
+	def iterHostsInHostset(self, host_set_id, page_size = DEFAULT_PAGE_SIZE, prefetch = True, **kwargs):
+		return self._iter_entries(self.restListHostsInHostset, page_size, prefetch, host_set_id = host_set_id, **kwargs)
+	
+	def iterHostsets(self, page_size = DEFAULT_PAGE_SIZE, prefetch = True, **kwargs):
+		return self._iter_entries(self.restListHostsets, page_size, prefetch, **kwargs)
+	
+	def iterAlerts(self, page_size = DEFAULT_PAGE_SIZE, prefetch = True, **kwargs):
+		return self._iter_entries(self.restGetAlerts, page_size, prefetch, **kwargs)
+	
+	def iterBulkAcquisitions(self, page_size = DEFAULT_PAGE_SIZE, prefetch = True, **kwargs):
+		return self._iter_entries(self.restListBulkAcquisitions, page_size, prefetch, **kwargs)
+	
+	def iterBulkHosts(self, bulk_id, page_size = DEFAULT_PAGE_SIZE, prefetch = True, **kwargs):
+		return self._iter_entries(self.restListBulkHosts, page_size, prefetch, bulk_id = bulk_id, **kwargs)
+	
+	def iterSearches(self, page_size = DEFAULT_PAGE_SIZE, prefetch = True, **kwargs):
+		return self._iter_entries(self.restListSearches, page_size, prefetch, **kwargs)
+	
+	def iterSearchResults(self, search_id, page_size = DEFAULT_PAGE_SIZE, prefetch = True):
+		return self._iter_entries(self.restGetSearchResults, page_size, prefetch, search_id = search_id)
+	
+	def iterTriages(self, page_size = DEFAULT_PAGE_SIZE, prefetch = True, **kwargs):
+		return self._iter_entries(self.restListTriages, page_size, prefetch, **kwargs)
+	
+	def iterFileAcquisitions(self, page_size = DEFAULT_PAGE_SIZE, prefetch = True, **kwargs):
+		return self._iter_entries(self.restListFileaq, page_size, prefetch, **kwargs)
+	
+	def iterDataAcquisitions(self, page_size = DEFAULT_PAGE_SIZE, prefetch = True, **kwargs):
+		return self._iter_entries(self.restListDataAcquisitions, page_size, prefetch, **kwargs)
+	
+	def iterIndicators(self, page_size = DEFAULT_PAGE_SIZE, prefetch = True, **kwargs):
+		return self._iter_entries(self.restListIndicators, page_size, prefetch, **kwargs)
+	
 	def restGetUrl(self, url, method = 'GET', data = None, include_params=False, limit=DEFAULT_LIMIT, offset=0, share_mode=None, sort_term=None, search_term=None, filter_term={}, query_terms = {}):
 		params = {}
 		if include_params:
@@ -318,6 +1223,10 @@ class HXAPI:
 	# or 2.5 hours, whichever comes first.
 	# See page 47 of the API guide
 	def restIsSessionValid(self):
+		with self._token_lock:
+			return self._is_session_valid()
+	
+	def _is_session_valid(self):
 		is_valid = False
 		current_token = self.get_token(update_last_use_timestamp=False)
 		if current_token:
@@ -703,6 +1612,14 @@ class HXAPI:
 		
 		return(ret, response_code, response_data)
 		
+	# Get Triage Acquisition Status
+	def restTriageAcquisitionByID(self, acq_id):
+
+		request = self.build_request(self.build_api_route('acqs/triages/{0}'.format(acq_id)))
+		(ret, response_code, response_data, response_headers) = self.handle_response(request)
+		
+		return(ret, response_code, response_data)
+		
 	# Get Data Acquisition Status
 	def restDataAcquisitionByID(self, acq_id):
 
@@ -778,27 +1695,130 @@ class HXAPI:
 
 
 	# Download an acquisition (file)
-	def restDownloadFile(self, url, destination_file_path = None, accept = 'application/octet-stream'):
-
+	# Without destination_file_path the streaming response is returned. With it, the file is downloaded in
+	# parallel ranges (or in one piece when the controller doesn't support Range) to destination_file_path.part
+	# and renamed when complete. Calling again after a failure resumes the download. response_data is then
+	# {'sha256' : <hex digest of the file>, 'size' : <bytes>, 'resumed' : <True when carried on from a partial file>}
+	def restDownloadFile(self, url, destination_file_path = None, accept = 'application/octet-stream', segments = None):
+		
+		if destination_file_path:
+			return self._download_to_file(url, destination_file_path, accept, segments or self.DOWNLOAD_SEGMENTS)
+		
 		request = self.build_request(url, accept = accept)
 		try:
-			response = self._session.send(request, stream = True)
+			response = self.send_request(request, stream = True)
 			
 			if not response.encoding:
 				response.encoding = self.default_encoding
 			
-			if destination_file_path: 
-				with open(destination_file_path, 'wb') as f:
-					shutil.copyfileobj(response.raw, f)
-				return(True, response.status_code, None)	
-			else:
-				return(True, response.status_code, response)
+			return(True, response.status_code, response)
 				
 		except (requests.HTTPError, requests.ConnectionError) as e:
 			response_code = None
 			if e.response:
 				response_code = e.response.status_code
 			return(False, response_code, e)
+	
+	def _download_to_file(self, url, destination_file_path, accept, segments):
+		try:
+			# Ask for the first byte to find out the size and whether the controller supports Range
+			request = self.build_request(url, accept = accept)
+			request.headers['Range'] = 'bytes=0-0'
+			response = self.send_request(request, stream = True)
+			with response:
+				if response.status_code == 200:
+					self.logger.debug("The controller ignored the Range header for %s, downloading in one piece.", url)
+					return self._download_whole(response, destination_file_path)
+				elif response.status_code != 416:
+					response.raise_for_status()
+				size = HXAPI._content_range_size(response.headers.get('Content-Range'))
+			
+			if response.status_code == 416 or size is None:
+				# An empty file, or no usable Content-Range
+				request = self.build_request(url, accept = accept)
+				response = self.send_request(request, stream = True)
+				with response:
+					response.raise_for_status()
+					return self._download_whole(response, destination_file_path)
+			
+			state = _segmented_download.load_state(destination_file_path, url, size)
+			download = _segmented_download(destination_file_path, url, size, max(1, min(segments, size // self.DOWNLOAD_SEGMENT_MIN_SIZE)), state = state)
+			if state:
+				self.logger.info("Resuming the download of %s to %s, %d of %d bytes left.", url, destination_file_path, sum([end + 1 - start - written for start, end, written in download.segments]), size)
+			
+			pending = download.pending()
+			if pending:
+				with ThreadPoolExecutor(max_workers = len(pending), thread_name_prefix = 'HXAPIDownload') as executor:
+					futures = [executor.submit(HXAPITracer.bind(self._download_segment), url, accept, download, i) for i in pending]
+				download.save_state()
+				for future in futures:
+					if future.exception():
+						raise future.exception()
+			
+			return(True, 206, {'sha256' : download.finish(), 'size' : size, 'resumed' : download.resumed})
+			
+		except (requests.HTTPError, requests.ConnectionError, ProtocolError) as e:
+			response_code = None
+			if getattr(e, 'response', None) is not None:
+				response_code = e.response.status_code
+			return(False, response_code, e)
+	
+	# Downloads the range of a _segmented_download segment that hasn't been written yet, carrying on from
+	# where the data stopped when the connection drops
+	def _download_segment(self, url, accept, download, index):
+		attempt = 0
+		unsaved = 0
+		with open(download.part_path, 'r+b', buffering = 0) as f:
+			while True:
+				start, end, written = download.segments[index]
+				if start + written > end:
+					return
+				request = self.build_request(url, accept = accept)
+				request.headers['Range'] = 'bytes={}-{}'.format(start + written, end)
+				try:
+					response = self.send_request(request, stream = True)
+					with response:
+						response.raise_for_status()
+						if response.status_code != 206:
+							raise requests.HTTPError("The controller ignored the Range header while resuming {}".format(url), response = response)
+						f.seek(start + written)
+						for data in response.raw.stream(self.DOWNLOAD_CHUNK_SIZE, decode_content = False):
+							unsaved += download.write(f, index, data)
+							if unsaved >= self.DOWNLOAD_STATE_INTERVAL:
+								download.save_state()
+								unsaved = 0
+				except (requests.ConnectionError, ProtocolError) as e:
+					if not self.retry_policy.can_retry(request.method, attempt):
+						raise
+					self.logger.info("The download of %s was interrupted: %s, resuming at byte %d.", url, e, start + download.segments[index][2])
+				# A response that ended early without an error is retried the same way
+				if download.segments[index][2] == written:
+					if not self.retry_policy.can_retry(request.method, attempt):
+						raise requests.ConnectionError("No progress downloading bytes {}-{} of {}".format(start + written, end, url))
+					time.sleep(self.retry_policy.backoff(attempt))
+					attempt += 1
+	
+	def _download_whole(self, response, destination_file_path):
+		sha256 = hashlib.sha256()
+		size = 0
+		with open(destination_file_path + '.part', 'wb') as f:
+			for data in response.raw.stream(self.DOWNLOAD_CHUNK_SIZE, decode_content = False):
+				f.write(data)
+				sha256.update(data)
+				size += len(data)
+		os.replace(destination_file_path + '.part', destination_file_path)
+		if os.path.exists(destination_file_path + '.part.json'):
+			os.remove(destination_file_path + '.part.json')
+		return(True, response.status_code, {'sha256' : sha256.hexdigest(), 'size' : size, 'resumed' : False})
+	
+	# Total size from a "bytes 0-0/1234" Content-Range
+	@staticmethod
+	def _content_range_size(content_range):
+		try:
+			size = content_range.rsplit('/', 1)[1]
+			return None if size == '*' else int(size)
+		except (AttributeError, IndexError, ValueError):
+			return None
 			
 	# Delete bulk acquisition file		
 	def restDeleteFile(self, url):
@@ -985,10 +2005,10 @@ class HXAPI:
 		
 		return(ret, response_code, response_data)
 
-	def restGetSearchResults(self, search_id, limit=DEFAULT_LIMIT):
+	def restGetSearchResults(self, search_id, limit=DEFAULT_LIMIT, offset=0, stream_entries=False):
 
-		request = self.build_request(self.build_api_route('searches/{0}/results?limit={1}'.format(search_id, limit)))
-		(ret, response_code, response_data, response_headers) = self.handle_response(request)
+		request = self.build_request(self.build_api_route('searches/{0}/results?limit={1}&offset={2}'.format(search_id, limit, offset)))
+		(ret, response_code, response_data, response_headers) = self.handle_response(request, stream_entries = stream_entries)
 		
 		return(ret, response_code, response_data)
 
@@ -1004,7 +2024,7 @@ class HXAPI:
 		
 		return(ret, response_code, response_data)
 
-	def restGetAlerts(self, limit=DEFAULT_LIMIT, offset=0, has_share_mode=None, sort_term='reported_at+desc', filter_term={}, resolution_term=None):
+	def restGetAlerts(self, limit=DEFAULT_LIMIT, offset=0, has_share_mode=None, sort_term='reported_at+desc', filter_term={}, resolution_term=None, stream_entries = False):
 		
 		endpoint_url = "alerts"
 		params = {
@@ -1020,28 +2040,42 @@ class HXAPI:
 		params.update(filter_term)
 		
 		request = self.build_request(self.build_api_route(endpoint_url), params = params)
-		(ret, response_code, response_data, response_headers) = self.handle_response(request)
+		(ret, response_code, response_data, response_headers) = self.handle_response(request, stream_entries = stream_entries)
 		
 		return(ret, response_code, response_data)
 
-	# NOTE: this function does not return data in the usual way, the response is a list of alerts
-	def restGetAlertsHost(self, agent_id, limit = DEFAULT_LIMIT):
+	# Alerts matching query from alerts/filter, newest (by reported_at) first. With a limit, only the newest limit
+	# alerts are kept in a heap of that size while the response is read. predicate(alert) is applied to each alert as
+	# it is decoded, so alerts it rejects are never kept. With stream and no limit the alerts are returned as a
+	# generator, in the order the controller sends them.
+	def _filter_alerts(self, query, limit, predicate, stream):
 	
-		data = json.dumps({'agent._id' : [agent_id]})
-	
-		request = self.build_request(self.build_api_route('alerts/filter'), method = 'POST', data = data)
-		(ret, response_code, response_data, response_headers) = self.handle_response(request, multiline_json = True, multiline_json_limit = limit, stream = True)
-		
-		if ret:
-			from operator import itemgetter
-			sorted_alert_list = sorted(response_data, key=itemgetter('reported_at'), reverse=True);
-			return(True, response_code, sorted_alert_list)
+		request = self.build_request(self.build_api_route('alerts/filter'), method = 'POST', data = json.dumps(query))
+		(ret, response_code, response_data, response_headers) = self.handle_response(request, multiline_json = True, stream = True, multiline_json_stream = True)
 		
-		else:
+		if not ret or not isinstance(response_data, types.GeneratorType):
 			return(ret, response_code, response_data)
 		
+		alerts = filter(predicate, response_data) if predicate else response_data
+		if stream and not limit:
+			return(True, response_code, alerts)
+		
+		try:
+			if limit:
+				alert_list = heapq.nlargest(int(limit), alerts, key = itemgetter('reported_at'))
+			else:
+				alert_list = sorted(alerts, key = itemgetter('reported_at'), reverse = True)
+		finally:
+			response_data.close()
+		return(True, response_code, alert_list)
+	
+	# NOTE: this function does not return data in the usual way, the response is a list of alerts
+	def restGetAlertsHost(self, agent_id, limit = DEFAULT_LIMIT, predicate = None, stream = False):
+	
+		return self._filter_alerts({'agent._id' : [agent_id]}, limit, predicate, stream)
+		
 	# NOTE: this function does not return data in the usual way, the response is a list of alerts
-	def restGetAlertsTime(self, start_date, end_date, limit = DEFAULT_LIMIT, filters=False):
+	def restGetAlertsTime(self, start_date, end_date, limit = DEFAULT_LIMIT, filters=False, predicate = None, stream = False):
 
 		myquery = {'event_at' : 
 							{'min' : '{0}T00:00:00.000Z'.format(start_date), 
@@ -1052,19 +2086,7 @@ class HXAPI:
 			for filterkey, filterval in filters.items():
 				myquery[filterkey] = filterval
 
-		data = json.dumps(myquery)
-							
-		request = self.build_request(self.build_api_route('alerts/filter'), method = 'POST', data = data)
-		
-		(ret, response_code, response_data, response_headers) = self.handle_response(request, multiline_json = True, multiline_json_limit = limit, stream = True)
-		
-		if ret:
-			from operator import itemgetter
-			sorted_alert_list = sorted(response_data, key=itemgetter('reported_at'), reverse=True);
-			return(True, response_code, sorted_alert_list)
-		
-		else:
-			return(ret, response_code, response_data)
+		return self._filter_alerts(myquery, limit, predicate, stream)
 			
 
 
@@ -1072,7 +2094,7 @@ class HXAPI:
 	# Hosts
 	########
 		
-	def restListHosts(self, limit=DEFAULT_LIMIT, offset=0, search_term=None, sort_term=None, filter_term={}, query_terms = {}):
+	def restListHosts(self, limit=DEFAULT_LIMIT, offset=0, search_term=None, sort_term=None, filter_term={}, query_terms = {}, stream_entries = False):
 		
 		endpoint_url = "hosts"
 		params = {
@@ -1087,7 +2109,7 @@ class HXAPI:
 		params.update(query_terms)
 
 		request = self.build_request(self.build_api_route(endpoint_url), params = params)
-		(ret, response_code, response_data, response_headers) = self.handle_response(request)
+		(ret, response_code, response_data, response_headers) = self.handle_response(request, stream_entries = stream_entries)
 		
 		return(ret, response_code, response_data)
 		
@@ -1439,3 +2461,73 @@ class HXAPI:
 	def hx_strftime(d):
 		return d.strftime("%Y-%m-%dT%H:%M:%SZ")
 		
+
+# asyncio front end to an HXAPI object for issuing many independent calls at once.
+#
+# Every restXxx method of HXAPI is available as a coroutine taking the same arguments and returning the same
+# (ret, response_code, response_data) tuple. Calls run on a thread pool against the wrapped object, so the
+# token, its renewal and the connection pool are shared with synchronous users of the same HXAPI object.
+class HXAPIAsync:
+	DEFAULT_CONCURRENCY = 8
+	
+	# concurrency defaults to the size of the connection pool of hx_api_object when it has one
+	def __init__(self, hx_api_object, concurrency = None):
+		self.hx_api_object = hx_api_object
+		if not concurrency:
+			pool_stats = hx_api_object.pool_stats()
+			concurrency = pool_stats['size'] if pool_stats else self.DEFAULT_CONCURRENCY
+		self.concurrency = concurrency
+		self._executor = None
+		self._executor_lock = threading.Lock()
+	
+	def __getattr__(self, name):
+		f = getattr(self.hx_api_object, name)
+		if not (name.startswith('rest') and callable(f)):
+			return f
+		
+		@functools.wraps(f)
+		async def call(*args, **kwargs):
+			return await asyncio.get_running_loop().run_in_executor(self._get_executor(), HXAPITracer.bind(functools.partial(f, *args, **kwargs)))
+		return call
+	
+	def _get_executor(self):
+		with self._executor_lock:
+			if self._executor is None:
+				self._executor = ThreadPoolExecutor(max_workers = self.concurrency, thread_name_prefix = 'HXAPIAsync')
+			return self._executor
+	
+	def close(self):
+		with self._executor_lock:
+			if self._executor is not None:
+				self._executor.shutdown(wait = True)
+				self._executor = None
+	
+	async def __aenter__(self):
+		return self
+	
+	async def __aexit__(self, *args):
+		self.close()
+	
+	# asyncio.gather() with at most limit of the awaitables running at any one time. Results are returned in order.
+	@staticmethod
+	async def gather(*aws, limit = DEFAULT_CONCURRENCY, return_exceptions = False):
+		semaphore = asyncio.Semaphore(limit)
+		async def bounded(aw):
+			async with semaphore:
+				return await aw
+		return await asyncio.gather(*[bounded(_) for _ in aws], return_exceptions = return_exceptions)
+	
+	# For synchronous callers: calls the method once for each item in args_list, a tuple of positional or a dict
+	# of keyword arguments, with kwargs added to every call. Returns the results in the same order as args_list.
+	def map(self, method, args_list, **kwargs):
+		f = getattr(self, method)
+		def call(args):
+			if isinstance(args, dict):
+				return f(**dict(kwargs, **args))
+			return f(*args, **kwargs)
+		async def run():
+			return await self.gather(*[call(_) for _ in args_list], limit = self.concurrency)
+		try:
+			return asyncio.run(run())
+		finally:
+			self.close()
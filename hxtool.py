@@ -52,6 +52,9 @@ from hxtool_config import *
 from hxtool_data_models import *
 from hxtool_session import *
 from hxtool_scheduler import *
+from hxtool_task_journal import hxtool_task_journal
+from hxtool_task_lease import hxtool_task_lease
+from hxtool_object_cache import hxtool_object_cache
 from hxtool_apicache import *
 from hxtool_api import indicator_dict_from_indicator
 
@@ -505,7 +508,8 @@ def login():
 					session['ht_user'] = request.form['ht_user']
 					session['ht_profileid'] = ht_profile['profile_id']
 					session['ht_hx_name'] = ht_profile['hx_name']
-					session['ht_api_object'] = hx_api_object.serialize()
+					session['ht_api_session'] = hxtool_global.hxtool_api_sessions.add(hx_api_object)
+					session['ht_api_state'] = hx_api_object.session_state()
 					session['hx_version'] = hx_api_object.hx_version
 					session['hx_int_version'] = int(''.join(str(i) for i in hx_api_object.hx_version))
 					session['hx_ip'] = hx_api_object.hx_host
@@ -530,8 +534,12 @@ def login():
 @app.route('/logout', methods=['GET'])
 def logout():
 	if session:
-		if 'ht_api_object' in session:
+		hx_api_object = None
+		if 'ht_api_session' in session:
+			hx_api_object = hxtool_global.hxtool_api_sessions.pop(session['ht_api_session'], session.get('ht_api_state'))
+		elif 'ht_api_object' in session:
 			hx_api_object = HXAPI.deserialize(session['ht_api_object'])
+		if hx_api_object:
 			hx_api_object.restLogout()
 			logger.info(format_activity_log(msg="user logged out", user=session['ht_user'], controller=session['hx_ip']))
 			hx_api_object = None	
@@ -547,6 +555,14 @@ def sigint_handler(signum, frame):
 	if hxtool_global.hxtool_scheduler:
 		hxtool_global.hxtool_scheduler.stop()
 		hxtool_global.hxtool_scheduler.logout_task_api_sessions()
+	if getattr(hxtool_global, 'hxtool_task_journal', None):
+		hxtool_global.hxtool_task_journal.stop()
+	for apicache in hxtool_global.apicache.values():
+		apicache.stop()
+	if getattr(hxtool_global, 'hxtool_object_cache', None):
+		hxtool_global.hxtool_object_cache.stop()
+	if hxtool_global.hxtool_scheduler and hxtool_global.hxtool_scheduler.task_leases:
+		hxtool_global.hxtool_scheduler.task_leases.stop()
 	if hxtool_global.hxtool_db:
 		hxtool_global.hxtool_db.close()
 	exit(0)	
@@ -592,14 +608,49 @@ def app_init(debug = False):
 
 	hxtool_global.hxtool_db = init_db()
 	
+	HXAPI.configure_resilience(hxtool_global.hxtool_config.get_child_item('network', 'api_resilience', None))
+	if hxtool_global.hxtool_config.get_child_item('network', 'api_tracing', True):
+		HXAPI.set_tracer(HXAPITracer())
+	
 	# TODO: Disabled for now
 	# Enable X15 integration if config options are present
 	#if hxtool_global.hxtool_config['x15']:
 	#	from hxtool_x15_db import hxtool_x15
 	#	hxtool_global.hxtool_x15_object = hxtool_x15()
 	
+	# When several instances share the saved tasks (i.e. gunicorn workers) they claim each run of a task through a lease
+	task_leases = None
+	if hxtool_global.hxtool_config.get_child_item('scheduler', 'distributed', False):
+		task_leases = hxtool_task_lease(hxtool_global.hxtool_db, ttl = hxtool_global.hxtool_config.get_child_item('scheduler', 'lease_ttl', 60))
+		task_leases.start()
+	
+	# Task state is written behind through a journal, apply anything a previous run didn't get to the database.
+	# Not when distributed, the other instances need to see the task state as soon as it changes.
+	journal_flush_interval = hxtool_global.hxtool_config.get_child_item('scheduler', 'journal_flush_interval', 5)
+	if journal_flush_interval and not task_leases:
+		hxtool_global.hxtool_task_journal = hxtool_task_journal(hxtool_global.hxtool_db, 
+																combine_app_path(hxtool_vars.data_path), 
+																flush_interval = journal_flush_interval, 
+																flush_size = hxtool_global.hxtool_config.get_child_item('scheduler', 'journal_flush_size', 500))
+		hxtool_global.hxtool_task_journal.replay()
+		hxtool_global.hxtool_task_journal.start()
+	
+	# API cache objects are served from memory and written behind to the database
+	if hxtool_global.hxtool_config.get_child_item('apicache', 'enabled', False):
+		object_cache_config = hxtool_global.hxtool_config.get_child_item('apicache', 'object_cache', None) or {}
+		hxtool_global.hxtool_object_cache = hxtool_object_cache(hxtool_global.hxtool_db, 
+																max_size = object_cache_config.get('max_size', 256) * 1024 * 1024, 
+																ttls = object_cache_config.get('ttl', None), 
+																flush_interval = object_cache_config.get('flush_interval', 5), 
+																flush_size = object_cache_config.get('flush_size', 1000))
+		hxtool_global.hxtool_object_cache.start()
+	
 	# Initialize the scheduler
-	hxtool_global.hxtool_scheduler = hxtool_scheduler(hxtool_global.hxtool_config['scheduler']['thread_count'])
+	hxtool_global.hxtool_scheduler = hxtool_scheduler(hxtool_global.hxtool_config['scheduler']['thread_count'], 
+														process_count = hxtool_global.hxtool_config.get_child_item('scheduler', 'process_count', None),
+														profile_thread_count = hxtool_global.hxtool_config.get_child_item('scheduler', 'profile_thread_count', None),
+														task_class_weights = hxtool_global.hxtool_config.get_child_item('scheduler', 'task_class_weights', None),
+														task_leases = task_leases)
 	hxtool_global.hxtool_scheduler.start()
 	
 	# Initialize background API sessions
@@ -616,15 +667,28 @@ def app_init(debug = False):
 	app.config['SESSION_COOKIE_NAME'] = "hxtool_session"
 	app.permanent_session_lifetime = datetime.timedelta(days=7)
 	app.session_interface = hxtool_session_interface(app, expiration_delta=hxtool_global.hxtool_config['network']['session_timeout'])
-
-	# Disable API cache for now
-	# TODO: Restricted to MongoDB only?
-	#if hxtool_global.hxtool_config.get_child_item('apicache', 'enabled', False):
-	#	for profile in hxtool_global.hxtool_db.profileList():
-	#		if profile['profile_id'] in hxtool_global.hxtool_scheduler.task_hx_api_sessions:
-	#			hxtool_global.apicache[profile['profile_id']] = hxtool_api_cache(hxtool_global.hxtool_scheduler.task_hx_api_sessions[profile['profile_id']], profile['profile_id'], hxtool_global.hxtool_config['apicache']['intervals'], hxtool_global.hxtool_config['apicache']['types'])
-	#		else:
-	#			logger.info("No background credential for {}, not starting apicache".format(profile['profile_id']))
+	hxtool_global.hxtool_api_sessions = hxtool_api_session_registry(api_kwargs = {
+																		'proxies' : hxtool_global.hxtool_config['network'].get('proxies'), 
+																		'headers' : hxtool_global.hxtool_config['headers'], 
+																		'cookies' : hxtool_global.hxtool_config['cookies'], 
+																		'logger_name' : hxtool_logging.getLoggerName(HXAPI.__name__), 
+																		'default_encoding' : default_encoding
+																	}, 
+																	max_size = hxtool_global.hxtool_config.get_child_item('network', 'api_session_cache_size', 256),
+																	idle_timeout = hxtool_global.hxtool_config['network']['session_timeout'])
+
+	# The API cache serves the dashboards, it needs the background API session of a profile
+	if hxtool_global.hxtool_config.get_child_item('apicache', 'enabled', False):
+		for profile in hxtool_global.hxtool_db.profileList():
+			if profile['profile_id'] in hxtool_global.hxtool_scheduler.task_hx_api_sessions:
+				hxtool_global.apicache[profile['profile_id']] = hxtool_api_cache(hxtool_global.hxtool_scheduler.task_hx_api_sessions[profile['profile_id']], 
+																					profile['profile_id'], 
+																					hxtool_global.hxtool_config['apicache']['intervals'], 
+																					hxtool_global.hxtool_config['apicache']['types'], 
+																					sysinfo_concurrency = hxtool_global.hxtool_config.get_child_item('apicache', 'sysinfo_concurrency', 4), 
+																					max_staleness = hxtool_global.hxtool_config.get_child_item('apicache', 'max_staleness', hxtool_api_cache.DEFAULT_MAX_STALENESS))
+			else:
+				logger.info("No background credential for {}, not starting apicache".format(profile['profile_id']))
 
 # Version specific upgrade code goes here
 def hxtool_upgrade():
@@ -24,6 +24,7 @@ from hxtool_scheduler import *
 from hxtool_scheduler_task import *
 from hxtool_task_modules import *
 from hx_openioc import openioc_to_hxioc
+from hxtool_apicache import apicache_hosts, apicache_host_sysinfo, apicache_host_viewed
 
 ht_api = Blueprint('ht_api', __name__, template_folder='templates')
 logger = hxtool_logging.getLogger(__name__)
@@ -449,6 +450,8 @@ def hxtool_api_hosts_config(hx_api_object):
 @valid_session_required
 def hxtool_api_hosts_get(hx_api_object):
 	(ret, response_code, response_data) = hx_api_object.restGetHostSummary(request.args.get('id'))
+	if ret and hxtool_global.hxtool_config.get_child_item('apicache', 'enabled', False):
+		apicache_host_viewed(session['ht_profileid'], request.args.get('id'))
 	(r, rcode) = create_api_response(response_data = response_data)
 	return(app.response_class(response=json.dumps(r), status=rcode, mimetype='application/json'))
 
@@ -609,21 +612,52 @@ def hxtool_api_scheduler_remove(hx_api_object):
 def scheduler_health(hx_api_object):
 	return(app.response_class(response=json.dumps(hxtool_global.hxtool_scheduler.status()), status=200, mimetype='application/json'))
 
+@ht_api.route('/api/v{0}/scheduler_queues'.format(HXTOOL_API_VERSION), methods=['GET'])
+@valid_session_required
+def scheduler_queues(hx_api_object):
+	return(app.response_class(response=json.dumps(hxtool_global.hxtool_scheduler.queue_stats()), status=200, mimetype='application/json'))
+
+# Per endpoint statistics of the requests made to the controllers, DELETE resets them
+@ht_api.route('/api/v{0}/hxapi/stats'.format(HXTOOL_API_VERSION), methods=['GET', 'DELETE'])
+@valid_session_required
+def hxapi_stats(hx_api_object):
+	if HXAPI.tracer is None:
+		return(app.response_class(response=json.dumps({'enabled' : False}), status=200, mimetype='application/json'))
+	if request.method == 'DELETE':
+		HXAPI.tracer.reset()
+		app.logger.info(format_activity_log(msg="hx api stats", action="reset", user=session['ht_user'], controller=session['hx_ip']))
+		return(app.response_class(response=json.dumps("OK"), status=200, mimetype='application/json'))
+	mystats = {
+		'enabled' : True,
+		'since' : HXAPI.tracer.since,
+		'routes' : HXAPI.tracer.stats(),
+		'circuit_breakers' : HXAPI.circuit_breaker_stats()
+	}
+	return(app.response_class(response=json.dumps(mystats), status=200, mimetype='application/json'))
+
+@ht_api.route('/api/v{0}/hxapi/circuit_breakers'.format(HXTOOL_API_VERSION), methods=['GET'])
+@valid_session_required
+def hxapi_circuit_breakers(hx_api_object):
+	return(app.response_class(response=json.dumps(HXAPI.circuit_breaker_stats()), status=200, mimetype='application/json'))
+
 @ht_api.route('/api/v{0}/scheduler_tasks'.format(HXTOOL_API_VERSION), methods=['GET'])
 @valid_session_required
 def scheduler_tasks(hx_api_object):
 	mytasks = {}
 	mytasks['data'] = []
-	for task in hxtool_global.hxtool_scheduler.tasks():
+	tasks = hxtool_global.hxtool_scheduler.tasks()
+	
+	# Count the child states per parent in a single pass
+	child_states = {}
+	for subtask in tasks:
+		if subtask['parent_id']:
+			taskstates = child_states.setdefault(subtask['parent_id'], {})
+			state_description = task_states.description.get(subtask['state'], "Unknown")
+			taskstates[state_description] = taskstates.get(state_description, 0) + 1
+	
+	for task in tasks:
 		if not task['parent_id']:
-
-			taskstates = {}
-			for subtask in hxtool_global.hxtool_scheduler.tasks():
-				if subtask['parent_id'] == task['task_id']:
-					if not task_states.description.get(subtask['state'], "Unknown") in taskstates.keys():
-						taskstates[task_states.description.get(subtask['state'], "Unknown")] = 1
-					else:
-						taskstates[task_states.description.get(subtask['state'], "Unknown")] += 1
+			taskstates = child_states.get(task['task_id'], {})
 
 			mytasks['data'].append({
 				"DT_RowId": task['task_id'],
@@ -1622,6 +1656,7 @@ def hxtool_api_stacking_remove(hx_api_object):
 		if bulk_download_job and 'bulk_acquisition_id' in bulk_download_job:
 			(ret, response_code, response_data) = hx_api_object.restDeleteJob('acqs/bulk', bulk_download_job['bulk_acquisition_id'])
 			hxtool_global.hxtool_db.bulkDownloadDelete(bulk_download_job.doc_id)
+			bulk_host_status_poller.drop(stack_job['profile_id'], bulk_download_job['bulk_acquisition_id'])
 			(r, rcode) = create_api_response(ret, response_code, response_data)
 		else:
 			(r, rcode) = create_api_response()
@@ -1746,6 +1781,7 @@ def hxtool_api_acquisition_multi_file_listing_remove(hx_api_object):
 		bulk_download_job = hxtool_global.hxtool_db.bulkDownloadGet(file_listing_job['bulk_download_eid'])
 		if bulk_download_job.get('bulk_acquisition_id', None):
 			(ret, response_code, response_data) = hx_api_object.restDeleteJob('acqs/bulk', bulk_download_job['bulk_acquisition_id'])
+			bulk_host_status_poller.drop(session['ht_profileid'], bulk_download_job['bulk_acquisition_id'])
 		hxtool_global.hxtool_db.bulkDownloadDelete(file_listing_job['bulk_download_eid'])
 		hxtool_global.hxtool_db.fileListingDelete(file_listing_job.doc_id)
 		app.logger.info(format_activity_log(msg="multi-file listing acquisition", action="remove", id=request.args.get('id'), user=session['ht_user'], controller=session['hx_ip']))
@@ -1816,18 +1852,25 @@ def hxtool_api_acquisition_multi_mf_new(hx_api_object):
 					continue
 				choice_files = [file_listing['files'][i] for i in file_ids if i <= len(file_listing['files'])]
 				multi_file_eid = hxtool_global.hxtool_db.multiFileCreate(session['ht_user'], session['ht_profileid'], display_name=display_name, file_listing_id=file_listing.doc_id, api_mode=use_api_mode)
-				# Create a data acquisition for each file from its host
-				for cf in choice_files:
-					if cf['hostname'] in agent_ids:
-						agent_id = agent_ids[cf['hostname']]
+				# Look up the hosts, then request the acquisitions, concurrently
+				hx_api_async = HXAPIAsync(hx_api_object)
+				hostnames = list({ cf['hostname'] for cf in choice_files } - set(agent_ids.keys()))
+				for hostname, (ret, response_code, response_data) in zip(hostnames, hx_api_async.map('restListHosts', [{'search_term' : _} for _ in hostnames])):
+					if ret and len(response_data['data']['entries']) > 0:
+						agent_ids[hostname] = response_data['data']['entries'][0]['_id']
 					else:
-						(ret, response_code, response_data) = hx_api_object.restListHosts(search_term = cf['hostname'])
-						agent_id = agent_ids[cf['hostname']] = response_data['data']['entries'][0]['_id']
+						app.logger.warn('Unable to find host %s for file acquisition - User: %s@%s:%s', hostname, session['ht_user'], hx_api_object.hx_host, hx_api_object.hx_port)
+				choice_files = [cf for cf in choice_files if cf['hostname'] in agent_ids][:MAX_FILE_ACQUISITIONS - len(file_jobs)]
+				acquisitions = []
+				for cf in choice_files:
 					path_split_char = '\\'
 					if cf['FullPath'].startswith('/'):
 						path_split_char = '/'
 					path, filename = cf['FullPath'].rsplit(path_split_char, 1)
-					(ret, response_code, response_data) = hx_api_object.restAcquireFile(agent_id, path, filename, use_api_mode)
+					acquisitions.append((agent_ids[cf['hostname']], path, filename, use_api_mode))
+				# Create a data acquisition for each file from its host
+				for cf, acquisition, (ret, response_code, response_data) in zip(choice_files, acquisitions, hx_api_async.map('restAcquireFile', acquisitions)):
+					agent_id = acquisition[0]
 					if ret:
 						acq_id = response_data['data']['_id']
 						job_record = {
@@ -1987,9 +2030,11 @@ def datatable_agentstatus_csv(hx_api_object):
 	myField = request.args.get('field')
 	myPattern = request.args.get('pattern')
 
-	(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts(limit=200000, filter_term={ myField: myPattern })
+	hosts = apicache_hosts(session['ht_profileid'], filter_term={ myField: myPattern })
+	if hosts is None:
+		hosts = hx_api_object.iterHosts(filter_term={ myField: myPattern })
 
-	for host in hresponse_data['data']['entries']:
+	for host in hosts:
 		if '.' in myField:
 			item1, item2 = myField.split(".")
 			mydata['data'].append({
@@ -2027,9 +2072,12 @@ def datatable_agentstatus(hx_api_object):
 	myField = request.args.get('field')
 	myPattern = request.args.get('pattern')
 
-	(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts(limit=5000, filter_term={ myField: myPattern })
+	hosts = apicache_hosts(session['ht_profileid'], filter_term={ myField: myPattern }, limit=5000)
+	if hosts is None:
+		(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts(limit=5000, filter_term={ myField: myPattern })
+		hosts = hresponse_data['data']['entries']
 
-	for host in hresponse_data['data']['entries']:
+	for host in hosts:
 		if '.' in myField:
 			item1, item2 = myField.split(".")
 			mydata['data'].append({
@@ -2056,8 +2104,12 @@ def datatable_avcontent_detail(hx_api_object):
 
 	myversion = request.args.get('version')
 
-	(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts()
-	for host in hresponse_data['data']['entries']:
+	# Read the whole host list, and close its connection, before asking for the sysinfo of each host
+	(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts(stream_entries=True)
+	hosts = [{'_id' : _['_id'], 'hostname' : _['hostname']} for _ in hresponse_data['data']['entries']]
+	del hresponse_data
+	
+	for host in hosts:
 		(ret, response_code, response_data) = hx_api_object.restGetHostSysinfo(host['_id'])
 		if 'malware' in response_data['data']:
 			if 'av' in response_data['data']['malware']:
@@ -2075,8 +2127,6 @@ def datatable_avcontent_detail(hx_api_object):
 					"content_version": myversion
 					})
 
-	del hresponse_data
-
 	return(app.response_class(response=json.dumps(mydata), status=200, mimetype='application/json'))
 
 
@@ -2088,8 +2138,12 @@ def datatable_avengine_detail(hx_api_object):
 
 	myversion = request.args.get('version')
 
-	(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts()
-	for host in hresponse_data['data']['entries']:
+	# Read the whole host list, and close its connection, before asking for the sysinfo of each host
+	(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts(stream_entries=True)
+	hosts = [{'_id' : _['_id'], 'hostname' : _['hostname']} for _ in hresponse_data['data']['entries']]
+	del hresponse_data
+	
+	for host in hosts:
 		(ret, response_code, response_data) = hx_api_object.restGetHostSysinfo(host['_id'])
 		if 'malware' in response_data['data']:
 			if 'av' in response_data['data']['malware']:
@@ -2107,8 +2161,6 @@ def datatable_avengine_detail(hx_api_object):
 					"engine_version": myversion
 					})
 
-	del hresponse_data
-
 	return(app.response_class(response=json.dumps(mydata), status=200, mimetype='application/json'))
 
 @ht_api.route('/api/v{0}/datatable/avstatus'.format(HXTOOL_API_VERSION), methods=['GET'])
@@ -2119,8 +2171,12 @@ def datatable_avstatus_detail(hx_api_object):
 
 	mystate = request.args.get('state')
 
-	(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts()
-	for host in hresponse_data['data']['entries']:
+	# Read the whole host list, and close its connection, before asking for the sysinfo of each host
+	(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts(stream_entries=True)
+	hosts = [{'_id' : _['_id'], 'hostname' : _['hostname']} for _ in hresponse_data['data']['entries']]
+	del hresponse_data
+	
+	for host in hosts:
 		(ret, response_code, response_data) = hx_api_object.restGetHostSysinfo(host['_id'])
 		if 'MalwareProtectionStatus' in response_data['data']:
 			if mystate == response_data['data']['MalwareProtectionStatus']:
@@ -2137,8 +2193,6 @@ def datatable_avstatus_detail(hx_api_object):
 					"state": mystate
 					})
 
-	del hresponse_data
-
 	return(app.response_class(response=json.dumps(mydata), status=200, mimetype='application/json'))
 
 @ht_api.route('/api/v{0}/datatable_categories'.format(HXTOOL_API_VERSION), methods=['GET'])
@@ -2198,19 +2252,22 @@ def datatable_hosts(hx_api_object):
 	mydata = {}
 	mydata['data'] = []
 
-	(ret, response_code, response_data) = hx_api_object.restListHosts(search_term = request.args.get('q'))
-	if ret:
-		for host in response_data['data']['entries']:
-			mydata['data'].append({
-				"DT_RowId": host['_id'],
-				"hostname": host['hostname'],
-				"domain": host['domain'],
-				"agent_version": host['agent_version'],
-				"last_poll_timestamp": host['last_poll_timestamp'],
-				"last_poll_ip": host['last_poll_ip'],
-				"product_name": host['os']['product_name'],
-				"patch_level": host['os']['patch_level']
-				})
+	hosts = apicache_hosts(session['ht_profileid'], search_term = request.args.get('q'))
+	if hosts is None:
+		(ret, response_code, response_data) = hx_api_object.restListHosts(search_term = request.args.get('q'))
+		hosts = response_data['data']['entries'] if ret else []
+
+	for host in hosts:
+		mydata['data'].append({
+			"DT_RowId": host['_id'],
+			"hostname": host['hostname'],
+			"domain": host['domain'],
+			"agent_version": host['agent_version'],
+			"last_poll_timestamp": host['last_poll_timestamp'],
+			"last_poll_ip": host['last_poll_ip'],
+			"product_name": host['os']['product_name'],
+			"patch_level": host['os']['patch_level']
+			})
 
 	return(app.response_class(response=json.dumps(mydata), status=200, mimetype='application/json'))
 
@@ -2287,7 +2344,7 @@ def datatable_alerts(hx_api_object):
 				# Query host object
 				hresponse_data = False
 				if hxtool_global.hxtool_config.get_child_item('apicache', 'enabled', False):
-					hresponse_data = hxtool_global.hxtool_db.cacheGet(session['ht_profileid'], "host", alert['agent']['_id'])
+					hresponse_data = hxtool_global.hxtool_object_cache.get(session['ht_profileid'], "host", alert['agent']['_id'])
 				if hresponse_data == False:
 					(hret, hresponse_code, hresponse_data) = hx_api_object.restGetHostSummary(alert['agent']['_id'])
 
@@ -2321,6 +2378,45 @@ def datatable_alerts(hx_api_object):
 		return(app.response_class(response=json.dumps(myalerts), status=200, mimetype='application/json'))
 
 
+# Whether the file or process of an alert has the MD5 hash md5hash
+def alert_has_md5(alert, md5hash):
+	if alert['source'] == "IOC":
+		return any([alert['event_values'].get(_) == md5hash for _ in ["fileWriteEvent/md5", "processEvent/md5"]])
+	
+	elif alert['source'] == "EXD":
+		for detail in alert['event_values']['analysis_details']:
+			for itemkey, itemvalue in detail[detail['detail_type']].items():
+				if (itemkey == "md5sum" and itemvalue == md5hash):
+					return True
+				elif itemkey == "processinfo" and itemvalue.get('md5sum') == md5hash:
+					return True
+	
+	elif alert['source'] == "MAL":
+		for detection in alert['event_values']['detections']['detection']:
+			for myobjkey, myobjval in detection['infected-object'].items():
+				if myobjkey == "file-object" and myobjval.get('md5sum') == md5hash:
+					return True
+	
+	return False
+
+# indicator_name(condition_id) returns the name of the indicator an IOC alert's condition belongs to
+def alert_has_name(alert, alertname, indicator_name):
+	if alert['source'] == "MAL":
+		for mymalinfo in alert['event_values']['detections']['detection']:
+			try:
+				if alertname in mymalinfo['infection']['infection-name']:
+					return True
+			except(KeyError):
+				continue
+	
+	elif alert['source'] == "EXD":
+		return alertname in alert['event_values']['process_name']
+	
+	elif alert['source'] == "IOC":
+		return alertname in indicator_name(alert['condition']['_id'])
+	
+	return False
+
 @ht_api.route('/api/v{0}/datatable_alerts_full'.format(HXTOOL_API_VERSION), methods=['GET'])
 @valid_session_required
 def datatable_alerts_full(hx_api_object):
@@ -2352,94 +2448,34 @@ def datatable_alerts_full(hx_api_object):
 					myhostlist.append(hostname['_id'])
 				myfilters['agent._id'] = myhostlist
 
-		if len(myfilters) > 0:
-			(ret, response_code, response_data) = hx_api_object.restGetAlertsTime(request.args.get('startDate'), request.args.get('endDate'), filters=myfilters, limit=mylimit)
-		else:
-			(ret, response_code, response_data) = hx_api_object.restGetAlertsTime(request.args.get('startDate'), request.args.get('endDate'), limit=mylimit)
-		if ret:
-
-			# Check if we need to match alertname
-			if 'alertname' in request.args:
-
-				myalertname = request.args.get("alertname")
-				myMatches = []
-
-				for alert in response_data:
-					if alert['source'] == "MAL":
-						for mymalinfo in alert['event_values']['detections']['detection']:
-							try:
-								if myalertname in mymalinfo['infection']['infection-name']:
-									myMatches.append(alert)
-							except(KeyError):
-								continue
-					if alert['source'] == "EXD":
-						if myalertname in alert['event_values']['process_name']:
-							myMatches.append(alert)
-					if alert['source'] == "IOC":
-						if alert['condition']['_id'] not in myiocs:
-							# Query IOC object since we do not have it in memory
-							(cret, cresponse_code, cresponse_data) = hx_api_object.restGetIndicatorFromCondition(alert['condition']['_id'])
-							if cret:
-								myiocs[alert['condition']['_id']] = cresponse_data['data']['entries'][0]
-								tname = cresponse_data['data']['entries'][0]['name']
-							else:
-								tname = "N/A"
-						else:
-							tname = myiocs[alert['condition']['_id']]['name']
-							if myalertname in tname:
-								myMatches.append(alert)
-
-				# overwrite data with our filtered list
-				response_data = myMatches
-
-
-			# Check if we need to match md5hash
-			if 'md5hash' in request.args:
-
-				myhash = request.args.get("md5hash")
-				myMatches = []
-				myIOCfields = ["fileWriteEvent/md5", "processEvent/md5"]
+		# Alerts that don't match the hash or the alert name are dropped as they are read, before the limit is applied
+		mypredicates = []
+		if 'md5hash' in request.args:
+			myhash = request.args.get("md5hash")
+			mypredicates.append(lambda alert: alert_has_md5(alert, myhash))
 
-				for alert in response_data:
-					if alert['source'] == "IOC":
-						try:
-							for mykey in myIOCfields:
-								if alert['event_values'][mykey] == myhash:
-									myMatches.append(alert)
-						except(KeyError):
-							continue
-
-					elif alert['source'] == "EXD":
-						EXDMatch = False
-						for detail in alert['event_values']['analysis_details']:
-							for itemkey, itemvalue in detail[detail['detail_type']].items():
-								if (itemkey == "md5sum" and itemvalue == myhash):
-									EXDMatch = True
-								else:
-									if itemkey == "processinfo":
-										try:
-											if detail[detail['detail_type']]['processinfo']['md5sum'] == myhash:
-												EXDMatch = True
-										except(KeyError):
-											continue
-						if EXDMatch:
-							myMatches.append(alert)
-
-					elif alert['source'] == "MAL":
-						for detection in alert['event_values']['detections']['detection']:
-							for myobjkey, myobjval in detection['infected-object'].items():
-								if myobjkey == "file-object":
-									try:
-										if myobjval['md5sum'] == myhash:
-											myMatches.append(alert)
-									except(KeyError):
-										continue
+		if 'alertname' in request.args:
+			myalertname = request.args.get("alertname")
+			
+			def indicator_name(condition_id):
+				if condition_id not in myiocs:
+					# Query IOC object since we do not have it in memory
+					(cret, cresponse_code, cresponse_data) = hx_api_object.restGetIndicatorFromCondition(condition_id)
+					if cret and len(cresponse_data['data']['entries']) > 0:
+						myiocs[condition_id] = cresponse_data['data']['entries'][0]
 					else:
-						continue
-
-				response_data = myMatches
+						myiocs[condition_id] = {'name' : "N/A"}
+				return myiocs[condition_id]['name']
+			
+			mypredicates.append(lambda alert: alert_has_name(alert, myalertname, indicator_name))
 
+		mypredicate = (lambda alert: all(_(alert) for _ in mypredicates)) if mypredicates else None
 
+		if len(myfilters) > 0:
+			(ret, response_code, response_data) = hx_api_object.restGetAlertsTime(request.args.get('startDate'), request.args.get('endDate'), filters=myfilters, limit=mylimit, predicate=mypredicate)
+		else:
+			(ret, response_code, response_data) = hx_api_object.restGetAlertsTime(request.args.get('startDate'), request.args.get('endDate'), limit=mylimit, predicate=mypredicate)
+		if ret:
 			# Get annotations from DB and store in memory
 			myannotations = {}
 			dbannotations = hxtool_global.hxtool_db.alertList(session['ht_profileid'])
@@ -2451,6 +2487,20 @@ def datatable_alerts_full(hx_api_object):
 					if item['state'] > myannotations[annotation['hx_alert_id']]['max_state']:
 						myannotations[annotation['hx_alert_id']]['max_state'] = item['state']
 
+			# Fetch the hosts and indicators the alerts refer to concurrently instead of one alert at a time
+			hx_api_async = HXAPIAsync(hx_api_object)
+			agent_ids = list({ alert['agent']['_id'] for alert in response_data } - set(myhosts.keys()))
+			for agent_id, (hret, hresponse_code, hresponse_data) in zip(agent_ids, hx_api_async.map('restGetHostSummary', [(_,) for _ in agent_ids])):
+				if hret:
+					myhosts[agent_id] = hresponse_data['data']
+			
+			# Handle missing indicator object when multiple IOCs hit. ENDPT-52003
+			condition_ids = list({ alert['condition']['_id'] for alert in response_data if alert['source'] == "IOC" and alert.get("indicator", None) is None })
+			condition_names = {}
+			for condition_id, (cret, cresponse_code, cresponse_data) in zip(condition_ids, hx_api_async.map('restGetIndicatorFromCondition', [(_,) for _ in condition_ids])):
+				if cret and len(cresponse_data['data']['entries']) > 0:
+					condition_names[condition_id] = "; ".join([ _['name'] for _ in cresponse_data['data']['entries'] ])
+
 			for alert in response_data:
 
 				if alert['_id'] in myannotations.keys():
@@ -2484,14 +2534,8 @@ def datatable_alerts_full(hx_api_object):
 					tname = js_path(alert, hxtool_global.hx_alert_types.get(alert['source'])['threat_key'])
 					if alert['source'] == "EXD":
 						tname = "Exploit detected in process {}".format(tname)
-					# Handle missing indicator object when multiple IOCs hit. ENDPT-52003
 					elif alert['source'] == "IOC" and alert.get("indicator", None) is None:
-						(cret, cresponse_code, cresponse_data) = hx_api_object.restGetIndicatorFromCondition(alert['condition']['_id'])
-						if cret and len(cresponse_data['data']['entries']) > 0:
-							tlist = [ _['name'] for _ in cresponse_data['data']['entries'] ]
-							tname = "; ".join(tlist)
-						else:
-							tname = "N/A"
+						tname = condition_names.get(alert['condition']['_id'], "N/A")
 
 				myalerts['data'].append({
 					"DT_RowId": alert['_id'],
@@ -2550,7 +2594,7 @@ def datatable_acqs(hx_api_object):
 					if acq['type'] != "bulk":
 						hresponse_data = False
 						if hxtool_global.hxtool_config.get_child_item('apicache', 'enabled', False):
-							hresponse_data = hxtool_global.hxtool_db.cacheGet(session['ht_profileid'], "host", acq['host']['_id'])
+							hresponse_data = hxtool_global.hxtool_object_cache.get(session['ht_profileid'], "host", acq['host']['_id'])
 						if hresponse_data == False:
 							(hret, hresponse_code, hresponse_data) = hx_api_object.restGetHostSummary(acq['host']['_id'])
 						if ret:
@@ -2562,7 +2606,7 @@ def datatable_acqs(hx_api_object):
 								acq_url = "/hx/api/v3/acqs/{}/{}".format(acq['type'], HXAPI.compat_str(acq['acq']['_id']))
 							a_response_data = False
 							if hxtool_global.hxtool_config.get_child_item('apicache', 'enabled', False):
-								a_response_data = hxtool_global.hxtool_db.cacheGet(session['ht_profileid'], acq['type'], acq['acq']['_id'])
+								a_response_data = hxtool_global.hxtool_object_cache.get(session['ht_profileid'], acq['type'], acq['acq']['_id'])
 							if a_response_data == False:
 								(a_ret, a_response_code, a_response_data) = hx_api_object.restGetUrl(acq_url)
 							else:
@@ -2790,7 +2834,7 @@ def datatable_bulk(hx_api_object):
 def datatable_es_result_types(hx_api_object):
 	if request.args.get('id'):
 		mytypes = {}
-		(ret, response_code, response_data) = hx_api_object.restGetSearchResults(request.args.get('id'), limit=30000)
+		(ret, response_code, response_data) = hx_api_object.restGetSearchResults(request.args.get('id'), limit=30000, stream_entries=True)
 		if ret:
 			for host in response_data['data']['entries']:
 				for event in host['results']:
@@ -2818,7 +2862,7 @@ def datatable_es_result_types(hx_api_object):
 def datatable_es_result(hx_api_object):
 	if request.args.get('id') and request.args.get('type'):
 		myresult = {"data": []}
-		(ret, response_code, response_data) = hx_api_object.restGetSearchResults(request.args.get('id'), limit=30000)
+		(ret, response_code, response_data) = hx_api_object.restGetSearchResults(request.args.get('id'), limit=30000, stream_entries=True)
 		if ret:
 			for host in response_data['data']['entries']:
 				for event in host['results']:
@@ -2849,12 +2893,16 @@ def datatable_es_result(hx_api_object):
 @valid_session_required
 def chartjs_agentstatus(hx_api_object):
 	rData = {}
-	(ret, response_code, response_data) = hx_api_object.restListHosts()
-	if ret:
+	hosts = apicache_hosts(session['ht_profileid'])
+	if hosts is None:
+		(ret, response_code, response_data) = hx_api_object.restListHosts(stream_entries=True)
+		hosts = response_data['data']['entries'] if ret else None
+		del response_data
+	if hosts is not None:
 		myField = request.args.get('field')
 		myData = {}
 
-		for host in response_data['data']['entries']:
+		for host in hosts:
 			if "." in myField:
 				item1, item2 = myField.split(".")
 				if host[item1][item2] not in myData.keys():
@@ -2865,7 +2913,7 @@ def chartjs_agentstatus(hx_api_object):
 					myData[host[myField]] = 0
 				myData[host[myField]] += 1
 
-		del response_data
+		del hosts
 
 		myPattern = ["#0fb8dc", "#006b8c", "#fb715e", "#59dc90", "#11a962", "#99ddff", "#ffe352", "#f0950e", "#ea475b", "#00cbbe"]
 		random.shuffle(myPattern)
@@ -2895,10 +2943,13 @@ def chartjs_malwarecontent(hx_api_object):
 		myData['labels'] = []
 		myData['datasets'] = []
 
-		(ret, response_code, response_data) = hx_api_object.restListHosts(limit=100000)
-		if ret:
-			for host in response_data['data']['entries']:
-				(sret, sresponse_code, sresponse_data) = hx_api_object.restGetHostSysinfo(host['_id'])
+		hosts = apicache_hosts(session['ht_profileid'])
+		if hosts is None:
+			hosts = hx_api_object.iterHosts()
+
+		try:
+			for host in hosts:
+				(sret, sresponse_code, sresponse_data) = apicache_host_sysinfo(hx_api_object, session['ht_profileid'], host['_id'])
 				if sret and 'malware' in sresponse_data['data'].keys():
 					if 'av' in sresponse_data['data']['malware'].keys():
 						if 'content' in sresponse_data['data']['malware']['av'].keys():
@@ -2912,9 +2963,9 @@ def chartjs_malwarecontent(hx_api_object):
 						myContent['none'] += 1
 				else:
 					myContent['none'] += 1
-		
-		del response_data
-		
+		except HXAPIPagingError as e:
+			logger.error("Failed to list hosts. Error: {}".format(e))
+
 		dataset = []
 		mylist = []
 		for ckey, cval in myContent.items():
@@ -2953,10 +3004,13 @@ def chartjs_malwareengine(hx_api_object):
 		myData['labels'] = []
 		myData['datasets'] = []
 
-		(ret, response_code, response_data) = hx_api_object.restListHosts(limit=100000)
-		if ret:
-			for host in response_data['data']['entries']:
-				(sret, sresponse_code, sresponse_data) = hx_api_object.restGetHostSysinfo(host['_id'])
+		hosts = apicache_hosts(session['ht_profileid'])
+		if hosts is None:
+			hosts = hx_api_object.iterHosts()
+
+		try:
+			for host in hosts:
+				(sret, sresponse_code, sresponse_data) = apicache_host_sysinfo(hx_api_object, session['ht_profileid'], host['_id'])
 				if sret and 'malware' in sresponse_data['data'].keys():
 					if 'av' in sresponse_data['data']['malware'].keys():
 						if 'content' in sresponse_data['data']['malware']['av'].keys():
@@ -2970,8 +3024,8 @@ def chartjs_malwareengine(hx_api_object):
 						myContent['none'] += 1
 				else:
 					myContent['none'] += 1
-
-		del response_data
+		except HXAPIPagingError as e:
+			logger.error("Failed to list hosts. Error: {}".format(e))
 
 		dataset = []
 		mylist = []
@@ -3010,10 +3064,13 @@ def chartjs_malwarestatus(hx_api_object):
 		myData['labels'] = []
 		myData['datasets'] = []
 
-		(ret, response_code, response_data) = hx_api_object.restListHosts(limit=100000)
-		if ret:
-			for host in response_data['data']['entries']:
-				(sret, sresponse_code, sresponse_data) = hx_api_object.restGetHostSysinfo(host['_id'])
+		hosts = apicache_hosts(session['ht_profileid'])
+		if hosts is None:
+			hosts = hx_api_object.iterHosts()
+
+		try:
+			for host in hosts:
+				(sret, sresponse_code, sresponse_data) = apicache_host_sysinfo(hx_api_object, session['ht_profileid'], host['_id'])
 				if 'MalwareProtectionStatus' in sresponse_data['data'].keys():
 					if not sresponse_data['data']['MalwareProtectionStatus'] in myContent.keys():
 						myContent[sresponse_data['data']['MalwareProtectionStatus']] = 1
@@ -3021,8 +3078,8 @@ def chartjs_malwarestatus(hx_api_object):
 						myContent[sresponse_data['data']['MalwareProtectionStatus']] += 1
 				else:
 					myContent['none'] += 1
-
-		del response_data
+		except HXAPIPagingError as e:
+			logger.error("Failed to list hosts. Error: {}".format(e))
 
 		dataset = []
 		mylist = []
@@ -3158,30 +3215,32 @@ def chartjs_hosts_initial_agent_checkin(hx_api_object):
 	for date in date_list[::-1]:
 		mycount[date.strftime("%Y-%m-%d")] = 0
 
-	(ret, response_code, response_data) = hx_api_object.restListHosts(limit=100000)
-	if ret:
-		for host in response_data['data']['entries']:
+	hosts = apicache_hosts(session['ht_profileid'])
+	if hosts is None:
+		hosts = hx_api_object.iterHosts()
+
+	try:
+		for host in hosts:
 			if host['initial_agent_checkin'][0:10] in mycount.keys():
 				mycount[host['initial_agent_checkin'][0:10]] += 1
-		
-		del response_data
-		
-		myGraphData = []
-		for key, stats in mycount.items():
-			myhosts['labels'].append(key)
-			myGraphData.append(stats)
-
-		myhosts['datasets'].append({
-			"label": "Provisioned endpoints",
-			"backgroundColor": "rgba(17, 169, 98, 0.2)",
-			"borderWidth": 2,
-			"borderColor": "#8fffc1",
-			"pointStyle": "circle",
-			"pointRadius": 2,
-	        "data": myGraphData
-			})
-	else:
+	except HXAPIPagingError as e:
+		logger.error("Failed to list hosts. Error: {}".format(e))
 		return('', 500)
+		
+	myGraphData = []
+	for key, stats in mycount.items():
+		myhosts['labels'].append(key)
+		myGraphData.append(stats)
+
+	myhosts['datasets'].append({
+		"label": "Provisioned endpoints",
+		"backgroundColor": "rgba(17, 169, 98, 0.2)",
+		"borderWidth": 2,
+		"borderColor": "#8fffc1",
+		"pointStyle": "circle",
+		"pointRadius": 2,
+		"data": myGraphData
+		})
 
 	return(app.response_class(response=json.dumps(myhosts), status=200, mimetype='application/json'))
 
@@ -3206,8 +3265,8 @@ def chartjs_events_timeline(hx_api_object):
 	for date in date_list[::-1]:
 		mycount[date.strftime("%Y-%m-%d")] = { k : 0 for k in hxtool_global.hx_alert_types.keys() }
 
-	# Get alerts
-	(ret, response_code, response_data) = hx_api_object.restGetAlertsTime(request.args.get('startDate'), request.args.get('endDate'))
+	# Get alerts, they are only counted so there's no need to keep or sort them
+	(ret, response_code, response_data) = hx_api_object.restGetAlertsTime(request.args.get('startDate'), request.args.get('endDate'), limit=None, stream=True)
 	if ret:
 		for alert in response_data:
 			# Make sure the date exists
@@ -3287,8 +3346,8 @@ def chartjs_events_distribution(hx_api_object):
 		k : 0 for k in hxtool_global.hx_alert_types.keys()
 	}
 
-	# Get alerts
-	(ret, response_code, response_data) = hx_api_object.restGetAlertsTime(request.args.get('startDate'), request.args.get('endDate'))
+	# Get alerts, they are only counted so there's no need to keep or sort them
+	(ret, response_code, response_data) = hx_api_object.restGetAlertsTime(request.args.get('startDate'), request.args.get('endDate'), limit=None, stream=True)
 	if ret:
 		for alert in response_data:
 			# Make sure the key exists
@@ -3319,18 +3378,19 @@ def chartjs_inactive_hosts_per_hostset(hx_api_object):
 	
 	(ret, response_code, response_data) = hx_api_object.restListHostsets()
 	if ret:
-		for hostset in response_data['data']['entries']:
-			(hret, hresponse_code, hresponse_data) = hx_api_object.restListHosts(query_terms = {'host_sets._id' : hostset['_id']})
-			if hret:
+		hostsets = response_data['data']['entries']
+		hosts_per_hostset = [apicache_hosts(session['ht_profileid'], filter_term = {'host_sets._id' : _['_id']}) for _ in hostsets]
+		if None in hosts_per_hostset:
+			hosts_per_hostset = [hresponse_data['data']['entries'] if hret else None for (hret, hresponse_code, hresponse_data) in HXAPIAsync(hx_api_object).map('restListHosts', [{'query_terms' : {'host_sets._id' : _['_id']}} for _ in hostsets])]
+		for hostset, hosts in zip(hostsets, hosts_per_hostset):
+			if hosts is not None:
 				now = datetime.datetime.utcnow()
 				hcount = 0
-				for host in hresponse_data['data']['entries']:
+				for host in hosts:
 					x = (HXAPI.gt(host['last_poll_timestamp']))
 					if (int((now - x).total_seconds())) > int(request.args.get('seconds')):
 						hcount += 1
 				
-				del hresponse_data
-				
 				myhosts.append({"hostset": hostset['name'], "count": hcount})
 
 		# Return the Vega Data
@@ -3436,13 +3496,23 @@ def cache_statistics(hx_api_object):
 	except TypeError:
 		mystats['enabled'] = False
 
-	if mystats['enabled']:
-		mystats['started'] = hxtool_global.apicache['started']
-		mystats['types'] = hxtool_global.apicache['types']
-		for k, v in hxtool_global.apicache['data'].items():
+	# Only started for profiles with background credentials
+	apicache = hxtool_global.apicache.get(session['ht_profileid'])
+	if mystats['enabled'] and apicache is not None:
+		mystats['started'] = apicache.stats['started']
+		mystats['types'] = apicache.stats['types']
+		for k, v in apicache.stats['data'].items():
 			mystats[k] = {}
 			mystats[k]['settings'] = v['settings']
 			mystats[k]['records processed'] = v['stats']['records']
+			mystats[k]['watermark'] = v['sync']['watermark']
+			mystats[k]['last reconcile'] = v['sync']['last_reconcile'].strftime("%Y-%m-%d %H:%M:%S") if v['sync']['last_reconcile'] else None
+			mystats[k]['last sync'] = v['sync']['last_sync'].strftime("%Y-%m-%d %H:%M:%S") if v['sync']['last_sync'] else None
+			mystats[k]['records removed'] = v['sync']['removed']
+		mystats['object_cache'] = hxtool_global.hxtool_object_cache.statistics()
+		mystats['queries'] = apicache.stats['queries']
+		if apicache.sysinfo is not None:
+			mystats['sysinfo'] = apicache.sysinfo.statistics()
 
 		return(app.response_class(response=json.dumps(mystats), status=200, mimetype='application/json'))
 	else:
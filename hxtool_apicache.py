@@ -4,22 +4,200 @@
 import hxtool_logging
 import hxtool_global
 import time
+import json
+import queue
+import heapq
+import itertools
+import threading
 from collections import deque
 
 from hx_lib import *
 from hxtool_scheduler import *
 from hxtool_scheduler_task import hxtool_scheduler_task
 from hxtool_db import *
+from hxtool_object_cache import HOST_SEARCH_FIELDS
+from hxtool_util import pretty_exceptions
+
+
+# Fetches host sysinfo for the API cache on a pool of worker threads, fed by the host fetcher.
+#
+# Hosts are taken from a priority queue, hosts a user has looked at first, then new hosts, then changed ones.
+# A host is queued once, queuing it again only raises its priority. Sysinfo is skipped for hosts whose record
+# has the same fingerprint as when their sysinfo was last fetched, the fields in the fingerprint are the ones
+# that show up in sysinfo as well.
+class hxtool_sysinfo_enricher:
+	PRIORITY_VIEWED = 0
+	PRIORITY_NEW = 1
+	PRIORITY_CHANGED = 2
+	FINGERPRINT_FIELDS = ['hostname', 'domain', 'agent_version', 'os', 'primary_ip_address', 'primary_mac', 'timezone', 'gmt_offset_seconds', 'last_audit_timestamp']
+
+	def __init__(self, hx_api_object, profile_id, object_cache, concurrency = 4):
+		self.logger = hxtool_logging.getLogger(__name__)
+		self.hx_api_object = hx_api_object
+		self.profile_id = profile_id
+		self.object_cache = object_cache
+		self._lock = threading.Lock()
+		self._queue = queue.PriorityQueue()
+		# host_id -> (priority, fingerprint) of the hosts in the queue
+		self._queued = {}
+		# host_id -> fingerprint of the host record the cached sysinfo was fetched for
+		self._fingerprints = {}
+		self._sequence = itertools.count()
+		self._stop_event = threading.Event()
+		self._workers = [threading.Thread(target = self._worker, name = "SysinfoEnricher-{}-{}".format(profile_id, i), daemon = True) for i in range(max(1, concurrency))]
+		self.stats = {
+			'queued' : 0,
+			'skipped' : 0,
+			'fetched' : 0,
+			'failed' : 0
+		}
+
+	@classmethod
+	def fingerprint(cls, host):
+		return hash(json.dumps([host.get(_) for _ in cls.FINGERPRINT_FIELDS], sort_keys = True, default = str))
+
+	# Queue the sysinfo of a host record from the controller, returns False if it hasn't changed
+	def submit(self, host, priority = PRIORITY_CHANGED):
+		fingerprint = self.fingerprint(host)
+		with self._lock:
+			if self._fingerprints.get(host['_id']) == fingerprint:
+				self.stats['skipped'] += 1
+				return False
+		self._enqueue(host['_id'], priority, fingerprint)
+		return True
+
+	# A user looked at the host, fetch its sysinfo ahead of everything else unless it is cached already
+	def prioritize(self, host_id):
+		with self._lock:
+			if host_id in self._fingerprints and host_id not in self._queued:
+				return False
+		self._enqueue(host_id, self.PRIORITY_VIEWED, None)
+		return True
+
+	# Hosts that are gone from the controller
+	def forget(self, host_ids):
+		with self._lock:
+			for host_id in host_ids:
+				self._fingerprints.pop(host_id, None)
+				self._queued.pop(host_id, None)
+
+	def _enqueue(self, host_id, priority, fingerprint):
+		with self._lock:
+			queued = self._queued.get(host_id)
+			if queued is not None:
+				fingerprint = fingerprint if fingerprint is not None else queued[1]
+				if queued[0] <= priority:
+					self._queued[host_id] = (queued[0], fingerprint)
+					return
+			self._queued[host_id] = (priority, fingerprint)
+			self.stats['queued'] += 1
+		self._queue.put((priority, next(self._sequence), host_id))
+
+	def _worker(self):
+		if HXAPI.tracer is not None:
+			HXAPITracer.set_context(self.profile_id, type(self).__name__)
+		while not self._stop_event.is_set():
+			try:
+				(priority, sequence, host_id) = self._queue.get(timeout = 1)
+			except queue.Empty:
+				continue
+			with self._lock:
+				queued = self._queued.get(host_id)
+				# Queued again with a higher priority, or forgotten
+				if queued is None or queued[0] != priority:
+					continue
+				del self._queued[host_id]
+			try:
+				(ret, response_code, response_data) = self.hx_api_object.restGetHostSysinfo(host_id)
+			except Exception as e:
+				(ret, response_code, response_data) = (False, None, pretty_exceptions(e))
+			if not ret:
+				self.stats['failed'] += 1
+				self.logger.debug("{}: Failed to fetch the sysinfo of host {}: {} {}".format(self.profile_id, host_id, response_code, response_data))
+				continue
+			self.object_cache.put(self.profile_id, "sysinfo", host_id, response_data['data'])
+			with self._lock:
+				self._fingerprints[host_id] = queued[1]
+			self.stats['fetched'] += 1
+			self.logger.debug("{}: Host sysinfo record updated: {}".format(self.profile_id, host_id))
+
+	def start(self):
+		for worker in self._workers:
+			worker.start()
+
+	def stop(self):
+		self._stop_event.set()
+		for worker in self._workers:
+			if worker.is_alive():
+				worker.join()
+
+	def statistics(self):
+		with self._lock:
+			s = dict(self.stats)
+			s['pending'] = len(self._queued)
+		return s
 
 
 class hxtool_api_cache:
-	def __init__(self, hx_api_object, profile_id, intervals, objectTypes):
+	# Field each object type is ordered by for the incremental sync, objects at or above the watermark are fetched
+	WATERMARK_FIELDS = {
+		'host' : 'last_poll_timestamp',
+		'alert' : 'reported_at',
+		'triage' : '_id',
+		'file' : '_id',
+		'live' : '_id'
+	}
+	# The watermark doesn't move when the state of one of these changes, cached objects that aren't in a final state
+	# are fetched again by id once they are older than refresh_interval. Alerts have no final state.
+	FINAL_STATES = {
+		'triage' : ['COMPLETE', 'FAILED', 'CANCELLED', 'ABORTED'],
+		'file' : ['COMPLETE', 'FAILED', 'CANCELLED', 'ABORTED'],
+		'live' : ['COMPLETE', 'FAILED', 'CANCELLED', 'ABORTED']
+	}
+	DEFAULT_RECONCILE_INTERVAL = 3600
+	DEFAULT_MAX_STALENESS = 300
+
+	def __init__(self, hx_api_object, profile_id, intervals, objectTypes, sysinfo_concurrency = 4, max_staleness = DEFAULT_MAX_STALENESS):
 		self.logger = hxtool_logging.getLogger(__name__)
 		self.hx_api_object = hx_api_object
 		self.profile_id = profile_id
+		self.max_staleness = max_staleness
+
+		self.list_functions = {
+			'host' : self.hx_api_object.restListHosts,
+			'alert' : self.hx_api_object.restGetAlerts,
+			'triage' : self.hx_api_object.restListTriages,
+			'file' : self.hx_api_object.restListFileaq,
+			'live' : self.hx_api_object.restListDataAcquisitions
+		}
+		self.get_functions = {
+			'alert' : self.hx_api_object.restGetAlertID,
+			'triage' : self.hx_api_object.restTriageAcquisitionByID,
+			'file' : self.hx_api_object.restFileAcquisitionById,
+			'live' : self.hx_api_object.restDataAcquisitionByID
+		}
+
+		self.object_cache = hxtool_global.hxtool_object_cache
 
 		# TEMP: drop cache
-		hxtool_global.hxtool_db.cacheDrop(self.profile_id)
+		self.object_cache.drop(self.profile_id)
+
+		# contentId -> update_timestamp of the cached objects, kept in step with the object cache so that a run
+		# doesn't have to load the whole cache first
+		self.cache_index = {}
+		# contentIds of the cached objects that have to be revisited, see FINAL_STATES
+		self.open_objects = {}
+
+		stats = {}
+		for k, v in intervals.items():
+			stats[k] = {"settings": v, "stats": {"records": 0, "timeline": deque([], maxlen=1000)}, "sync": {"watermark": None, "last_reconcile": None, "last_sync": None, "reconcile_requested": False, "removed": 0}}
+
+		self.stats = { "started" : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "types" : objectTypes, "data": stats, "queries": {"hits": 0, "misses": 0} }
+
+		self.sysinfo = None
+		if "host" in objectTypes:
+			self.sysinfo = hxtool_sysinfo_enricher(self.hx_api_object, self.profile_id, self.object_cache, concurrency = sysinfo_concurrency)
+			self.sysinfo.start()
 
 		for objectType in objectTypes:
 			if objectType in intervals.keys():
@@ -27,64 +205,76 @@ class hxtool_api_cache:
 					setattr(self, objectType + "_fetcher_interval", intervals[objectType]["fetcher_interval"])
 					setattr(self, objectType + "_objects_per_poll", intervals[objectType]["objects_per_poll"])
 					setattr(self, objectType + "_refresh_interval", intervals[objectType]["refresh_interval"])
+					setattr(self, objectType + "_reconcile_interval", intervals[objectType].get("reconcile_interval", self.DEFAULT_RECONCILE_INTERVAL))
 				except:
 					self.logger.error("Missing interval settings for {}, check configuration to enable cache".format(objectType))
 					exit(2)
 
+				self.cache_index[objectType] = {}
+				self.open_objects[objectType] = set()
 				my_fetcher_task = hxtool_scheduler_task("System", "Cache fetcher for " + objectType + " profile: " + str(self.profile_id), immutable=True)
 				my_fetcher_task.set_schedule(seconds=intervals[objectType]["fetcher_interval"])
 				my_fetcher_task.add_step(self, "apicache_fetcher", kwargs={"objectType" : objectType } )
 				hxtool_global.hxtool_scheduler.add(my_fetcher_task)
 				self.logger.info("Apicache {} fetcher started for profile: {}.".format(objectType, self.profile_id))
 
-		stats = {}
-		for k, v in intervals.items():
-			stats[k] = {"settings": v, "stats": {"records": 0, "timeline": deque([], maxlen=1000)}}
-
-		hxtool_global.apicache = { "started" : datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "types" : objectTypes, "data": stats }
-
+	# A refresh_interval of None updates every cached record, the incremental sync only passes changed ones
 	def apicache_processor(self, currOffset, objectType, records, myCache, refresh_interval):
 
 		s_start = datetime.datetime.now()
 		s_total = 0
 		s_update = 0
 		s_add = 0
+		# Hosts whose sysinfo has to be updated or added
+		hosts = []
+		# Written to the object cache in one go
+		cached = []
 
 		for record in records:
 			
 			s_total += 1
 			currOffset += 1
 
-			if record['_id'] in myCache.keys():
+			if record['_id'] in myCache:
 				t = datetime.datetime.now() - datetime.datetime.strptime(myCache[record['_id']], "%Y-%m-%d %H:%M:%S")
-				if t.seconds > refresh_interval:
-					hxtool_global.hxtool_db.cacheUpdate(self.profile_id, objectType, record['_id'], record)
+				if refresh_interval is None or t.total_seconds() > refresh_interval:
+					cached.append((record['_id'], record))
+					myCache[record['_id']] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 					s_update += 1
 					self.logger.debug("{}: {} record updated: {}".format(self.profile_id, objectType, record['_id']))
 
 					# Special case, also get sysinfo for hosts
 					if objectType == "host":
-						(ret, response_code, response_data) = self.hx_api_object.restGetHostSysinfo(record['_id'])
-						if ret:
-							hxtool_global.hxtool_db.cacheUpdate(self.profile_id, "sysinfo", record['_id'], response_data['data'])
-							self.logger.debug("{}: Host sysinfo record updated: {}".format(self.profile_id, record['_id']))
+						hosts.append((record, hxtool_sysinfo_enricher.PRIORITY_CHANGED))
 			else:
-				hxtool_global.hxtool_db.cacheAdd(self.profile_id, objectType, record)
+				cached.append((record['_id'], record))
+				myCache[record['_id']] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 				s_add += 1
 				self.logger.debug("{}: New {} record added: {}".format(self.profile_id, objectType, record['_id']))
 
 				# Special case, also get sysinfo for hosts
 				if objectType == "host":
-					(ret, response_code, response_data) = self.hx_api_object.restGetHostSysinfo(record['_id'])
-					if ret:
-						hxtool_global.hxtool_db.cacheAddById(self.profile_id, "sysinfo", record['_id'], response_data['data'])
-						self.logger.debug("{}: New sysinfo record added: {}".format(self.profile_id, record['_id']))
+					hosts.append((record, hxtool_sysinfo_enricher.PRIORITY_NEW))
+
+		if cached:
+			self.object_cache.put_many(self.profile_id, objectType, cached)
+			if objectType in self.get_functions:
+				final_states = self.FINAL_STATES.get(objectType, [])
+				for contentId, record in cached:
+					if record.get('state') in final_states:
+						self.open_objects[objectType].discard(contentId)
+					else:
+						self.open_objects[objectType].add(contentId)
+
+		# The sysinfo is fetched in the background, only once the cached host records are written
+		for record, priority in hosts:
+			self.sysinfo.submit(record, priority)
 
 		# Process stats
 		s_end = datetime.datetime.now()
 		myStats = {"timestamp": s_end.strftime("%Y-%m-%d %H:%M:%S"), "processed": s_total, "updates": s_update, "additions": s_add, "duration": (s_end - s_start).total_seconds()}
-		hxtool_global.apicache['data'][objectType]['stats']['records'] += s_total
-		hxtool_global.apicache['data'][objectType]['stats']['timeline'].append(myStats)
+		self.stats['data'][objectType]['stats']['records'] += s_total
+		self.stats['data'][objectType]['stats']['timeline'].append(myStats)
 
 		# Show log if we have updates or new records
 		if s_update != 0 or s_add != 0:
@@ -97,57 +287,233 @@ class hxtool_api_cache:
 		#Temp workaround
 		time.sleep(2)
 
-		# Get a list of current cache entries for this object type
-		res = hxtool_global.hxtool_db.cacheList(self.profile_id, objectType)
+		if objectType not in self.list_functions:
+			return True
 
-		# Format the local cache results into a dict
-		myCache = {}
-		for cacheEntry in res:
-			myCache[cacheEntry['contentId']] = cacheEntry['update_timestamp']
-		
-		# We always start the query from the top (always check everything)
-		myoffset = 0
+		sync = self.stats['data'][objectType]['sync']
+		reconcile_interval = getattr(self, objectType + "_reconcile_interval")
+		if sync['reconcile_requested'] or sync['last_reconcile'] is None or (datetime.datetime.now() - sync['last_reconcile']).total_seconds() >= reconcile_interval:
+			self.apicache_reconcile(objectType)
+		else:
+			self.apicache_incremental(objectType)
 
+		return True
+
+	# Walk the list newest first and stop at the watermark, only objects that changed since the last run are fetched
+	def apicache_incremental(self, objectType):
+		sync = self.stats['data'][objectType]['sync']
+		field = self.WATERMARK_FIELDS[objectType]
+		page_size = getattr(self, objectType + "_objects_per_poll")
+		myCache = self.cache_index[objectType]
+
+		watermark = sync['watermark']
+		total = None
+		offset = 0
+		currOffset = 0
+		while True:
+			(ret, response_code, response_data) = self.list_functions[objectType](limit = page_size, offset = offset, sort_term = field + "+descending")
+			if not ret:
+				self.logger.error("{}: Failed to fetch {} records. Error: {}".format(self.profile_id, objectType, HXAPIPagingError(response_code, response_data, offset)))
+				return
+
+			entries = response_data['data']['entries']
+			if total is None:
+				total = response_data['data'].get('total', None)
+			offset += len(entries)
+
+			changed = []
+			reached = False
+			for entry in entries:
+				value = entry.get(field)
+				if value is None or (watermark is not None and value < watermark):
+					reached = True
+					break
+				changed.append(entry)
+				if sync['watermark'] is None or value > sync['watermark']:
+					sync['watermark'] = value
+
+			if changed:
+				currOffset = self.apicache_processor(currOffset, objectType, changed, myCache, None)
+
+			if reached or len(entries) < page_size or (total is not None and offset >= total):
+				break
+
+		self.apicache_revisit(objectType)
+
+		sync['last_sync'] = datetime.datetime.now()
+
+		# The totals only differ when objects were deleted on the controller, or changed without moving past the watermark
+		if total is not None and total != len(myCache):
+			self.logger.info("{}: [{}] controller has {} records, cache has {}, reconciling on the next run".format(self.profile_id, objectType, total, len(myCache)))
+			sync['reconcile_requested'] = True
+
+	# Fetch the open objects that are older than refresh_interval again, oldest first and at most objects_per_poll of them
+	def apicache_revisit(self, objectType):
+		if objectType not in self.get_functions:
+			return
+		myCache = self.cache_index[objectType]
+		refresh_interval = getattr(self, objectType + "_refresh_interval")
+		stale_before = (datetime.datetime.now() - datetime.timedelta(seconds = refresh_interval)).strftime("%Y-%m-%d %H:%M:%S")
+		stale = heapq.nsmallest(getattr(self, objectType + "_objects_per_poll"), ((myCache[_], _) for _ in self.open_objects[objectType] if _ in myCache and myCache[_] < stale_before))
+
+		records = []
+		removed = []
+		for update_timestamp, contentId in stale:
+			(ret, response_code, response_data) = self.get_functions[objectType](contentId)
+			if ret:
+				records.append(response_data['data'])
+			elif response_code == 404:
+				removed.append(contentId)
+			else:
+				self.logger.error("{}: Failed to fetch {} record {}. Error: {} {}".format(self.profile_id, objectType, contentId, response_code, response_data))
+				break
+
+		if records:
+			self.apicache_processor(0, objectType, records, myCache, refresh_interval)
+		if removed:
+			self.apicache_remove(objectType, removed)
+
+	def apicache_remove(self, objectType, removed):
+		myCache = self.cache_index[objectType]
+		self.object_cache.remove(self.profile_id, objectType, removed)
 		if objectType == "host":
-			while True:
-				(ret, response_code, response_data) = self.hx_api_object.restListHosts(offset=myoffset, sort_term="_id+ascending", limit=self.host_objects_per_poll)
-				if ret:
-					# Leave loop if no new records are returned
-					if len(response_data['data']['entries']) == 0:
-						break
-					myoffset = self.apicache_processor(myoffset, objectType, response_data['data']['entries'], myCache, self.host_refresh_interval)
-
-		elif objectType == "alert":
-			while True:
-				(ret, response_code, response_data) = self.hx_api_object.restGetAlerts(offset=myoffset, sort_term="_id+ascending", limit=self.alert_objects_per_poll)
-				if ret:
-					if len(response_data['data']['entries']) == 0:
-						break
-					myoffset = self.apicache_processor(myoffset, objectType, response_data['data']['entries'], myCache, self.alert_refresh_interval)
-
-		elif objectType == "triage":
-			while True:
-				(ret, response_code, response_data) = self.hx_api_object.restListTriages(offset=myoffset, sort_term="_id+ascending", limit=self.triage_objects_per_poll)
-				if ret:
-					if len(response_data['data']['entries']) == 0:
-						break
-					myoffset = self.apicache_processor(myoffset, objectType, response_data['data']['entries'], myCache, self.triage_refresh_interval)
-
-		elif objectType == "file":
-			while True:
-				(ret, response_code, response_data) = self.hx_api_object.restListFileaq(offset=myoffset, sort_term="_id+ascending", limit=self.file_objects_per_poll)
-				if ret:
-					if len(response_data['data']['entries']) == 0:
-						break
-					myoffset = self.apicache_processor(myoffset, objectType, response_data['data']['entries'], myCache, self.file_refresh_interval)
-
-		elif objectType == "live":
-			while True:
-				(ret, response_code, response_data) = self.hx_api_object.restListDataAcquisitions(offset=myoffset, sort_term="_id+ascending", limit=self.live_objects_per_poll)
-				if ret:
-					if len(response_data['data']['entries']) == 0:
-						break
-					myoffset = self.apicache_processor(myoffset, objectType, response_data['data']['entries'], myCache, self.live_refresh_interval)
+			self.object_cache.remove(self.profile_id, "sysinfo", removed)
+			self.sysinfo.forget(removed)
+		for contentId in removed:
+			del myCache[contentId]
+			self.open_objects[objectType].discard(contentId)
+		self.stats['data'][objectType]['sync']['removed'] += len(removed)
+		self.logger.info("{}: [{}] {} records removed".format(self.profile_id, objectType, len(removed)))
 
-		return True
+	# Walk the whole list, refresh stale objects and drop the ones that are gone from the controller
+	def apicache_reconcile(self, objectType):
+		sync = self.stats['data'][objectType]['sync']
+		field = self.WATERMARK_FIELDS[objectType]
+		myCache = self.cache_index[objectType]
+
+		s_start = datetime.datetime.now()
+		seen = set()
+		watermark = None
+		myoffset = 0
+		try:
+			for entries in self.hx_api_object.iterPages(self.list_functions[objectType], page_size = getattr(self, objectType + "_objects_per_poll"), sort_term = "_id+ascending"):
+				for entry in entries:
+					seen.add(entry['_id'])
+					value = entry.get(field)
+					if value is not None and (watermark is None or value > watermark):
+						watermark = value
+				myoffset = self.apicache_processor(myoffset, objectType, entries, myCache, getattr(self, objectType + "_refresh_interval"))
+		except HXAPIPagingError as e:
+			# A partial walk says nothing about deletions, try again on the next run
+			self.logger.error("{}: Failed to fetch {} records. Error: {}".format(self.profile_id, objectType, e))
+			return
+
+		removed = [_ for _ in myCache.keys() if _ not in seen]
+		if removed:
+			self.apicache_remove(objectType, removed)
+
+		sync['watermark'] = watermark
+		sync['last_reconcile'] = datetime.datetime.now()
+		sync['last_sync'] = sync['last_reconcile']
+		sync['reconcile_requested'] = False
+		self.logger.info("{}: [{}] reconciled {} records in {} seconds".format(self.profile_id, objectType, len(seen), (sync['last_reconcile'] - s_start).total_seconds()))
+
+	# The cache can answer for a type once it has been walked in full and synced within max_staleness seconds
+	def is_fresh(self, objectType):
+		sync = self.stats['data'].get(objectType, {}).get('sync')
+		if not sync or sync['last_reconcile'] is None or sync['last_sync'] is None:
+			return False
+		return (datetime.datetime.now() - sync['last_sync']).total_seconds() <= self.max_staleness
+
+	# Generator over the cached objects of a type, or the ones in contentIds, objects the object cache dropped are read
+	# from the database
+	def iter_objects(self, objectType, contentIds = None):
+		cached = self.cache_index.get(objectType, {}).keys()
+		if contentIds is not None:
+			cached = [_ for _ in cached if _ in contentIds]
+		for record in self.object_cache.get_many(self.profile_id, objectType, list(cached)):
+			yield record['data']
+
+	def count_query(self, hit):
+		self.stats['queries']['hits' if hit else 'misses'] += 1
+
+	def stop(self):
+		if self.sysinfo is not None:
+			self.sysinfo.stop()
+
+
+# Read-through queries for the dashboards. Each returns None when the API cache of the profile can't answer,
+# the caller then asks the controller.
+
+# filter_term fields answered by an object cache index alone, the search fields are checked again as the index is lower case
+HOST_FILTER_INDEXES = {
+	'host_sets._id' : 'hostset',
+	'host_set._id' : 'hostset'
+}
+
+def _host_field(host, field):
+	for part in field.split("."):
+		if not isinstance(host, dict):
+			return None
+		host = host.get(part)
+	return host
+
+def _apicache_for(profile_id, objectType):
+	cache = hxtool_global.apicache.get(profile_id)
+	if cache is None:
+		return None
+	hit = cache.is_fresh(objectType)
+	cache.count_query(hit)
+	return cache if hit else None
+
+# Hosts matching search_term, a case insensitive substring of one of HOST_SEARCH_FIELDS, and filter_term, a dict of (dotted) field values
+def apicache_hosts(profile_id, search_term = None, filter_term = {}, limit = None):
+	cache = _apicache_for(profile_id, "host")
+	if cache is None:
+		return None
+	# Narrow the hosts down with the indexes before reading any of them
+	contentIds = None
+	for k, v in filter_term.items():
+		if k in HOST_FILTER_INDEXES:
+			found = cache.object_cache.find(profile_id, "host", HOST_FILTER_INDEXES[k], HXAPI.compat_str(v))
+		elif k in HOST_SEARCH_FIELDS:
+			found = cache.object_cache.find(profile_id, "host", k, HXAPI.compat_str(v).lower())
+		else:
+			continue
+		contentIds = found if contentIds is None else contentIds & found
+	if search_term:
+		search_term = search_term.lower()
+		found = set()
+		for f in HOST_SEARCH_FIELDS:
+			found |= cache.object_cache.find(profile_id, "host", f, match = lambda value: search_term in value)
+		contentIds = found if contentIds is None else contentIds & found
+	
+	hosts = cache.iter_objects("host", contentIds)
+	if search_term:
+		hosts = (_ for _ in hosts if any(search_term in HXAPI.compat_str(_host_field(_, f) or '').lower() for f in HOST_SEARCH_FIELDS))
+	filter_term = { k : v for k, v in filter_term.items() if k not in HOST_FILTER_INDEXES }
+	if filter_term:
+		hosts = (_ for _ in hosts if all(HXAPI.compat_str(_host_field(_, k)) == HXAPI.compat_str(v) for k, v in filter_term.items()))
+	if limit is not None:
+		hosts = itertools.islice(hosts, limit)
+	return hosts
+
+# (ret, response_code, response_data) like restGetHostSysinfo
+def apicache_host_sysinfo(hx_api_object, profile_id, host_id):
+	cache = hxtool_global.apicache.get(profile_id)
+	if cache is None or cache.sysinfo is None:
+		return hx_api_object.restGetHostSysinfo(host_id)
+	record = cache.object_cache.get(profile_id, "sysinfo", host_id)
+	cache.count_query(bool(record))
+	if record:
+		return (True, 200, {'data' : record['data']})
+	(ret, response_code, response_data) = hx_api_object.restGetHostSysinfo(host_id)
+	if ret:
+		cache.object_cache.put(profile_id, "sysinfo", host_id, response_data['data'])
+	return (ret, response_code, response_data)
 
+# A user looked at a host, have the API cache fetch its sysinfo first
+def apicache_host_viewed(profile_id, host_id):
+	cache = hxtool_global.apicache.get(profile_id)
+	if cache is not None and cache.sysinfo is not None and host_id:
+		cache.sysinfo.prioritize(host_id)
@@ -29,7 +29,18 @@ class hxtool_config:
 			'ssl' : 'enabled',
 			'port' : 8080,
 			'listen_address' : '0.0.0.0',
-			'session_timeout' : 30
+			'session_timeout' : 30,
+			'api_session_cache_size' : 256,
+			'api_tracing' : True,
+			'api_resilience' : {
+				'retries' : 3,
+				'backoff_factor' : 0.5,
+				'backoff_max' : 8,
+				'breaker_window' : 60,
+				'breaker_min_requests' : 20,
+				'breaker_error_threshold' : 0.5,
+				'breaker_cooldown' : 30
+			}
 		},
 		'ssl' : {
 			'cert' : 'hxtool.crt',
@@ -37,7 +48,18 @@ class hxtool_config:
 		},
 		'scheduler' : {
 			'thread_count' : None,
-			'defer_interval' : 30
+			'process_count' : None,
+			'profile_thread_count' : None,
+			'task_class_weights' : {
+				'system' : 4,
+				'user' : 2,
+				'child' : 1
+			},
+			'defer_interval' : 30,
+			'journal_flush_interval' : 5,
+			'journal_flush_size' : 500,
+			'distributed' : False,
+			'lease_ttl' : 60
 		},
 		'headers' : {
 		},
@@ -7,4 +7,55 @@ class hxtool_db:
 
 	@property
 	def database_engine(self):
-		raise NotImplementedError("You must override this in your database class.")
\ No newline at end of file
+		raise NotImplementedError("You must override this in your database class.")
+	
+	def taskWriteBatch(self, creates = [], updates = [], deletes = []):
+		raise NotImplementedError("You must override this in your database class.")
+	
+	# Applies a list of write operations to a table (collection) in as few writes as the database allows:
+	#	('insert', document)
+	#	('update', query, fields)
+	#	('upsert', query, fields[, insert_fields]) - insert_fields are only set when the document is created
+	#	('delete', query)
+	# A query is a dict of field values a document has to match. Operations are applied by kind, deletes first,
+	# then inserts, then updates and upserts in the order given.
+	def bulkWrite(self, table, operations):
+		raise NotImplementedError("You must override this in your database class.")
+	
+	def auditInsertMany(self, audits):
+		raise NotImplementedError("You must override this in your database class.")
+	
+	# ObjectCache records of a type for a list of contentIds, in any order
+	def cacheGetMany(self, profile_id, cacheType, contentIds):
+		raise NotImplementedError("You must override this in your database class.")
+	
+	# ObjectCache records of a type
+	def cacheList(self, profile_id, cacheType):
+		raise NotImplementedError("You must override this in your database class.")
+	
+	# Upserts a list of ObjectCache records, see hxtool_object_cache
+	def cacheUpsertMany(self, records):
+		return self.cacheWriteBatch(upserts = records)
+	
+	# Write behind from hxtool_object_cache, upserts are ObjectCache records and removes (profile_id, type, contentId) tuples
+	def cacheWriteBatch(self, upserts = [], removes = []):
+		operations = [('delete', {'profile_id' : profile_id, 'type' : cacheType, 'contentId' : contentId}) for (profile_id, cacheType, contentId) in removes]
+		operations.extend([('upsert', 
+							{'profile_id' : _['profile_id'], 'type' : _['type'], 'contentId' : _['contentId']}, 
+							{'update_timestamp' : _['update_timestamp'], 'data' : _['data']}, 
+							{'create_timestamp' : _['create_timestamp'], 'dirty' : _['dirty']}) for _ in upserts])
+		if operations:
+			return self.bulkWrite('ObjectCache', operations)
+	
+	# Task leases, see hxtool_task_lease
+	def taskLeaseClaim(self, task_id, owner, run_key, expires, now):
+		raise NotImplementedError("You must override this in your database class.")
+	
+	def taskLeaseRenew(self, owner, task_ids, expires, now):
+		raise NotImplementedError("You must override this in your database class.")
+	
+	def taskLeaseRelease(self, task_id, owner, run_key, next_run, now):
+		raise NotImplementedError("You must override this in your database class.")
+	
+	def taskLeasePurge(self, before):
+		raise NotImplementedError("You must override this in your database class.")
@@ -10,5 +10,11 @@ def initialize():
 	global hxtool_db
 	global hxtool_config
 	global hxtool_scheduler
+	global hxtool_task_journal
+	hxtool_task_journal = None
+	global hxtool_object_cache
+	hxtool_object_cache = None
+	global hxtool_api_sessions
+	hxtool_api_sessions = None
 	global hxtool_x15_object
 	global hx_alert_types
@@ -4,7 +4,8 @@
 from hxtool_db import hxtool_db
 
 try:
-	from pymongo import MongoClient
+	from pymongo import MongoClient, InsertOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany, ReturnDocument
+	from pymongo.errors import DuplicateKeyError
 except ImportError:
 	print("HXTool is configured to use MongoDB. Please install the 'pymongo' Python module")
 	exit(1)
@@ -38,10 +39,13 @@ class hxtool_mongodb(hxtool_db):
 	def __init__(self, db_host, db_port, db_user, db_pass, db_auth_source, db_auth_mechanism, db_name="hxtool"):
 		try:
 			self._client = MongoClient(db_host, db_port, username=db_user, password=db_pass, authSource=db_auth_source, authMechanism=db_auth_mechanism, document_class=tinydb_emulated_dict)
+			self._database = self._client[db_name]
 			self._db_profile = self._client[db_name].profile
 			self._db_background_processor_credential = self._client[db_name].background_processor_credential
 			self._db_session = self._client[db_name].session
 			self._db_tasks = self._client[db_name].tasks
+			self._db_task_leases = self._client[db_name].task_leases
+			self._db_task_leases.create_index('task_id', unique = True)
 			self._db_taskprofiles = self._client[db_name].taskprofiles
 			self._db_alerts = self._client[db_name].alerts
 			self._db_hosts = self._client[db_name].hosts
@@ -53,6 +57,7 @@ class hxtool_mongodb(hxtool_db):
 			self._db_stacking = self._client[db_name].stacking
 			self._db_audits = self._client[db_name].audits
 			self._db_hostgroups = self._client[db_name].hostgroups
+			self._db_object_cache = self._client[db_name].ObjectCache
 			self._client.admin.command('ismaster')
 			logger.info("MongoDB connection successful")
 		except Exception as e:
@@ -61,6 +66,7 @@ class hxtool_mongodb(hxtool_db):
 		
 		# Ensure that the text wildcard index is in place
 		self._db_audits.create_index([("$**","text")])
+		self._db_object_cache.create_index([("profile_id", 1), ("type", 1), ("contentId", 1)], unique = True)
 	
 	@property
 	def database_engine(self):
@@ -76,6 +82,10 @@ class hxtool_mongodb(hxtool_db):
 	def auditInsert(self, auditdata):
 		return self._db_audits.insert_one(auditdata)
 
+	def auditInsertMany(self, audits):
+		if audits:
+			return self._db_audits.insert_many(audits, ordered = False)
+	
 	def auditRemove(self, myid):
 		return self._db_audits.delete_one({"bulk_acquisition_id": int(myid)})
 
@@ -289,8 +299,9 @@ class hxtool_mongodb(hxtool_db):
 		return self._db_stacking.update_one( { "profile_id": profile_id, "bulk_download_eid": ObjectId(bulk_download_eid) }, { "$push": { "hosts": {"hostname" : hostname, "agent_id" : agent_id, "processed" : False} } } )
 		
 	def stackJobAddResult(self, profile_id, bulk_download_eid, hostname, result):
-		self._db_stacking.update_one( { "profile_id": profile_id, "bulk_download_eid": ObjectId(bulk_download_eid) }, { "$push": { "results" : { "$each": result }  } } )
-		return self._db_stacking.update_one( { "profile_id": profile_id, "bulk_download_eid": ObjectId(bulk_download_eid) }, { "$set": { "hosts.$[].hostname": hostname, "hosts.$[].processed": True } } )
+		return self._db_stacking.update_one( { "profile_id": profile_id, "bulk_download_eid": ObjectId(bulk_download_eid) }, 
+											{ "$push": { "results" : { "$each": result } }, "$set": { "hosts.$[host].processed": True, "update_timestamp": HXAPI.dt_to_str(datetime.datetime.utcnow()) } }, 
+											array_filters = [ { "host.hostname": hostname } ] )
 			
 	def stackJobStop(self, stack_job_eid):
 		return self._db_stacking.update_one( { "_id": ObjectId(stack_job_eid) }, { "$set": { "stopped": True, "update_timestamp": HXAPI.dt_to_str(datetime.datetime.utcnow()) } } )
@@ -357,11 +368,80 @@ class hxtool_mongodb(hxtool_db):
 	def taskGet(self, profile_id, task_id):
 		return self._db_tasks.find_one( { "profile_id": profile_id, "task_id": task_id } )
 	
+	# $set rather than replace_one so a partial update from the task journal doesn't drop the other fields
 	def taskUpdate(self, profile_id, task_id, serialized_task):
-		return self._db_tasks.replace_one({ "profile_id": profile_id, "task_id": task_id }, serialized_task)
+		return self._db_tasks.update_one({ "profile_id": profile_id, "task_id": task_id }, { "$set" : serialized_task })
 	
 	def taskDelete(self, profile_id, task_id):
 		return self._db_tasks.delete_one( { "profile_id": profile_id, "task_id": task_id } )
+	
+	# Apply a batch of task changes in a single round trip.
+	# updates is a list of (profile_id, task_id, fields) and deletes a list of (profile_id, task_id)
+	def taskWriteBatch(self, creates = [], updates = [], deletes = []):
+		operations = [DeleteOne({ "profile_id": profile_id, "task_id": task_id }) for (profile_id, task_id) in deletes]
+		operations.extend([InsertOne(_) for _ in creates])
+		operations.extend([UpdateOne({ "profile_id": profile_id, "task_id": task_id }, { "$set" : fields }) for (profile_id, task_id, fields) in updates])
+		if operations:
+			return self._db_tasks.bulk_write(operations, ordered = True)
+	
+	def bulkWrite(self, table, operations):
+		deletes = []
+		inserts = []
+		updates = []
+		for operation in operations:
+			if operation[0] == 'delete':
+				deletes.append(DeleteMany(operation[1]))
+			elif operation[0] == 'insert':
+				inserts.append(InsertOne(operation[1]))
+			elif operation[0] == 'update':
+				updates.append(UpdateMany(operation[1], { "$set" : operation[2] }))
+			elif operation[0] == 'upsert':
+				update = { "$set" : operation[2] }
+				if len(operation) > 3 and operation[3]:
+					update["$setOnInsert"] = operation[3]
+				updates.append(UpdateOne(operation[1], update, upsert = True))
+			else:
+				raise ValueError("Unknown bulk write operation {}".format(operation[0]))
+		if deletes or inserts or updates:
+			return self._database[table].bulk_write(deletes + inserts + updates, ordered = True)
+	
+	def cacheGet(self, profile_id, cacheType, contentId):
+		return self._db_object_cache.find_one( { "profile_id": profile_id, "type": cacheType, "contentId": contentId } ) or False
+	
+	def cacheGetMany(self, profile_id, cacheType, contentIds):
+		return list(self._db_object_cache.find( { "profile_id": profile_id, "type": cacheType, "contentId": { "$in": list(contentIds) } } ))
+	
+	def cacheList(self, profile_id, cacheType):
+		return list(self._db_object_cache.find( { "profile_id": profile_id, "type": cacheType } ))
+	
+	def cacheDrop(self, profile_id):
+		return self._db_object_cache.delete_many( { "profile_id": profile_id } )
+	
+	# The claim is a single conditional upsert, if the lease exists but isn't claimable the upsert
+	# collides with the unique task_id index and we lost the claim.
+	def taskLeaseClaim(self, task_id, owner, run_key, expires, now):
+		try:
+			lease = self._db_task_leases.find_one_and_update({ "task_id": task_id, 
+																"$and" : [
+																	{ "$or" : [ { "owner" : owner }, { "owner" : None }, { "expires" : { "$lt" : now } } ] },
+																	{ "$nor" : [ { "done" : True, "run_key" : { "$gte" : run_key } } ] }
+																]}, 
+																{ "$set" : { "owner" : owner, "run_key" : run_key, "expires" : expires, "done" : False, "updated" : now } },
+																upsert = True, return_document = ReturnDocument.AFTER)
+			return (True, lease)
+		except DuplicateKeyError:
+			return (False, self._db_task_leases.find_one({ "task_id": task_id }))
+	
+	def taskLeaseRenew(self, owner, task_ids, expires, now):
+		self._db_task_leases.update_many({ "task_id" : { "$in" : task_ids }, "owner" : owner }, { "$set" : { "expires" : expires, "updated" : now } })
+		return [_['task_id'] for _ in self._db_task_leases.find({ "task_id" : { "$in" : task_ids }, "owner" : owner }, { "task_id" : 1 })]
+	
+	def taskLeaseRelease(self, task_id, owner, run_key, next_run, now):
+		return self._db_task_leases.update_one({ "task_id" : task_id, "owner" : owner, "run_key" : run_key }, 
+												{ "$set" : { "owner" : None, "done" : True, "next_run" : next_run, "expires" : 0, "updated" : now } })
+	
+	def taskLeasePurge(self, before):
+		return self._db_task_leases.delete_many({ "done" : True, "next_run" : None, "updated" : { "$lt" : before } })
 			
 	def taskProfileAdd(self, name, actor, params):
 		return self._db_taskprofiles.insert_one({'taskprofile_id' : str(secure_uuid4()), 
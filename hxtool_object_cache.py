@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import datetime
+import threading
+from collections import OrderedDict
+
+import hxtool_logging
+from hxtool_util import pretty_exceptions
+
+logger = hxtool_logging.getLogger(__name__)
+
+# The fields the controller searches hosts on
+HOST_SEARCH_FIELDS = ['hostname', 'domain', 'primary_ip_address', 'last_poll_ip', 'agent_version', 'os.product_name']
+
+def _field_values(field):
+	def f(data):
+		for part in field.split("."):
+			if not isinstance(data, dict):
+				return []
+			data = data.get(part)
+		return [str(data).lower()] if data is not None and not isinstance(data, (dict, list)) else []
+	return f
+
+def _hostset_values(data):
+	host_sets = data.get('host_sets') or []
+	if isinstance(data.get('host_set'), dict):
+		host_sets = host_sets + [data['host_set']]
+	return [str(_['_id']) for _ in host_sets if isinstance(_, dict) and '_id' in _]
+
+# Secondary indexes per object type, name -> function returning the index values of an object. The search fields
+# are indexed lower case, hostset by host set _id.
+DEFAULT_INDEXES = {
+	'host' : dict([(_, _field_values(_)) for _ in HOST_SEARCH_FIELDS], hostset = _hostset_values)
+}
+
+# In memory cache of the objects in ObjectCache, keyed by (profile_id, type, contentId).
+#
+# Records have the same shape as the ones returned by cacheGet. Entries expire after the TTL of their type, if one
+# is set, and the least recently used entries are evicted once the estimated size of the cached objects goes over
+# max_size bytes. A get for an object that isn't in memory, or expired, reads through to the database.
+#
+# Changes are written behind to the database in batches every flush_interval seconds, or sooner once flush_size
+# objects have pending changes. Unlike the task journal there is no journal file, anything lost in a crash is
+# fetched again from the controller. A batch stays visible to get() until it is in the database.
+#
+# The secondary indexes of a (profile_id, type) cover every object of it, in memory or not. They are built from the
+# database by the first find() and kept up to date by put, remove and drop, evicting an object leaves them alone.
+class hxtool_object_cache:
+	def __init__(self, db, max_size = 256 * 1024 * 1024, ttls = None, indexes = DEFAULT_INDEXES, flush_interval = 5, flush_size = 1000):
+		self._db = db
+		self.max_size = max_size
+		self.ttls = ttls or {}
+		self.indexes = indexes or {}
+		self.flush_interval = flush_interval
+		self.flush_size = flush_size
+		self._lock = threading.RLock()
+		self._flush_lock = threading.Lock()
+		# (profile_id, type, contentId) -> [record, expires, size], least recently used first
+		self._entries = OrderedDict()
+		# (profile_id, type, index name) -> {value : set of contentIds}
+		self._index_values = {}
+		# (profile_id, type) -> {contentId : [(index name, value)]}, for the (profile_id, type)s whose indexes are built
+		self._indexed = {}
+		# (profile_id, type, contentId) -> record, or None for a removal
+		self._pending = OrderedDict()
+		# The batch being written to the database
+		self._flushing = {}
+		# Counts the batches written, a record read from the database during a write may already be out of date
+		self._flushes = 0
+		self.size = 0
+		self._flush_event = threading.Event()
+		self._stop_event = threading.Event()
+		self._flush_thread = threading.Thread(target = self._flush_loop, name = "ObjectCacheThread")
+		self.stats = {
+			'hits' : 0,
+			'misses' : 0,
+			'expired' : 0,
+			'evictions' : 0,
+			'batches' : 0,
+			'objects_written' : 0
+		}
+
+	@staticmethod
+	def _record(profile_id, cacheType, contentId, data, create_timestamp = None):
+		now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+		return {
+			'profile_id' : profile_id,
+			'type' : cacheType,
+			'contentId' : contentId,
+			'create_timestamp' : create_timestamp or now,
+			'update_timestamp' : now,
+			'dirty' : False,
+			'data' : data
+		}
+
+	# Replaces the index values of an object, data is None for a removal. Must be called with self._lock held
+	def _index(self, key, data):
+		indexed = self._indexed.get(key[:2])
+		if indexed is None:
+			return
+		for name, value in indexed.pop(key[2], []):
+			index = self._index_values[(key[0], key[1], name)]
+			index[value].discard(key[2])
+			if not index[value]:
+				del index[value]
+		if data is None:
+			return
+		values = []
+		for name, f in self.indexes.get(key[1], {}).items():
+			try:
+				values.extend([(name, _) for _ in f(data)])
+			except Exception:
+				continue
+		for name, value in values:
+			self._index_values.setdefault((key[0], key[1], name), {}).setdefault(value, set()).add(key[2])
+		if values:
+			indexed[key[2]] = values
+
+	# Builds the indexes of a (profile_id, type) from the database and the changes that aren't written yet
+	def _build_indexes(self, profile_id, cacheType):
+		with self._flush_lock:
+			with self._lock:
+				if (profile_id, cacheType) in self._indexed:
+					return
+			records = self._db.cacheList(profile_id, cacheType)
+			with self._lock:
+				self._indexed[(profile_id, cacheType)] = {}
+				for record in records:
+					key = (profile_id, cacheType, record['contentId'])
+					if key not in self._pending:
+						self._index(key, record['data'])
+				for key, record in self._pending.items():
+					if key[:2] == (profile_id, cacheType) and record is not None:
+						self._index(key, record['data'])
+
+	# contentIds of the objects with value in the given index, or one that match(value) if match is given
+	def find(self, profile_id, cacheType, index, value = None, match = None):
+		if (profile_id, cacheType) not in self._indexed:
+			self._build_indexes(profile_id, cacheType)
+		with self._lock:
+			index_values = self._index_values.get((profile_id, cacheType, index), {})
+			if match is None:
+				return set(index_values.get(value, ()))
+			contentIds = set()
+			for v, ids in index_values.items():
+				if match(v):
+					contentIds.update(ids)
+			return contentIds
+
+	# Leaves the indexes alone, an evicted object is still in the database. Must be called with self._lock held
+	def _unlink(self, key):
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			self.size -= entry[2]
+		return entry
+
+	# Must be called with self._lock held
+	def _link(self, key, record):
+		self._unlink(key)
+		ttl = self.ttls.get(key[1])
+		size = len(json.dumps(record['data'], default = str))
+		self._entries[key] = [record, time.monotonic() + ttl if ttl else None, size]
+		self.size += size
+		self._index(key, record['data'])
+		while self.size > self.max_size and len(self._entries) > 1:
+			self._unlink(next(iter(self._entries)))
+			self.stats['evictions'] += 1
+
+	# The record of a change that isn't in the database yet, None for a removal. Must be called with self._lock held
+	def _unwritten(self, key):
+		if key in self._pending:
+			return self._pending[key]
+		return self._flushing.get(key)
+
+	# Returns None when the object isn't in memory or expired. Must be called with self._lock held
+	def _lookup(self, key):
+		entry = self._entries.get(key)
+		if entry is None:
+			return None
+		if entry[1] is not None and entry[1] <= time.monotonic():
+			self._unlink(key)
+			self.stats['expired'] += 1
+			return None
+		self._entries.move_to_end(key)
+		return entry[0]
+
+	def get(self, profile_id, cacheType, contentId):
+		key = (profile_id, cacheType, contentId)
+		with self._lock:
+			record = self._lookup(key)
+			if record is None:
+				record = self._unwritten(key)
+			if record:
+				self.stats['hits'] += 1
+				return record
+			self.stats['misses'] += 1
+			# Removed, but not from the database yet
+			if key in self._pending or key in self._flushing:
+				return False
+			flushes = self._flushes
+
+		record = self._db.cacheGet(profile_id, cacheType, contentId)
+		if record:
+			with self._lock:
+				if self._flushes == flushes and key not in self._entries and key not in self._pending and key not in self._flushing:
+					self._link(key, record)
+		return record
+
+	# Records of the given contentIds that are cached, in the same order. The ones that aren't in memory are read from
+	# the database in one go, and not kept in memory so that a walk over all objects doesn't evict the working set.
+	def get_many(self, profile_id, cacheType, contentIds):
+		records = {}
+		misses = []
+		with self._lock:
+			for contentId in contentIds:
+				key = (profile_id, cacheType, contentId)
+				record = self._lookup(key)
+				if record is None:
+					record = self._unwritten(key)
+				if record:
+					records[contentId] = record
+				elif key not in self._pending and key not in self._flushing:
+					misses.append(contentId)
+			self.stats['hits'] += len(records)
+			self.stats['misses'] += len(misses)
+
+		if misses:
+			for record in self._db.cacheGetMany(profile_id, cacheType, misses):
+				records[record['contentId']] = record
+		return [records[_] for _ in contentIds if _ in records]
+
+	def put(self, profile_id, cacheType, contentId, data):
+		self.put_many(profile_id, cacheType, [(contentId, data)])
+
+	# items is a list of (contentId, data)
+	def put_many(self, profile_id, cacheType, items):
+		with self._lock:
+			for contentId, data in items:
+				key = (profile_id, cacheType, contentId)
+				older = self._entries.get(key) or [self._unwritten(key)]
+				record = self._record(profile_id, cacheType, contentId, data, older[0]['create_timestamp'] if older[0] else None)
+				self._link(key, record)
+				self._pending.pop(key, None)
+				self._pending[key] = record
+			if len(self._pending) >= self.flush_size:
+				self._flush_event.set()
+
+	def remove(self, profile_id, cacheType, contentIds):
+		with self._lock:
+			for contentId in contentIds:
+				key = (profile_id, cacheType, contentId)
+				self._unlink(key)
+				self._index(key, None)
+				self._pending.pop(key, None)
+				self._pending[key] = None
+			if len(self._pending) >= self.flush_size:
+				self._flush_event.set()
+
+	# Drops the cached objects of a profile from memory and, right away, from the database
+	def drop(self, profile_id):
+		with self._flush_lock:
+			with self._lock:
+				for key in [_ for _ in self._entries if _[0] == profile_id]:
+					self._unlink(key)
+				for key in [_ for _ in self._pending if _[0] == profile_id]:
+					del self._pending[key]
+				for key in [_ for _ in self._indexed if _[0] == profile_id]:
+					del self._indexed[key]
+				for key in [_ for _ in self._index_values if _[0] == profile_id]:
+					del self._index_values[key]
+			return self._db.cacheDrop(profile_id)
+
+	def flush(self):
+		with self._flush_lock:
+			with self._lock:
+				if not self._pending:
+					return True
+				batch = self._pending
+				self._pending = OrderedDict()
+				self._flushing = batch
+
+			upserts = [_ for _ in batch.values() if _ is not None]
+			removes = [key for key, record in batch.items() if record is None]
+			try:
+				self._db.cacheWriteBatch(upserts = upserts, removes = removes)
+			except Exception as e:
+				logger.error("Failed to write {} cached objects to the database, will retry. Error: {}".format(len(batch), pretty_exceptions(e)))
+				# Anything that came in since is newer than the batch
+				with self._lock:
+					batch.update(self._pending)
+					self._pending = batch
+					self._flushing = {}
+				return False
+
+			with self._lock:
+				self._flushing = {}
+				self._flushes += 1
+			self.stats['batches'] += 1
+			self.stats['objects_written'] += len(batch)
+			logger.debug("Wrote {} cached objects to the database.".format(len(batch)))
+			return True
+
+	def _flush_loop(self):
+		while not self._stop_event.is_set():
+			self._flush_event.wait(self.flush_interval)
+			self._flush_event.clear()
+			self.flush()
+
+	def start(self):
+		self._flush_thread.start()
+
+	def stop(self):
+		self._stop_event.set()
+		self._flush_event.set()
+		if self._flush_thread.is_alive():
+			self._flush_thread.join()
+		self.flush()
+
+	def statistics(self):
+		with self._lock:
+			s = dict(self.stats)
+			s['entries'] = len(self._entries)
+			s['size'] = self.size
+			s['max_size'] = self.max_size
+			s['pending'] = len(self._pending)
+			s['indexed'] = sum([len(_) for _ in self._indexed.values()])
+		return s
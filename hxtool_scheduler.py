@@ -3,9 +3,15 @@
 
 import threading
 import datetime
+import time
+import heapq
+import itertools
+import signal
+import multiprocessing
+from collections import deque
 from argparse import Namespace
 from multiprocessing.pool import ThreadPool
-from multiprocessing import cpu_count, TimeoutError
+from multiprocessing import cpu_count
 
 import hxtool_logging
 import hxtool_global
@@ -26,51 +32,220 @@ except ImportError:
 
 MAX_HISTORY_QUEUE_LENGTH = 1000
 
+# The most tasks that may run at once against a single profile (HX controller)
+DEFAULT_PROFILE_THREAD_COUNT = 10
+
+# Relative share of a profile's threads given to each task class when they are all waiting
+DEFAULT_TASK_CLASS_WEIGHTS = {
+	'system' : 4,
+	'user' : 2,
+	'child' : 1
+}
+
+# System tasks (API logins, session reaper, cache fetchers) are immutable, fan-out tasks such as
+# per-host bulk downloads have a parent, everything else was submitted by a user.
+def task_class(task):
+	if task.immutable:
+		return 'system'
+	elif task.parent_id:
+		return 'child'
+	return 'user'
+
+# Process pool workers leave SIGINT to the main process, which stops the scheduler
+def _process_pool_initializer():
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
 TASK_API_KEY = 'Z\\U+z$B*?AiV^Fr~agyEXL@R[vSTJ%N&'.encode(default_encoding)
 
-# Note: scheduler resolution is a little less than a second
+# Tasks are dispatched from a heap keyed on next_run, the dispatch thread sleeps until the earliest deadline
 class hxtool_scheduler:
-	def __init__(self, thread_count = None):
+	def __init__(self, thread_count = None, process_count = None, profile_thread_count = None, task_class_weights = None, task_leases = None):
 		self._lock = threading.Lock()
+		# Signalled whenever the earliest deadline in the run queue may have changed
+		self._run_queue_event = threading.Condition(self._lock)
+		# Min-heap of (next_run, sequence, task) entries, stale entries are discarded lazily
+		self._run_queue = []
+		self._run_queue_sequence = itertools.count()
+		# Tasks that were woken while queued or running, they run again as soon as they are rescheduled
+		self._pending_wakeups = set()
 		self.task_queue = {}
 		self.history_queue = {}
+		# parent task_id -> set of child task_ids, for the task queue and the history queue
+		self._children = {}
+		self._history_children = {}
 		self.task_hx_api_sessions = {}
-		self._poll_thread = threading.Thread(target = self._scan_task_queue, name = "PollThread")
+		self._dispatch_thread = threading.Thread(target = self._dispatch, name = "DispatchThread")
 		self._stop_event = threading.Event()
+		# Task modules that opt in run their CPU bound work here, 0 disables the process pool.
+		# By now the database client, journal, lease and cache threads are running, so the workers come from a fork
+		# server (or are spawned where there is none) rather than being forked from this process.
+		self.process_count = cpu_count() if process_count is None else process_count
+		self.process_pool = None
+		if self.process_count > 0:
+			start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+			self.process_pool = multiprocessing.get_context(start_method).Pool(self.process_count, initializer = _process_pool_initializer)
 		# Allow for thread oversubscription based on CPU count
 		self.thread_count = thread_count or (cpu_count() + 1)
 		self.task_threads = ThreadPool(self.thread_count)
+		# Due tasks wait here, per profile and task class, until a thread is free and the profile is under its cap
+		self.profile_thread_count = min(profile_thread_count or DEFAULT_PROFILE_THREAD_COUNT, self.thread_count)
+		self.task_class_weights = dict(DEFAULT_TASK_CLASS_WEIGHTS, **(task_class_weights or {}))
+		self._ready_queues = {}
+		self._ready_profiles = deque()
+		self._ready_credits = {}
+		self._in_flight = {}
+		self._in_flight_total = 0
+		# hxtool_task_lease when several HXTool instances share the saved tasks, stored tasks must be claimed before they run
+		self.task_leases = task_leases
 		logger.info("Task scheduler initialized.")
 
-	def _scan_task_queue(self):
-		while not self._stop_event.wait(.1):
-			ret = None
-			with self._lock:
-				ret = self.task_threads.imap_unordered(self._run_task, [_ for _ in self.task_queue.values() if _.should_run()])
-			if ret:
-				while not self._stop_event.is_set():
-					try:
-						ret.next(timeout=5)
-					except TimeoutError:
-						break
-					except StopIteration:
+	# Must be called with self._lock held
+	def _schedule(self, task):
+		if task.next_run is not None and task.state == task_states.TASK_STATE_SCHEDULED:
+			heapq.heappush(self._run_queue, (task.next_run, next(self._run_queue_sequence), task))
+			if self._run_queue[0][2] is task:
+				self._run_queue_event.notify()
+	
+	# Must be called with self._lock held
+	def _enqueue_ready(self, task):
+		profile_queues = self._ready_queues.get(task.profile_id, None)
+		if profile_queues is None:
+			profile_queues = self._ready_queues[task.profile_id] = {}
+			self._ready_profiles.append(task.profile_id)
+		profile_queues.setdefault(task_class(task), deque()).append(task)
+	
+	# Weighted round robin between the task classes of a single profile. Must be called with self._lock held
+	def _dequeue_ready(self, profile_id):
+		profile_queues = self._ready_queues[profile_id]
+		credits = self._ready_credits.setdefault(profile_id, {})
+		while True:
+			waiting = [_ for _ in profile_queues if profile_queues[_]]
+			if not waiting:
+				del self._ready_queues[profile_id]
+				self._ready_credits.pop(profile_id, None)
+				self._ready_profiles.remove(profile_id)
+				return None
+			eligible = [_ for _ in waiting if credits.get(_, 0) > 0]
+			if not eligible:
+				for c in waiting:
+					credits[c] = credits.get(c, 0) + self.task_class_weights.get(c, 1)
+				continue
+			c = max(eligible, key = lambda _: credits[_])
+			task = profile_queues[c].popleft()
+			# Removed or stopped while it was waiting for a thread
+			if self.task_queue.get(task.task_id) is not task or task.state != task_states.TASK_STATE_QUEUED:
+				continue
+			credits[c] -= 1
+			return task
+	
+	# Round robin between profiles that are under their cap. Must be called with self._lock held
+	def _dispatch_ready(self):
+		while self._in_flight_total < self.thread_count and self._ready_profiles:
+			task = None
+			for _ in range(len(self._ready_profiles)):
+				profile_id = self._ready_profiles[0]
+				self._ready_profiles.rotate(-1)
+				if self._in_flight.get(profile_id, 0) < self.profile_thread_count:
+					task = self._dequeue_ready(profile_id)
+					if task:
 						break
-					except Exception as e:
-						logger.error(pretty_exceptions(e))
+			if task is None:
+				return
+			self._in_flight[task.profile_id] = self._in_flight.get(task.profile_id, 0) + 1
+			self._in_flight_total += 1
+			self.task_threads.apply_async(self._run_task, (task,))
+	
+	def _dispatch(self):
+		with self._lock:
+			while not self._stop_event.is_set():
+				now = datetime.datetime.utcnow()
+				while self._run_queue and self._run_queue[0][0] <= now:
+					(next_run, _, task) = heapq.heappop(self._run_queue)
+					# Skip entries for tasks that have been removed, rescheduled or already dispatched
+					if self.task_queue.get(task.task_id) is not task or not task.should_run():
 						continue
-					
+					task.set_state(task_states.TASK_STATE_QUEUED)
+					self._enqueue_ready(task)
+				
+				self._dispatch_ready()
+				
+				if self._run_queue:
+					self._run_queue_event.wait((self._run_queue[0][0] - datetime.datetime.utcnow()).total_seconds())
+				else:
+					self._run_queue_event.wait()
+	
 	def _run_task(self, task):
 		ret = False
 		task.set_state(task_states.TASK_STATE_QUEUED)
 		logger.debug("Executing task with id: %s, name: %s.", task.task_id, task.name)
+		run_key = None
 		try:
+			# Immutable tasks are never stored, every instance runs its own
+			if self.task_leases is not None and not task.immutable:
+				run_key = HXAPI.dt_to_str(task.next_run) if task.next_run else ''
+				(claimed, lease) = self.task_leases.claim(task, run_key)
+				if not claimed:
+					run_key = None
+					self._leased_elsewhere(task, lease)
+					return ret
 			ret = task.run(self)
 		except Exception as e:
 			logger.error(pretty_exceptions(e))
 			task.set_state(task_states.TASK_STATE_FAILED)
 		finally:
+			if run_key is not None:
+				try:
+					self.task_leases.release(task, run_key)
+				except Exception as e:
+					logger.error("Failed to release the lease for task {}. Error: {}".format(task.task_id, pretty_exceptions(e)))
+			# Recurring and deferred tasks come back around with a new next_run
+			with self._lock:
+				self._in_flight[task.profile_id] -= 1
+				self._in_flight_total -= 1
+				# A thread is free, let the dispatcher hand it to the next waiting task
+				self._run_queue_event.notify()
+				if task.task_id in self._pending_wakeups:
+					self._pending_wakeups.discard(task.task_id)
+					if task.next_run:
+						task.next_run = min(task.next_run, datetime.datetime.utcnow())
+				if self.task_queue.get(task.task_id) is task:
+					self._schedule(task)
 			return ret
 			
+	# Another instance claimed this run of the task, follow along with what it did
+	def _leased_elsewhere(self, task, lease):
+		lease = lease or {}
+		if lease.get('done'):
+			if lease.get('next_run'):
+				task.next_run = HXAPI.dt_from_str(lease['next_run'])
+			else:
+				# Finished, the instance that ran it has taken care of the database and its children
+				logger.debug("Task %s was completed by %s.", task.task_id, lease.get('owner'))
+				with self._lock:
+					self._forget(task.task_id)
+		else:
+			# Check back once the lease has expired in case the other instance went away
+			task.next_run = max(datetime.datetime.utcfromtimestamp(lease.get('expires', 0)), datetime.datetime.utcnow()) + datetime.timedelta(seconds = 1)
+		task.set_state(task_states.TASK_STATE_SCHEDULED)
+	
+	# Drop a task and its children from this instance only. Must be called with self._lock held
+	def _forget(self, task_id):
+		for child_task_id in list(self._children.pop(task_id, ())):
+			self._forget(child_task_id)
+		t = self.task_queue.pop(task_id, None)
+		if t is not None:
+			self._unindex_child(self._children, t.parent_id, task_id)
+	
+	# The background API session of a profile is shared by every task the profile can have running, each of which
+	# may download in DOWNLOAD_SEGMENTS parallel ranges or prefetch the next page of a list, and by the API cache:
+	# its fetchers run as System tasks, outside the profile cap, next to the sysinfo threads.
+	def _task_api_pool_size(self):
+		pool_size = self.profile_thread_count * max(2, HXAPI.DOWNLOAD_SEGMENTS)
+		apicache = hxtool_global.hxtool_config['apicache'] or {}
+		if apicache.get('enabled', False):
+			pool_size += 2 * len(apicache.get('types', [])) + apicache.get('sysinfo_concurrency', 4)
+		return pool_size
+	
 	def _add_task_api_task(self, profile_id, hx_host, hx_port, username, password):
 		self.task_hx_api_sessions[profile_id] = HXAPI(hx_host,
 														hx_port = hx_port, 
@@ -78,7 +253,10 @@ class hxtool_scheduler:
 														headers = hxtool_global.hxtool_config['headers'], 
 														cookies = hxtool_global.hxtool_config['cookies'], 
 														logger_name = hxtool_logging.getLoggerName(HXAPI.__name__), 
-														default_encoding = default_encoding)
+														default_encoding = default_encoding,
+														pool_size = self._task_api_pool_size(),
+														pool_timeout = hxtool_global.hxtool_config['network'].get('api_pool_timeout', 60),
+														background = True)
 		api_login_task = hxtool_scheduler_task(profile_id, "Task API Login - {}".format(hx_host), immutable = True)
 		api_login_task.add_step(task_api_session_module, kwargs = {
 									'profile_id' : profile_id,
@@ -88,16 +266,24 @@ class hxtool_scheduler:
 		self.add(api_login_task)
 	
 	def start(self):
-		self._poll_thread.start()
-		logger.info("Task scheduler started with %s threads.", self.thread_count)
+		self._dispatch_thread.start()
+		logger.info("Task scheduler started with %s threads and %s processes.", self.thread_count, self.process_count)
 		
 	def stop(self):
 		logger.debug("stop() enter.")
 		self._stop_event.set()
+		with self._lock:
+			self._run_queue_event.notify()
+		if self._dispatch_thread.is_alive():
+			self._dispatch_thread.join()
 		logger.debug("Closing the task thread pool.")
 		self.task_threads.close()
 		logger.debug("Waiting for running threads to terminate.")
 		self.task_threads.join()
+		if self.process_pool is not None:
+			logger.debug("Closing the task process pool.")
+			self.process_pool.close()
+			self.process_pool.join()
 		logger.debug("stop() exit.")
 
 	def initialize_task_api_sessions(self):
@@ -151,45 +337,95 @@ class hxtool_scheduler:
 				hx_api_object.restLogout()
 				hx_api_object = None
 	
+	# Must be called with self._lock held
+	def _index_child(self, index, parent_id, task_id):
+		if parent_id:
+			index.setdefault(parent_id, set()).add(task_id)
+	
+	# Must be called with self._lock held
+	def _unindex_child(self, index, parent_id, task_id):
+		children = index.get(parent_id, None)
+		if children is not None:
+			children.discard(task_id)
+			if not children:
+				del index[parent_id]
+	
 	def signal_child_tasks(self, parent_task_id, parent_task_state, parent_stored_result):
 		with self._lock:
-			for task_id in self.task_queue:
-				self.task_queue[task_id].parent_state_callback(parent_task_id, parent_task_state, parent_stored_result)
+			self._signal_child_tasks(parent_task_id, parent_task_state, parent_stored_result)
+	
+	# Must be called with self._lock held
+	def _signal_child_tasks(self, parent_task_id, parent_task_state, parent_stored_result):
+		for task_id in list(self._children.get(parent_task_id, ())):
+			t = self.task_queue[task_id]
+			t.parent_state_callback(parent_task_id, parent_task_state, parent_stored_result)
+			self._schedule(t)
+			# Stopping or failing cascades down the whole subtree
+			if parent_task_state in (task_states.TASK_STATE_STOPPED, task_states.TASK_STATE_FAILED):
+				self._signal_child_tasks(task_id, parent_task_state, parent_stored_result)
+	
+	# Bring a deferred task forward so it runs now rather than when its defer interval expires
+	def wake(self, task_id):
+		with self._lock:
+			t = self.task_queue.get(task_id, None)
+			if t is None:
+				return False
+			if t.state == task_states.TASK_STATE_SCHEDULED:
+				now = datetime.datetime.utcnow()
+				if t.next_run and t.next_run > now:
+					t.next_run = now
+					self._schedule(t)
+			elif t.state in (task_states.TASK_STATE_QUEUED, task_states.TASK_STATE_RUNNING):
+				self._pending_wakeups.add(task_id)
+			return True
 	
 	def add(self, task, should_store = True):
 		with self._lock:
 			self.task_queue[task.task_id] = task
+			self._index_child(self._children, task.parent_id, task.task_id)
 			task.set_state(task_states.TASK_STATE_SCHEDULED)
 			# Note: this must be within the lock otherwise we run into a nasty race condition where the task runs before the stored state is set -
 			# with the run lock taking precedence.
 			if should_store:
 				task.store()
+			self._schedule(task)
 		return task.task_id	
 		
 	def add_list(self, tasks):
 		if isinstance(tasks, list):
 			for t in tasks:
 				self.add(t)
+	
+	# Must be called with self._lock held
+	def _remove_children(self, task_id):
+		for child_task_id in list(self._children.pop(task_id, ())):
+			self._remove_children(child_task_id)
+			t = self.task_queue.pop(child_task_id, None)
+			if t is not None:
+				t.remove()
+		
+		for child_task_id in list(self._history_children.pop(task_id, ())):
+			self._remove_children(child_task_id)
+			self.history_queue.pop(child_task_id, None)
 		
 	def remove(self, task_id, delete_children=True):
 		if task_id:
 			with self._lock:
 				if delete_children:
-					# We need to make a shallow copy so we don't modify the task_queue while iterating over it
-					for child_task_id in [_.task_id for _ in self.task_queue.values() if _.parent_id == task_id]:
-						self.task_queue[child_task_id].remove()
-						del self.task_queue[child_task_id]
-							
-					for child_task_id in [_['task_id'] for _ in self.history_queue.values() if _['parent_id'] == task_id]:
-						del self.history_queue[child_task_id]
+					self._remove_children(task_id)
 							
 				t = self.task_queue.get(task_id, None)
 				if t and not t.immutable:
 					t.remove()
 					del self.task_queue[task_id]
+					self._unindex_child(self._children, t.parent_id, task_id)
 					t = None
 				elif task_id in self.history_queue:
-					del self.history_queue[task_id]
+					h = self.history_queue.pop(task_id)
+					self._unindex_child(self._history_children, h['parent_id'], task_id)
+				
+				# Wake the dispatcher so it can drop the stale run queue entries
+				self._run_queue_event.notify()
 				
 	def get(self, task_id):
 		with self._lock:
@@ -199,9 +435,17 @@ class hxtool_scheduler:
 		with self._lock:
 			t = self.task_queue.pop(task_id, None)
 			if t is not None:
+				self._unindex_child(self._children, t.parent_id, task_id)
 				self.history_queue[task_id] = t.metadata()
-		if len(self.history_queue) > MAX_HISTORY_QUEUE_LENGTH:
-			self.history_queue.popitem()
+				self._index_child(self._history_children, t.parent_id, task_id)
+			if len(self.history_queue) > MAX_HISTORY_QUEUE_LENGTH:
+				(h_task_id, h) = self.history_queue.popitem()
+				self._unindex_child(self._history_children, h['parent_id'], h_task_id)
+	
+	# Returns the task_ids of the direct children of a task, both queued and in the history
+	def children(self, task_id):
+		with self._lock:
+			return list(self._children.get(task_id, ())) + list(self._history_children.get(task_id, ()))
 	
 	def tasks(self):
 		# Shallow copy to avoid locking
@@ -211,22 +455,65 @@ class hxtool_scheduler:
 	def load_from_database(self):
 		try:
 			if self.status():
+				start = time.time()
 				tasks = hxtool_global.hxtool_db.taskList()
+				profile_names = { _.get('profile_id') : _.get('hx_name') for _ in hxtool_global.hxtool_db.profileList() }
+				task_ids = set([_['task_id'] for _ in tasks])
+				orphans = []
+				loaded = []
 				for task_entry in tasks:
 					p_id = task_entry.get('parent_id', None)
-					if p_id and (not task_entry['parent_complete'] and not hxtool_global.hxtool_db.taskGet(task_entry['profile_id'], p_id)):
+					if p_id and (not task_entry['parent_complete'] and p_id not in task_ids):
 						logger.warn("Deleting orphan task {}, {}".format(task_entry['name'], task_entry['task_id']))
-						hxtool_global.hxtool_db.taskDelete(task_entry['profile_id'], task_entry['task_id'])
-					else:
-						task = hxtool_scheduler_task.deserialize(task_entry)
-						task.set_stored()
-						# Set should_store to False as we've already been stored, and we skip a needless update
-						self.add(task, should_store = False)
+						orphans.append((task_entry['profile_id'], task_entry['task_id']))
+						continue
+					try:
+						task = hxtool_scheduler_task.deserialize(task_entry, profile_name = profile_names.get(task_entry['profile_id'], "Unknown"))
+					except Exception as e:
+						logger.error("Failed to load saved task {}, {}. Error: {}".format(task_entry['name'], task_entry['task_id'], pretty_exceptions(e)))
+						continue
+					task.set_stored()
+					loaded.append(task)
+				
+				if orphans:
+					hxtool_global.hxtool_db.taskWriteBatch(deletes = orphans)
+				
+				# We've already been stored, so skip a needless update, and take the lock once for the whole lot
+				with self._lock:
+					for task in loaded:
+						self.task_queue[task.task_id] = task
+						self._index_child(self._children, task.parent_id, task.task_id)
+						task.set_state(task_states.TASK_STATE_SCHEDULED)
+						self._schedule(task)
+				
+				logger.info("Loaded {} saved tasks and deleted {} orphans in {:.2f} seconds.".format(len(loaded), len(orphans), time.time() - start))
 			else:
 				logger.warn("Task scheduler must be running before loading queued tasks from the database.")
 		except Exception as e:
 			logger.error("Failed to load saved tasks from the database. Error: {}".format(pretty_exceptions(e)))
 	
+	# Live per-profile view of the scheduler for tuning the thread counts
+	def queue_stats(self):
+		with self._lock:
+			stats = {
+				'thread_count' : self.thread_count,
+				'profile_thread_count' : self.profile_thread_count,
+				'in_flight' : self._in_flight_total,
+				'profiles' : {}
+			}
+			for profile_id in set(self._in_flight) | set(self._ready_queues):
+				stats['profiles'][profile_id] = {
+					'in_flight' : self._in_flight.get(profile_id, 0),
+					'queued' : { c : len(q) for c, q in self._ready_queues.get(profile_id, {}).items() }
+				}
+			for profile_id, hx_api_object in list(self.task_hx_api_sessions.items()):
+				api_pool = hx_api_object.pool_stats()
+				if api_pool:
+					stats['profiles'].setdefault(profile_id, {'in_flight' : 0, 'queued' : {}})['api_pool'] = api_pool
+			if self.task_leases is not None:
+				stats['leases'] = dict(self.task_leases.stats, owner = self.task_leases.owner)
+			return stats
+	
 	def status(self):
-		return self._poll_thread.is_alive()
+		return self._dispatch_thread.is_alive()
 		
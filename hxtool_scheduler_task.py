@@ -7,10 +7,9 @@ import random
 
 import hxtool_logging
 import hxtool_global
-# TODO: figure out how to remove this, need to remove the eval() from deserialize
 import hxtool_task_modules
 from hxtool_util import secure_uuid4
-from hx_lib import HXAPI
+from hx_lib import HXAPI, HXAPITracer
 
 logger = hxtool_logging.getLogger(__name__)
 
@@ -34,10 +33,29 @@ class task_states(object):
 	}
 		
 
+_task_module_registry = None
+
+# Maps the module names we serialize steps with to the task module classes in hxtool_task_modules
+def task_module_registry():
+	global _task_module_registry
+	if _task_module_registry is None:
+		_task_module_registry = { m.__module__ : m for m in vars(hxtool_task_modules).values() if isinstance(m, type) and hasattr(m, 'hxtool_task_module') }
+	return _task_module_registry
+
+# Tasks share a fixed set of locks rather than carrying one each, the locks are reentrant as
+# a task can end up taking the lock of another task in the same stripe, i.e. its parent.
+TASK_LOCK_STRIPES = 64
+_task_locks = [threading.RLock() for _ in range(TASK_LOCK_STRIPES)]
+
 class hxtool_scheduler_task:
-	def __init__(self, profile_id, name, task_id = None, start_time = None, end_time = None, next_run = None, enabled = True, immutable = False, stop_on_fail = True, parent_id = None, wait_for_parent = True, defer_interval = 30):
+	# Large fan-out jobs queue a task per host, so keep tasks small
+	__slots__ = ('profile_id', 'profile_name', 'task_id', 'parent_id', 'scheduler', 'wait_for_parent', 'parent_complete',
+				'name', 'enabled', 'immutable', 'state', 'last_run_state', 'schedule', 'start_time', 'end_time', 'last_run',
+				'next_run', 'stop_on_fail', 'steps', 'stored_result', 'defer_interval', '_modules', '_stored', '_stop_signal',
+				'_defer_signal', '_pending_deletion_signal', '_metadata')
+	
+	def __init__(self, profile_id, name, task_id = None, start_time = None, end_time = None, next_run = None, enabled = True, immutable = False, stop_on_fail = True, parent_id = None, wait_for_parent = True, defer_interval = 30, profile_name = None):
 		
-		self._lock = threading.Lock()
 		self.profile_id = profile_id
 		self.profile_name = "Unknown"
 		self.task_id = task_id or str(secure_uuid4())
@@ -50,7 +68,8 @@ class hxtool_scheduler_task:
 		self.immutable = immutable
 		self.state = None
 		self.last_run_state = None
-		self.schedule = {}
+		# None until set_schedule() is called, most tasks only run once
+		self.schedule = None
 		self.start_time = start_time or datetime.datetime.utcnow().replace(microsecond=1)
 		self.end_time = end_time
 		self.last_run = None
@@ -59,17 +78,28 @@ class hxtool_scheduler_task:
 		else:
 			self.next_run = next_run or self.start_time
 		self.stop_on_fail = stop_on_fail
-		self.steps = []
+		# Step definitions, (module, func, args, kwargs), and the module instances once the task has run
+		self.steps = ()
+		self._modules = None
 		self.stored_result = {}
 		self.defer_interval = defer_interval
 		
 		self._stored = False
 		self._stop_signal = False
 		self._defer_signal = False
+		self._pending_deletion_signal = False
+		self._metadata = None
 		
-		profile = hxtool_global.hxtool_db.profileGet(self.profile_id)
-		if profile is not None:
-			self.profile_name = profile['hx_name']
+		if profile_name is not None:
+			self.profile_name = profile_name
+		else:
+			profile = hxtool_global.hxtool_db.profileGet(self.profile_id)
+			if profile is not None:
+				self.profile_name = profile['hx_name']
+
+	@property
+	def _lock(self):
+		return _task_locks[hash(self.task_id) % TASK_LOCK_STRIPES]
 
 	def _calculate_next_run(self):
 		self.next_run = None
@@ -118,12 +148,12 @@ class hxtool_scheduler_task:
 				(self.parent_complete if self.parent_id is not None and self.wait_for_parent else True)
 		)
 
+	# HXTool task modules are added as their class and only instantiated when the task first runs.
+	# args and kwargs are never modified so steps can share them.
 	def add_step(self, module, func = "run", args = (), kwargs = {}):
-		# This is an HXTool task module, we need to init it.
-		if hasattr(module, 'hxtool_task_module'):
-			module = module(self)
 		with self._lock:
-			self.steps.append((module, func, args, kwargs))
+			self.steps += ((module, func, args, kwargs),)
+			self._modules = None
 		
 	# Use this to set state, its thread-safe
 	def set_state(self, state):
@@ -135,15 +165,14 @@ class hxtool_scheduler_task:
 			self._stored = stored
 		
 	def run(self, scheduler):
-		self._stop_signal = False
-		self._defer_signal = False
-		self._pending_deletion_signal = False
 		ret = False
 		
-		if self.enabled:
-			
-			with self._lock:
-				
+		with self._lock:
+			self._stop_signal = False
+			self._defer_signal = False
+			self._pending_deletion_signal = False
+			enabled = self.enabled
+			if enabled:
 				self.state = task_states.TASK_STATE_RUNNING
 				
 				self.scheduler = scheduler
@@ -152,59 +181,75 @@ class hxtool_scheduler_task:
 				self.last_run = datetime.datetime.utcnow().replace(microsecond=1)
 				# Clear this, otherwise the task view looks confusing
 				self.next_run = None
+		
+		if enabled:
+			# The steps run without holding the task lock, the lock is shared with other tasks
+			if self._modules is None:
+				# This is an HXTool task module, we need to init it.
+				self._modules = [m(self) if isinstance(m, type) and hasattr(m, 'hxtool_task_module') else m for m, f, a, ka in self.steps]
+			
+			for module, (m, func, args, kwargs) in zip(self._modules, self.steps):
+				kwargs = dict(kwargs)
 				
-				for module, func, args, kwargs in self.steps:
-					logger.debug("Have module: {}, function: {}".format(module.__module__, func))
-					if getattr(module, 'hxtool_task_module', lambda: False)():
-						if module.enabled == False:
-							logger.error("Module {} is disabled!".format(module.__module__))
-							ret = False
-							self.state = task_states.TASK_STATE_FAILED
-							break
-							
-						for arg_i in module.input_args():
-							if not kwargs.get(arg_i['name'], None):
-								if arg_i['name'] in self.stored_result.keys():
-									kwargs[arg_i['name']] = self.stored_result[arg_i['name']]
-								elif arg_i['required']:
-									logger.error("Module {} requires argument {} that was not found! Bailing!".format(module.__module__, arg_i['name']))
-									ret = False
-									self.state = task_states.TASK_STATE_FAILED
-									break
-					if self.state != task_states.TASK_STATE_FAILED:
-						logger.debug("Begin execute {}.{}".format(module.__module__, func))
-						result = getattr(module, func)(*args, **kwargs)
-						logger.debug("End execute {}.{}".format(module.__module__, func))
-						if isinstance(result, tuple) and len(result) > 1:
-							ret = result[0]
-							# Store the result - make sure it is of type dict
-							if isinstance(result[1], dict):
-								# Use update so we don't clobber existing values
-								self.stored_result.update(result[1])
-							elif result[1] is not None:
-								logger.error("Task module {} returned a value that was not a dictionary or None. Discarding the result.".format(module.__module__))
-						else:
-							ret = result
-					
-					
-					if self._defer_signal:
-						break
-					elif self._stop_signal:
-						self.state = task_states.TASK_STATE_STOPPED
-						break
-					elif self._pending_deletion_signal:
-						self.state = task_states.TASK_STATE_PENDING_DELETION
-						break
-					elif not ret and self.stop_on_fail:
+				logger.debug("Have module: {}, function: {}".format(module.__module__, func))
+				if getattr(module, 'hxtool_task_module', lambda: False)():
+					if module.enabled == False:
+						logger.error("Module {} is disabled!".format(module.__module__))
+						ret = False
 						self.state = task_states.TASK_STATE_FAILED
 						break
+						
+					for arg_i in module.input_args():
+						if not kwargs.get(arg_i['name'], None):
+							if arg_i['name'] in self.stored_result.keys():
+								kwargs[arg_i['name']] = self.stored_result[arg_i['name']]
+							elif arg_i['required']:
+								logger.error("Module {} requires argument {} that was not found! Bailing!".format(module.__module__, arg_i['name']))
+								ret = False
+								self.state = task_states.TASK_STATE_FAILED
+								break
+				if self.state != task_states.TASK_STATE_FAILED:
+					logger.debug("Begin execute {}.{}".format(module.__module__, func))
+					if HXAPI.tracer is not None:
+						HXAPITracer.set_context(self.profile_id, type(module).__name__)
+					try:
+						result = getattr(module, func)(*args, **kwargs)
+					finally:
+						HXAPITracer.clear_context()
+					logger.debug("End execute {}.{}".format(module.__module__, func))
+					if isinstance(result, tuple) and len(result) > 1:
+						ret = result[0]
+						# Store the result - make sure it is of type dict
+						if isinstance(result[1], dict):
+							# Use update so we don't clobber existing values
+							self.stored_result.update(result[1])
+						elif result[1] is not None:
+							logger.error("Task module {} returned a value that was not a dictionary or None. Discarding the result.".format(module.__module__))
+					else:
+						ret = result
 				
+				
+				if self._defer_signal:
+					break
+				elif self._stop_signal:
+					self.state = task_states.TASK_STATE_STOPPED
+					break
+				elif self._pending_deletion_signal:
+					self.state = task_states.TASK_STATE_PENDING_DELETION
+					break
+				elif not ret and self.stop_on_fail:
+					self.state = task_states.TASK_STATE_FAILED
+					break
+			
+			with self._lock:
 				if self.state < task_states.TASK_STATE_STOPPED:
 					self.state = task_states.TASK_STATE_COMPLETE
-				
-				if not self.parent_id:
-					scheduler.signal_child_tasks(self.task_id, self.state, self.stored_result)
-				
+			
+			# Outside the task lock, signalling takes the scheduler lock
+			if not self.parent_id:
+				scheduler.signal_child_tasks(self.task_id, self.state, self.stored_result)
+			
+			with self._lock:
 				self._calculate_next_run()
 				
 				if self.next_run:
@@ -263,20 +308,31 @@ class hxtool_scheduler_task:
 			self.set_state(task_states.TASK_STATE_PENDING_DELETION)
 			self.unstore()
 			
+	# Task state goes through the write-behind task journal when it is enabled
+	@staticmethod
+	def _task_db():
+		return getattr(hxtool_global, 'hxtool_task_journal', None) or hxtool_global.hxtool_db
+	
 	def store(self):
 		if not (self.immutable or self._stored):
-			hxtool_global.hxtool_db.taskCreate(self.serialize())
+			self._task_db().taskCreate(self.serialize())
 			self.set_stored()
 		elif self._stored:
-			hxtool_global.hxtool_db.taskUpdate(self.profile_id, self.task_id, self.serialize())
+			self._task_db().taskUpdate(self.profile_id, self.task_id, self.serialize())
 	
 	def unstore(self):
 		logger.debug("Deleting task_id = {} from DB".format(self.task_id))
-		hxtool_global.hxtool_db.taskDelete(self.profile_id, self.task_id)
+		self._task_db().taskDelete(self.profile_id, self.task_id)
 		self.set_stored(stored = False)
 	
+	# The task list is polled by the UI, only rebuild the metadata when something it shows has changed
 	def metadata(self):
-		return self.serialize(include_module_data = False)
+		key = (self.name, self.profile_name, self.enabled, self.state, self.last_run_state, self.last_run, self.next_run, self.parent_complete, self.schedule)
+		cached = self._metadata
+		if cached is None or cached[0] != key:
+			cached = (key, self.serialize(include_module_data = False))
+			self._metadata = cached
+		return cached[1]
 		
 	def serialize(self, include_module_data = True):
 		r = {
@@ -312,7 +368,7 @@ class hxtool_scheduler_task:
 		return r	
 	
 	@staticmethod	
-	def deserialize(d):
+	def deserialize(d, profile_name = None):
 		task = hxtool_scheduler_task(d['profile_id'],
 									d['name'],
 									task_id = d['task_id'],
@@ -324,18 +380,20 @@ class hxtool_scheduler_task:
 									enabled = d['enabled'],
 									immutable = d['immutable'],
 									stop_on_fail = d['stop_on_fail'],
-									defer_interval = d['defer_interval'])
+									defer_interval = d['defer_interval'],
+									profile_name = profile_name)
 		task.last_run = HXAPI.dt_from_str(d['last_run']) if d['last_run'] else None
 		task.parent_complete = d.get('parent_complete', False)
 		task.last_run_state = d.get('last_run_state', None)							
 		task.state = d.get('state')
 		schedule = d.get('schedule', None)
-		if schedule is dict:
+		# next_run is restored above, so only the interval is needed here
+		if schedule:
 			task.set_schedule(**schedule)
-			task._calculate_next_run()
 		for s in d['steps']:
-			# I hate this
-			step_module = eval(s['module'])
+			step_module = task_module_registry().get(s['module'], None)
+			if step_module is None:
+				raise ValueError("Task {} uses unknown task module {}.".format(d['task_id'], s['module']))
 			task.add_step(step_module, s['function'], s['args'], s['kwargs'])
 		return task
 									
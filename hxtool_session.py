@@ -8,14 +8,97 @@ import hmac
 import hashlib
 import threading
 import datetime
+from collections import OrderedDict
 
 import hxtool_global
 import hxtool_logging
 from hx_lib import *
 from hxtool_scheduler_task import hxtool_scheduler_task
+from hxtool_util import secure_uuid4
 
 logger = hxtool_logging.getLogger(__name__)
 
+# Sessions that haven't changed are written back to the database at most this often, to keep update_timestamp fresh for the reaper
+SESSION_SAVE_INTERVAL = datetime.timedelta(minutes=5)
+
+# Live HXAPI objects of the users logged in to this process. Requests reuse the object, and with it the keep-alive
+# connections of its requests session, rather than unpickling a new one from the session every time. The user's
+# session only holds the registry key and HXAPI.session_state(), which is enough to rebuild the object after a
+# restart or in another worker process.
+class hxtool_api_session_registry:
+	# api_kwargs are passed to HXAPI when rebuilding an object, idle_timeout is in minutes
+	def __init__(self, api_kwargs = None, max_size = 256, idle_timeout = 30):
+		self._api_kwargs = api_kwargs or {}
+		self.max_size = max_size
+		self.idle_timeout = datetime.timedelta(minutes=idle_timeout)
+		self._lock = threading.Lock()
+		# key -> [hx_api_object, lock, last_access], least recently used first
+		self._entries = OrderedDict()
+		self.stats = {
+			'hits' : 0,
+			'rebuilt' : 0,
+			'evicted' : 0
+		}
+	
+	# Must be called with self._lock held
+	def _evict(self):
+		while len(self._entries) > self.max_size:
+			self._entries.popitem(last=False)
+			self.stats['evicted'] += 1
+		now = datetime.datetime.utcnow()
+		while self._entries:
+			(key, entry) = next(iter(self._entries.items()))
+			if now - entry[2] < self.idle_timeout:
+				break
+			del self._entries[key]
+			self.stats['evicted'] += 1
+	
+	def add(self, hx_api_object):
+		key = str(secure_uuid4())
+		with self._lock:
+			self._entries[key] = [hx_api_object, threading.Lock(), datetime.datetime.utcnow()]
+			self._evict()
+		return key
+	
+	def _entry(self, key, state):
+		with self._lock:
+			entry = self._entries.get(key, None)
+			if entry is not None:
+				self._entries.move_to_end(key)
+				entry[2] = datetime.datetime.utcnow()
+				self.stats['hits'] += 1
+			elif state:
+				entry = [HXAPI.from_session_state(state, **self._api_kwargs), threading.Lock(), datetime.datetime.utcnow()]
+				self._entries[key] = entry
+				self.stats['rebuilt'] += 1
+			self._evict()
+			return entry
+	
+	# Returns the API object for key if its token is still valid, otherwise None
+	def get(self, key, state = None):
+		entry = self._entry(key, state)
+		if entry is None:
+			return None
+		# One token check, and renewal, at a time for the same user
+		with entry[1]:
+			if entry[0].restIsSessionValid():
+				return entry[0]
+		self.remove(key)
+		return None
+	
+	# Removes and returns the API object for key, valid or not
+	def pop(self, key, state = None):
+		entry = self._entry(key, state)
+		self.remove(key)
+		return entry[0] if entry else None
+	
+	def remove(self, key):
+		with self._lock:
+			self._entries.pop(key, None)
+	
+	def __len__(self):
+		return len(self._entries)
+
 class hxtool_session(CallbackDict, SessionMixin):
 	def __init__(self, app_secret):
 		def on_update(self):
@@ -24,6 +107,7 @@ class hxtool_session(CallbackDict, SessionMixin):
 			
 		self.secret = app_secret
 		self.id = None
+		self.saved_at = None
 		self.new = True
 		self.accessed = False
 		self.modified = False
@@ -43,6 +127,8 @@ class hxtool_session(CallbackDict, SessionMixin):
 			self.id = id
 			self.update(session_record['session_data'])
 			self.accessed = False
+			if session_record.get('update_timestamp'):
+				self.saved_at = HXAPI.dt_from_str(session_record['update_timestamp'])
 	
 # expiration_delta is in minutes		
 class hxtool_session_interface(SessionInterface):
@@ -98,9 +184,13 @@ class hxtool_session_interface(SessionInterface):
 			logger.debug("Created a new session with id: {0}".format(session.id))
 			session.new = False
 			
-		logger.debug("Saving session with id: {0}".format(session.id))
-		hxtool_global.hxtool_db.sessionUpdate(session.id, session)
-		session.modified = False
+		# Only write sessions that have changed, or haven't been written for a while
+		now = datetime.datetime.utcnow()
+		if session.modified or not session.saved_at or (now - session.saved_at) >= SESSION_SAVE_INTERVAL:
+			logger.debug("Saving session with id: {0}".format(session.id))
+			hxtool_global.hxtool_db.sessionUpdate(session.id, session)
+			session.modified = False
+			session.saved_at = now
 		
 		self.session_cache[session.id] = session
 		
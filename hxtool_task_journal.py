@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import json
+import threading
+from collections import OrderedDict
+
+import hxtool_logging
+from hxtool_util import pretty_exceptions
+
+logger = hxtool_logging.getLogger(__name__)
+
+JOURNAL_FILE_PREFIX = 'task_journal.'
+JOURNAL_FILE_SUFFIX = '.log'
+
+# Write-behind persistence for scheduler tasks.
+#
+# taskCreate, taskUpdate and taskDelete have the same signatures as the database methods. Changes are appended
+# to a journal file so they survive a crash, coalesced per task in memory and written to the database in batches
+# every flush_interval seconds, or sooner once flush_size tasks have pending changes. Updates only carry the
+# top level fields that changed since the task was last written.
+#
+# The journal is split in numbered segments, a new segment is started for every batch and the older segments are
+# deleted once the batch is in the database. Any segments left behind by a crash are applied by replay().
+class hxtool_task_journal:
+	def __init__(self, db, journal_path, flush_interval = 5, flush_size = 500):
+		self._db = db
+		self._journal_path = journal_path
+		self.flush_interval = flush_interval
+		self.flush_size = flush_size
+		self._lock = threading.Lock()
+		self._flush_lock = threading.Lock()
+		# (profile_id, task_id) -> {'op' : 'create' | 'update' | 'delete', 'fields' : {name : json}}
+		self._pending = OrderedDict()
+		# task_id -> {name : hash of the last json we saw for that field}
+		self._digests = {}
+		self._segment = 0
+		self._journal = None
+		self._flush_event = threading.Event()
+		self._stop_event = threading.Event()
+		self._flush_thread = threading.Thread(target = self._flush_loop, name = "TaskJournalThread")
+		self.stats = {
+			'operations' : 0,
+			'coalesced' : 0,
+			'batches' : 0,
+			'tasks_written' : 0
+		}
+
+	def _segments(self):
+		segments = []
+		for f in glob.glob(os.path.join(self._journal_path, JOURNAL_FILE_PREFIX + '*' + JOURNAL_FILE_SUFFIX)):
+			try:
+				segments.append((int(os.path.basename(f)[len(JOURNAL_FILE_PREFIX):-len(JOURNAL_FILE_SUFFIX)]), f))
+			except ValueError:
+				continue
+		return sorted(segments)
+
+	def _segment_file(self, segment):
+		return os.path.join(self._journal_path, "{}{}{}".format(JOURNAL_FILE_PREFIX, segment, JOURNAL_FILE_SUFFIX))
+
+	# Must be called with self._lock held
+	def _open_segment(self):
+		if self._journal is not None:
+			self._journal.close()
+		self._segment += 1
+		self._journal = open(self._segment_file(self._segment), 'a')
+
+	# Merge a newer operation for the same task into an older one. A 'replace' is a delete followed by a create,
+	# returns None when nothing has to be written.
+	@staticmethod
+	def _merge(older, newer):
+		if newer['op'] == 'delete':
+			# Never made it to the database, nothing to do
+			if older['op'] == 'create':
+				return None
+			return newer
+		elif newer['op'] == 'update':
+			# Late state from a worker thread of a task that is already removed
+			if older['op'] == 'delete':
+				return older
+			older['fields'].update(newer['fields'])
+			return older
+		# A create of a task that may still have a row in the database
+		if older['op'] == 'create':
+			return newer
+		return {'op' : 'replace', 'fields' : newer['fields']}
+
+	# Must be called with self._lock held
+	def _record(self, op, profile_id, task_id, fields = None, write_journal = True):
+		self.stats['operations'] += 1
+		entry = {'op' : op, 'fields' : fields or {}}
+		if write_journal:
+			if self._journal is None:
+				self._segment = max([self._segment] + [_[0] for _ in self._segments()])
+				self._open_segment()
+			self._journal.write(json.dumps({'op' : op, 'profile_id' : profile_id, 'task_id' : task_id, 'fields' : entry['fields']}) + '\n')
+			self._journal.flush()
+
+		key = (profile_id, task_id)
+		older = self._pending.pop(key, None)
+		if older is not None:
+			self.stats['coalesced'] += 1
+			entry = self._merge(older, entry)
+		if entry is not None:
+			self._pending[key] = entry
+
+		if len(self._pending) >= self.flush_size:
+			self._flush_event.set()
+
+	# Returns the JSON of the fields that changed since we last saw this task. Must be called with self._lock held
+	def _changed_fields(self, serialized_task, reset = False):
+		digests = self._digests.setdefault(serialized_task['task_id'], {})
+		if reset:
+			digests.clear()
+		fields = {}
+		for k, v in serialized_task.items():
+			j = json.dumps(v, sort_keys = True, default = str)
+			h = hash(j)
+			if digests.get(k) != h:
+				digests[k] = h
+				fields[k] = j
+		return fields
+
+	def taskCreate(self, serialized_task):
+		with self._lock:
+			self._record('create', serialized_task['profile_id'], serialized_task['task_id'], self._changed_fields(serialized_task, reset = True))
+
+	def taskUpdate(self, profile_id, task_id, serialized_task):
+		with self._lock:
+			fields = self._changed_fields(serialized_task)
+			if fields:
+				self._record('update', profile_id, task_id, fields)
+
+	def taskDelete(self, profile_id, task_id):
+		with self._lock:
+			self._digests.pop(task_id, None)
+			self._record('delete', profile_id, task_id)
+
+	def flush(self):
+		with self._flush_lock:
+			with self._lock:
+				if not self._pending:
+					return True
+				batch = self._pending
+				self._pending = OrderedDict()
+				closed_segment = self._segment
+				self._open_segment()
+
+			creates = []
+			updates = []
+			deletes = []
+			for (profile_id, task_id), entry in batch.items():
+				fields = { k : json.loads(v) for k, v in entry['fields'].items() }
+				if entry['op'] == 'create':
+					creates.append(fields)
+				elif entry['op'] == 'replace':
+					# Deletes are written before creates
+					deletes.append((profile_id, task_id))
+					creates.append(fields)
+				elif entry['op'] == 'update':
+					updates.append((profile_id, task_id, fields))
+				else:
+					deletes.append((profile_id, task_id))
+
+			try:
+				self._db.taskWriteBatch(creates = creates, updates = updates, deletes = deletes)
+			except Exception as e:
+				logger.error("Failed to write {} task changes to the database, will retry. Error: {}".format(len(batch), pretty_exceptions(e)))
+				# Put the batch back in front of anything that came in since
+				with self._lock:
+					for key, entry in self._pending.items():
+						older = batch.pop(key, None)
+						batch[key] = self._merge(older, entry) if older else entry
+					self._pending = OrderedDict((k, v) for k, v in batch.items() if v is not None)
+				return False
+
+			self.stats['batches'] += 1
+			self.stats['tasks_written'] += len(batch)
+			for segment, f in self._segments():
+				if segment <= closed_segment:
+					os.remove(f)
+			logger.debug("Wrote {} task changes to the database.".format(len(batch)))
+			return True
+
+	def _flush_loop(self):
+		while not self._stop_event.is_set():
+			self._flush_event.wait(self.flush_interval)
+			self._flush_event.clear()
+			self.flush()
+
+	# Apply whatever a previous run left in the journal, must be called before start()
+	def replay(self):
+		segments = self._segments()
+		count = 0
+		with self._lock:
+			for segment, f in segments:
+				with open(f, 'r') as journal:
+					for line in journal:
+						try:
+							r = json.loads(line)
+						except ValueError:
+							# A torn final write from a crash
+							logger.warning("Skipping a corrupt task journal entry in {}.".format(f))
+							continue
+						self._record(r['op'], r['profile_id'], r['task_id'], r['fields'], write_journal = False)
+						count += 1
+			self._segment = segments[-1][0] if segments else 0
+		if count:
+			logger.info("Replaying {} task journal entries.".format(count))
+		if self.flush():
+			for segment, f in segments:
+				if os.path.exists(f):
+					os.remove(f)
+		self._digests.clear()
+
+	def start(self):
+		self._flush_thread.start()
+
+	def stop(self):
+		self._stop_event.set()
+		self._flush_event.set()
+		if self._flush_thread.is_alive():
+			self._flush_thread.join()
+		self.flush()
+		with self._lock:
+			if self._journal is not None:
+				self._journal.close()
+				self._journal = None
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import socket
+import threading
+
+import hxtool_logging
+from hx_lib import HXAPI
+from hxtool_util import pretty_exceptions, secure_uuid4
+
+logger = hxtool_logging.getLogger(__name__)
+
+# Leases of finished tasks are kept this long so that other instances find out the task is done
+DONE_LEASE_RETENTION = 86400
+
+# A lease can be claimed when nobody holds it, it has expired or we already hold it, as long as the run
+# of the task it is for (run_key, the ISO formatted next_run) hasn't already been done by another instance.
+# The database classes that store leases without a query language use this.
+def lease_claimable(lease, owner, run_key, now):
+	if lease is None:
+		return True
+	if lease.get('done') and lease.get('run_key', '') >= run_key:
+		return False
+	return lease.get('owner') in (None, owner) or lease.get('expires', 0) < now
+
+# Lease/claim protocol for running several HXTool instances against the same tasks collection.
+#
+# Every instance loads the saved tasks, and before a stored task runs the instance must claim the lease for
+# that run of the task. The lease is kept alive by a heartbeat while the task runs and expires ttl seconds
+# after the heartbeat stops, so the run can be taken over if the instance dies. When the run is done the
+# lease records the next_run of the task, instances that lost the claim pick it up from there.
+class hxtool_task_lease:
+	def __init__(self, db, ttl = 60):
+		self._db = db
+		self.ttl = ttl
+		self.owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), secure_uuid4().hex[:8])
+		self._lock = threading.Lock()
+		# task_id -> run_key of the leases we hold
+		self._held = {}
+		self._stop_event = threading.Event()
+		self._heartbeat_thread = threading.Thread(target = self._heartbeat, name = "TaskLeaseThread")
+		self.stats = {
+			'claimed' : 0,
+			'lost' : 0,
+			'released' : 0,
+			'expired' : 0
+		}
+
+	# Returns (claimed, lease)
+	def claim(self, task, run_key):
+		now = time.time()
+		(claimed, lease) = self._db.taskLeaseClaim(task.task_id, self.owner, run_key, now + self.ttl, now)
+		with self._lock:
+			if claimed:
+				self._held[task.task_id] = run_key
+				self.stats['claimed'] += 1
+			else:
+				self.stats['lost'] += 1
+		return (claimed, lease)
+
+	def release(self, task, run_key):
+		with self._lock:
+			self._held.pop(task.task_id, None)
+			self.stats['released'] += 1
+		next_run = HXAPI.dt_to_str(task.next_run) if task.next_run else None
+		self._db.taskLeaseRelease(task.task_id, self.owner, run_key, next_run, time.time())
+
+	def _heartbeat(self):
+		while not self._stop_event.wait(self.ttl / 3.0):
+			try:
+				with self._lock:
+					held = dict(self._held)
+				if held:
+					now = time.time()
+					renewed = self._db.taskLeaseRenew(self.owner, list(held.keys()), now + self.ttl, now)
+					for task_id in set(held.keys()) - set(renewed):
+						logger.warning("Lost the lease for task {}, another instance may run it again.".format(task_id))
+						with self._lock:
+							self.stats['expired'] += 1
+				self._db.taskLeasePurge(time.time() - DONE_LEASE_RETENTION)
+			except Exception as e:
+				logger.error("Failed to renew task leases. Error: {}".format(pretty_exceptions(e)))
+
+	def start(self):
+		self._heartbeat_thread.start()
+		logger.info("Distributed scheduling enabled, this instance is {}.".format(self.owner))
+
+	def stop(self):
+		self._stop_event.set()
+		if self._heartbeat_thread.is_alive():
+			self._heartbeat_thread.join()
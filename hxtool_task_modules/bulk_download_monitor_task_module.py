@@ -58,6 +58,7 @@ class bulk_download_monitor_task_module(task_module):
 						if ret and response_data['data']['state'] != 'RUNNING':
 							self.logger.warning("The bulk acquisition job {} is not in a running state. Controller state: {}".format(bulk_download_job['bulk_acquisition_id'], response_data['data']['state']))
 							hxtool_global.hxtool_db.bulkDownloadUpdate(bulk_download_eid, stopped=True)
+							bulk_host_status_poller.drop(self.parent_task.profile_id, bulk_download_job['bulk_acquisition_id'])
 							self.parent_task.stop()
 							return(ret, result)
 						elif not ret:
@@ -74,6 +75,8 @@ class bulk_download_monitor_task_module(task_module):
 						
 						(ret, response_code, response_data) = hx_api_object.restListBulkHosts(bulk_download_job['bulk_acquisition_id'], filter_term = {'state' : 'COMPLETE'})
 						if ret:
+							# Seed the shared host status poller so the download tasks don't have to ask for each host again
+							bulk_host_status_poller.get(self.parent_task.profile_id, bulk_download_job['bulk_acquisition_id'], hxtool_global.hxtool_config['scheduler']['defer_interval']).update(response_data['data']['entries'])
 							for bulk_host in response_data['data']['entries']:
 								# Don't create duplicate jobs for the same hosts
 								if not bulk_download_job['hosts'].get(bulk_host['host']['_id'], None):
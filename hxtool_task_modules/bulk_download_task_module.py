@@ -1,10 +1,114 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import threading
+import datetime
+
 import hxtool_global
 from .task_module import *
 from hxtool_util import *
 
+# Shared status poller for a single bulk acquisition. Rather than every per-host download task
+# calling restGetBulkHost and deferring, the first task to run after the poll interval has elapsed
+# pages through restListBulkHosts by state, records which hosts are ready and wakes only the
+# download tasks waiting on those hosts. A poller lives as long as its bulk download job, it is dropped
+# once the job is stopped, deleted or all of its hosts are downloaded.
+class bulk_host_status_poller(object):
+	PAGE_SIZE = 1000
+	POLL_STATES = ['COMPLETE', 'FAILED', 'CANCELLED', 'ABORTED']
+	
+	_pollers = {}
+	_pollers_lock = threading.Lock()
+	
+	def __init__(self, profile_id, bulk_acquisition_id, poll_interval):
+		self.profile_id = profile_id
+		self.bulk_acquisition_id = bulk_acquisition_id
+		self.poll_interval = datetime.timedelta(seconds = poll_interval)
+		self.last_poll = None
+		# Set to the failed controller response if the bulk acquisition no longer exists
+		self.missing = None
+		self._hosts = {}
+		self._waiting = {}
+		self._lock = threading.Lock()
+		self._poll_lock = threading.Lock()
+		self.logger = hxtool_logging.getLogger(__name__)
+	
+	@classmethod
+	def get(cls, profile_id, bulk_acquisition_id, poll_interval = 30):
+		with cls._pollers_lock:
+			poller = cls._pollers.get((profile_id, bulk_acquisition_id), None)
+			if poller is None:
+				poller = cls(profile_id, bulk_acquisition_id, poll_interval)
+				cls._pollers[(profile_id, bulk_acquisition_id)] = poller
+			return poller
+	
+	@classmethod
+	def drop(cls, profile_id, bulk_acquisition_id):
+		with cls._pollers_lock:
+			cls._pollers.pop((profile_id, bulk_acquisition_id), None)
+	
+	# Record host states from bulk acquisition host entries, returns the agent IDs that became ready.
+	# Counts as a poll, the entries are as recent as the ones we would get.
+	def update(self, entries):
+		ready = []
+		with self._lock:
+			self.last_poll = datetime.datetime.utcnow()
+			for entry in entries:
+				agent_id = entry['host']['_id']
+				url = (entry.get('result') or {}).get('url', None)
+				if self._hosts.get(agent_id, (None, None))[0] != entry['state']:
+					ready.append(agent_id)
+				self._hosts[agent_id] = (entry['state'], url)
+		return ready
+	
+	def host_state(self, agent_id, task_id = None):
+		with self._lock:
+			# Register interest while holding the lock so we don't miss a poll that lands in between
+			if task_id:
+				self._waiting[agent_id] = task_id
+			return self._hosts.get(agent_id, (None, None))
+	
+	def discard(self, agent_id):
+		with self._lock:
+			self._hosts.pop(agent_id, None)
+			self._waiting.pop(agent_id, None)
+	
+	def poll(self, hx_api_object, scheduler):
+		# Another task is already polling, it will wake us if our host is ready
+		if not self._poll_lock.acquire(blocking = False):
+			return(True, None, None)
+		try:
+			now = datetime.datetime.utcnow()
+			if self.last_poll and (now - self.last_poll) < self.poll_interval:
+				return(True, None, None)
+			# Set this up front so a failing controller is only asked once per interval
+			self.last_poll = now
+			
+			ready = []
+			for state in bulk_host_status_poller.POLL_STATES:
+				offset = 0
+				while True:
+					(ret, response_code, response_data) = hx_api_object.restListBulkHosts(self.bulk_acquisition_id, limit = bulk_host_status_poller.PAGE_SIZE, offset = offset, filter_term = {'state' : state})
+					if not ret:
+						if response_code == 404 and response_data['details'][0]['code'] == 1005:
+							self.missing = response_data
+						return(ret, response_code, response_data)
+					entries = response_data['data']['entries']
+					ready.extend(self.update(entries))
+					offset += len(entries)
+					if len(entries) < bulk_host_status_poller.PAGE_SIZE or offset >= response_data['data'].get('total', 0):
+						break
+			
+			with self._lock:
+				woken = [self._waiting[agent_id] for agent_id in ready if agent_id in self._waiting]
+			self.logger.debug("Bulk acquisition {} poll found {} ready hosts, waking {} download tasks.".format(self.bulk_acquisition_id, len(ready), len(woken)))
+			for task_id in woken:
+				scheduler.wake(task_id)
+			
+			return(True, None, None)
+		finally:
+			self._poll_lock.release()
+
 class bulk_download_task_module(task_module):
 	def __init__(self, parent_task):
 		super(type(self), self).__init__(parent_task)
@@ -61,6 +165,12 @@ class bulk_download_task_module(task_module):
 				'type' : str,
 				'required' : True,
 				'description' : "The host name of the bulk acquisition that was downloaded."
+			},
+			{
+				'name' : 'bulk_download_sha256',
+				'type' : str,
+				'required' : False,
+				'description' : "The SHA-256 of the bulk acquisition package, computed while it was downloaded."
 			}
 		]	
 		
@@ -72,23 +182,38 @@ class bulk_download_task_module(task_module):
 			if bulk_download_job and bulk_download_job['stopped'] == False:
 				hx_api_object = self.get_task_api_object()
 				if hx_api_object:
-					(ret, response_code, response_data) = hx_api_object.restGetBulkHost(bulk_download_job['bulk_acquisition_id'], agent_id)
-					if ret and 'data' in response_data and (response_data['data']['state'] == "COMPLETE" and response_data['data']['result']):
+					poller = bulk_host_status_poller.get(self.parent_task.profile_id, bulk_download_job['bulk_acquisition_id'], self.parent_task.defer_interval)
+					(ret, response_code, response_data) = poller.poll(hx_api_object, self.parent_task.scheduler)
+					(state, url) = poller.host_state(agent_id, self.parent_task.task_id)
+					if state == "COMPLETE" and not url:
+						# The host listing didn't include the package location, ask for this host directly
+						(ret, response_code, response_data) = hx_api_object.restGetBulkHost(bulk_download_job['bulk_acquisition_id'], agent_id)
+						if ret and 'data' in response_data and response_data['data']['result']:
+							url = response_data['data']['result']['url']
+					
+					if state == "COMPLETE" and url:
 						self.logger.debug("Processing bulk download for host: {0}".format(host_name))
 						download_directory = make_download_directory(hx_api_object.hx_host, bulk_download_job['bulk_acquisition_id'])
 						full_path = os.path.join(download_directory, get_download_filename(host_name, agent_id))
-						(ret, response_code, response_data) = hx_api_object.restDownloadFile(response_data['data']['result']['url'], full_path)
+						(ret, response_code, response_data) = hx_api_object.restDownloadFile(url, full_path)
 						if ret:
+							poller.discard(agent_id)
 							hxtool_global.hxtool_db.bulkDownloadUpdateHost(bulk_download_eid, agent_id, downloaded = True)
-							self.logger.debug("Bulk download for host {} successfully downloaded to {}".format(host_name, full_path))
+							if all(_.get('downloaded', False) for host_id, _ in bulk_download_job['hosts'].items() if host_id != agent_id):
+								bulk_host_status_poller.drop(self.parent_task.profile_id, bulk_download_job['bulk_acquisition_id'])
+							self.logger.debug("Bulk download for host {} successfully downloaded to {}, SHA-256: {}".format(host_name, full_path, response_data['sha256']))
 							result['bulk_acquisition_id'] = bulk_download_job['bulk_acquisition_id']
 							result['bulk_download_path'] = full_path
 							result['agent_id'] = agent_id
 							result['host_name'] = host_name
+							result['bulk_download_sha256'] = response_data['sha256']
 						else:
 							self.logger.error("Failed to download bulk acquisition package for {}. Response code: {}, response data: {}".format(agent_id, response_code, response_data))
-					elif 'data' in response_data and (response_code == 404 and response_data['details'][0]['code'] == 1005) or (response_data['data']['state'] in {'FAILED', 'CANCELLED', 'ABORTED'}):
-						self.logger.error("The bulk acquisition job {} for {} has failed, been canceled, aborted or cannot be found. Response code: {}, response data: {}".format(bulk_download_job['bulk_acquisition_id'], agent_id, response_code, response_data))
+					elif poller.missing or state in {'FAILED', 'CANCELLED', 'ABORTED'}:
+						self.logger.error("The bulk acquisition job {} for {} has failed, been canceled, aborted or cannot be found. Host state: {}, response data: {}".format(bulk_download_job['bulk_acquisition_id'], agent_id, state, poller.missing))
+						poller.discard(agent_id)
+						if poller.missing:
+							bulk_host_status_poller.drop(self.parent_task.profile_id, bulk_download_job['bulk_acquisition_id'])
 						self.parent_task.stop()
 						hxtool_global.hxtool_db.bulkDownloadDeleteHost(bulk_download_eid, agent_id)
 						ret = False
@@ -108,6 +233,8 @@ class bulk_download_task_module(task_module):
 					self.logger.warn("No task API session for profile: {}".format(self.parent_task.profile_id))
 			else:
 				self.logger.info("Bulk download is stopped.")
+				if bulk_download_job:
+					bulk_host_status_poller.drop(self.parent_task.profile_id, bulk_download_job['bulk_acquisition_id'])
 				self.parent_task.stop()
 		except Exception as e:
 			self.logger.error(pretty_exceptions(e))
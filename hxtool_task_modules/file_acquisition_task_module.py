@@ -57,7 +57,7 @@ class file_acquisition_task_module(task_module):
 					(ret, response_code, response_data) = hx_api_object.restDownloadFile('{}.zip'.format(response_data['data']['url']), full_path)
 					if ret:
 						hxtool_global.hxtool_db.multiFileUpdateFile(self.parent_task.profile_id, multi_file_eid, file_acquisition_id)
-						self.logger.info("File Acquisition download complete. Acquisition ID: {0}, Batch: {1}".format(file_acquisition_id, multi_file_eid))
+						self.logger.info("File Acquisition download complete. Acquisition ID: {0}, Batch: {1}, SHA-256: {2}".format(file_acquisition_id, multi_file_eid, response_data['sha256']))
 				elif response_code == 404:
 					self.logger.error("File acquisition ID: {} not found on the controller.".format(file_acquisition_id))
 					self.parent_task.stop()
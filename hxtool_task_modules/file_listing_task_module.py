@@ -9,6 +9,8 @@ from hxtool_data_models import *
 from hx_audit import *
 
 class file_listing_task_module(task_module):
+	use_process_pool = True
+	
 	def __init__(self, parent_task):
 		super(type(self), self).__init__(parent_task)
 	
@@ -58,17 +60,13 @@ class file_listing_task_module(task_module):
 			generator = 'files-raw'
 			if file_listing and 'api_mode' in file_listing['cfg'] and file_listing['cfg']['api_mode']:
 				generator = 'files-api'
-			with AuditPackage(bulk_download_path) as audit_pkg:
-				audit_data = audit_pkg.get_audit(generator = generator, open_only=True)
-				if audit_data:
-					files = get_audit_records(audit_data, generator, 'FileItem', hostname=host_name)
-					if files:
-						hxtool_global.hxtool_db.fileListingAddResult(self.parent_task.profile_id, bulk_download_eid, files)
-						self.logger.debug("File Listing added to the database. bulk job: {0} host: {1}".format(bulk_download_eid, host_name))
-						ret = True
-					else:
-						self.logger.warn("File Listing: No audit data for {} from bulk download job {}".format(host_name, bulk_download_eid))
-					audit_data.close()
+			files = self.run_in_process_pool(get_package_audit_records, bulk_download_path, generator, 'FileItem', hostname=host_name)
+			if files:
+				hxtool_global.hxtool_db.fileListingAddResult(self.parent_task.profile_id, bulk_download_eid, files)
+				self.logger.debug("File Listing added to the database. bulk job: {0} host: {1}".format(bulk_download_eid, host_name))
+				ret = True
+			elif files is not None:
+				self.logger.warn("File Listing: No audit data for {} from bulk download job {}".format(host_name, bulk_download_eid))
 					
 		except Exception as e:
 			self.logger.error(pretty_exceptions(e))
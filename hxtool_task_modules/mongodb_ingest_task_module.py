@@ -10,6 +10,9 @@ from hx_audit import *
 from hxtool_util import *
 
 class mongodb_ingest_task_module(task_module):
+	# Audit objects written to the database per round trip
+	INSERT_BATCH_SIZE = 1000
+	
 	def __init__(self, parent_task):
 		super(type(self), self).__init__(parent_task)
 	
@@ -68,8 +71,14 @@ class mongodb_ingest_task_module(task_module):
 		result = {}
 		try:
 			if bulk_download_path:
+				audit_objects = []
 				for audit_object in self.yield_audit_results(bulk_download_path, batch_mode, host_name, agent_id, bulk_acquisition_id = bulk_acquisition_id):
-					hxtool_global.hxtool_db.auditInsert(audit_object)
+					audit_objects.append(audit_object)
+					if len(audit_objects) >= self.INSERT_BATCH_SIZE:
+						hxtool_global.hxtool_db.auditInsertMany(audit_objects)
+						audit_objects = []
+				if audit_objects:
+					hxtool_global.hxtool_db.auditInsertMany(audit_objects)
 				ret = True								
 				if ret and delete_bulk_download:
 					os.remove(os.path.realpath(bulk_download_path))
@@ -9,6 +9,8 @@ from hxtool_data_models import *
 from hx_audit import *
 
 class stacking_task_module(task_module):
+	use_process_pool = True
+	
 	def __init__(self, parent_task):
 		super(type(self), self).__init__(parent_task)
 	
@@ -55,19 +57,13 @@ class stacking_task_module(task_module):
 			if bulk_download_path:
 				stack_job = hxtool_global.hxtool_db.stackJobGet(profile_id = self.parent_task.profile_id, bulk_download_eid = bulk_download_eid)
 				stack_model = hxtool_data_models(stack_job['stack_type']).stack_type
-				with AuditPackage(bulk_download_path) as audit_pkg:
-					audit_data = audit_pkg.get_audit(generator=stack_model['audit_module'], open_only=True)
-					if audit_data:
-						records = get_audit_records(audit_data, stack_model['audit_module'], stack_model['item_name'], fields=stack_model['fields'], post_process=stack_model['post_process'], hostname=host_name)
-						if records:
-							hxtool_global.hxtool_db.stackJobAddResult(self.parent_task.profile_id, bulk_download_eid, host_name, records)
-							self.logger.debug("Stacking records added to the database for host {}".format(host_name))
-							ret = True
-						else:
-							self.logger.warn("Stacking: No audit data for {}".format(host_name))
-						
-						# Explicitly close
-						audit_data.close()
+				records = self.run_in_process_pool(get_package_audit_records, bulk_download_path, stack_model['audit_module'], stack_model['item_name'], fields=stack_model['fields'], post_process=stack_model['post_process'], hostname=host_name)
+				if records:
+					hxtool_global.hxtool_db.stackJobAddResult(self.parent_task.profile_id, bulk_download_eid, host_name, records)
+					self.logger.debug("Stacking records added to the database for host {}".format(host_name))
+					ret = True
+				elif records is not None:
+					self.logger.warn("Stacking: No audit data for {}".format(host_name))
 					
 				if ret and delete_bulk_download:
 					try:
@@ -8,6 +8,8 @@ from hxtool_util import *
 
 class task_module(object):
 	MAX_RETRY = 10
+	# CPU bound modules set this to have their parsing run in the scheduler's process pool
+	use_process_pool = False
 	
 	# TODO: parent_task should probably be renamed to just task, as modules are associated with tasks
 	# and this confuses the parent/child task relationship.
@@ -25,8 +27,18 @@ class task_module(object):
 			self.logger.error("There is no valid background task API session for profile {}".format(self.parent_task.profile_id))
 			return None
 		
+	# Runs func in the scheduler's process pool when the module has opted in and a pool is available, otherwise inline.
+	# func, its arguments and its return value must be picklable, the caller does any database writes with the result.
+	def run_in_process_pool(self, func, *args, **kwargs):
+		scheduler = self.parent_task.scheduler
+		if self.use_process_pool and scheduler is not None and getattr(scheduler, 'process_pool', None) is not None:
+			return scheduler.process_pool.apply(func, args, kwargs)
+		return func(*args, **kwargs)
+	
+	# HXAPI has already retried the request a few times, this is for a controller that stays unavailable
+	# (or whose circuit breaker is open) long enough that the task should be deferred.
 	def can_retry(self, err):
-		return('connection' in str(type(err)).lower() and self.retry_count < task_module.MAX_RETRY)
+		return((isinstance(err, requests.ConnectionError) or 'connection' in str(type(err)).lower()) and self.retry_count < task_module.MAX_RETRY)
 	
 	def yield_audit_results(self, bulk_download_path, batch_mode, host_name, agent_id, bulk_acquisition_id = None):
 		hx_host = None
@@ -38,6 +50,8 @@ class task_module(object):
 		with AuditPackage(bulk_download_path) as audit_package:
 			for audit in audit_package.audits:
 				try:
+					# Always parsed inline, the callers stream each object to their sink and a process pool
+					# would hand back the whole audit at once.
 					for audit_object in audit_package.audit_to_dict(audit, host_name, agent_id = agent_id, batch_mode = batch_mode):
 						audit_object.update({
 							'hx_host' : hx_host,
@@ -4,9 +4,16 @@
 from hxtool_db import hxtool_db
 
 from threading import Lock
+from contextlib import contextmanager
+import os
 import datetime
 import json
 
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
 try:
 	import tinydb
 	import tinydb.operations
@@ -20,6 +27,7 @@ import hxtool_vars
 import hxtool_logging
 from hx_lib import HXAPI
 from hxtool_util import secure_uuid4
+from hxtool_task_lease import lease_claimable
 
 logger = hxtool_logging.getLogger(__name__)
 
@@ -35,6 +43,9 @@ class hxtool_tinydb(hxtool_db):
 			
 		self._lock = Lock()
 		self.check_schema()
+		
+		# Task leases are shared with other HXTool processes on this host, so they live in their own file
+		self._task_lease_file = os.path.splitext(db_file)[0] + '_task_leases.json'
 
 		self.apicache = apicache
 		self.apicache_refresh_interval = apicache_refresh_interval
@@ -399,8 +410,12 @@ class hxtool_tinydb(hxtool_db):
 	
 	def stackJobAddResult(self, profile_id, bulk_download_eid, hostname, result):
 		with self._lock:
-			e_id = self._db.table('stacking').update(self._db_append_to_list('results', result), (tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['bulk_download_eid'] == int(bulk_download_eid)))
-			return self._db.table('stacking').update(self._db_update_dict_in_list('hosts', 'hostname', hostname, 'processed', True), doc_ids = e_id)
+			append_results = self._db_append_to_list('results', result, update_timestamp = False)
+			set_processed = self._db_update_dict_in_list('hosts', 'hostname', hostname, 'processed', True)
+			def transform(element):
+				append_results(element)
+				set_processed(element)
+			return self._db.table('stacking').update(transform, (tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['bulk_download_eid'] == int(bulk_download_eid)))
 			
 	def stackJobUpdateIndex(self, profile_id, bulk_download_eid, last_index):
 		with self._lock:
@@ -502,7 +517,76 @@ class hxtool_tinydb(hxtool_db):
 	def taskDelete(self, profile_id, task_id):
 		with self._lock:
 			return self._db.table('tasks').remove((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['task_id'] == task_id))
-			
+	
+	# Apply a batch of task changes with at most one write of the database file per kind of change.
+	# updates is a list of (profile_id, task_id, fields) and deletes a list of (profile_id, task_id)
+	def taskWriteBatch(self, creates = [], updates = [], deletes = []):
+		with self._lock:
+			tasks_table = self._db.table('tasks')
+			if deletes:
+				delete_task_ids = set(_[1] for _ in deletes)
+				tasks_table.remove(tinydb.Query()['task_id'].test(lambda task_id: task_id in delete_task_ids))
+			if creates:
+				tasks_table.insert_multiple(creates)
+			if updates:
+				update_fields = {}
+				for (profile_id, task_id, fields) in updates:
+					update_fields.setdefault((profile_id, task_id), {}).update(fields)
+				update_task_ids = set(_[1] for _ in update_fields)
+				def apply_update(doc):
+					doc.update(update_fields.get((doc['profile_id'], doc['task_id']), {}))
+				tasks_table.update(apply_update, tinydb.Query()['task_id'].test(lambda task_id: task_id in update_task_ids))
+	
+	# Read-modify-write of the lease file under an exclusive lock, the lock file is separate
+	# so that the lease file can be replaced atomically.
+	@contextmanager
+	def _task_leases(self):
+		if fcntl is None:
+			raise NotImplementedError("Task leases with TinyDB require fcntl file locking, which is not available on this platform.")
+		with open(self._task_lease_file + '.lock', 'a') as lock_file:
+			fcntl.flock(lock_file, fcntl.LOCK_EX)
+			try:
+				leases = {}
+				if os.path.exists(self._task_lease_file):
+					with open(self._task_lease_file, 'r') as f:
+						leases = json.load(f)
+				yield leases
+				with open(self._task_lease_file + '.tmp', 'w') as f:
+					json.dump(leases, f)
+				os.replace(self._task_lease_file + '.tmp', self._task_lease_file)
+			finally:
+				fcntl.flock(lock_file, fcntl.LOCK_UN)
+	
+	def taskLeaseClaim(self, task_id, owner, run_key, expires, now):
+		with self._task_leases() as leases:
+			lease = leases.get(task_id)
+			if not lease_claimable(lease, owner, run_key, now):
+				return (False, lease)
+			lease = leases.setdefault(task_id, {'task_id' : task_id})
+			lease.update({'owner' : owner, 'run_key' : run_key, 'expires' : expires, 'done' : False, 'updated' : now})
+			return (True, lease)
+	
+	def taskLeaseRenew(self, owner, task_ids, expires, now):
+		renewed = []
+		with self._task_leases() as leases:
+			for task_id in task_ids:
+				lease = leases.get(task_id)
+				if lease and lease.get('owner') == owner:
+					lease.update({'expires' : expires, 'updated' : now})
+					renewed.append(task_id)
+		return renewed
+	
+	def taskLeaseRelease(self, task_id, owner, run_key, next_run, now):
+		with self._task_leases() as leases:
+			lease = leases.get(task_id)
+			if lease and lease.get('owner') == owner and lease.get('run_key') == run_key:
+				lease.update({'owner' : None, 'done' : True, 'next_run' : next_run, 'expires' : 0, 'updated' : now})
+	
+	def taskLeasePurge(self, before):
+		with self._task_leases() as leases:
+			for task_id in [k for k, v in leases.items() if v.get('done') and v.get('next_run') is None and v.get('updated', 0) < before]:
+				del leases[task_id]
+	
 	def taskProfileAdd(self, name, actor, params):
 		with self._lock:
 			return self._db.table('taskprofiles').insert({'taskprofile_id' : str(secure_uuid4()), 
@@ -536,6 +620,10 @@ class hxtool_tinydb(hxtool_db):
 													'end_time'	: end_time,
 													'results'	: results})
 	
+	def auditInsertMany(self, audits):
+		with self._lock:
+			return self._db.table('audits').insert_multiple(audits)
+	
 	def auditList(self, profile_id):
 		with self._lock:
 			return self._db.table('audits').get((tinydb.Query()['profile_id'] == profile_id))
@@ -625,6 +713,17 @@ class hxtool_tinydb(hxtool_db):
 			else:
 				return False
 
+	def cacheGetMany(self, profile_id, cacheType, contentIds):
+		contentIds = set(contentIds)
+		with self._lock:
+			if not self.apicache:
+				return []
+			r = self._db.table("ObjectCache").search((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['type'] == cacheType) & (tinydb.Query()['contentId'].test(lambda v: v in contentIds)))
+			if self.apicache_refresh_interval is not None:
+				now = datetime.datetime.now()
+				r = [_ for _ in r if (now - datetime.datetime.strptime(_['update_timestamp'], "%Y-%m-%d %H:%M:%S")).seconds <= self.apicache_refresh_interval]
+			return r
+
 	def cacheFlagRemove(self, profile_id, cacheType, offset):
 		with self._lock:
 			r = self._db.table('ObjectCache').update({
@@ -638,6 +737,10 @@ class hxtool_tinydb(hxtool_db):
 			return self._db.table("ObjectCache").remove((tinydb.Query()['profile_id'] == profile_id))
 
 
+	def cacheRemove(self, profile_id, cacheType, contentIds):
+		with self._lock:
+			return self._db.table("ObjectCache").remove((tinydb.Query()['profile_id'] == profile_id) & (tinydb.Query()['type'] == cacheType) & (tinydb.Query()['contentId'].one_of(contentIds)))
+
 	def cacheListAll(self, profile_id):
 		with self._lock:
 			return self._db.table('ObjectCache').search((tinydb.Query()['profile_id'] == profile_id))
@@ -738,6 +841,71 @@ class hxtool_tinydb(hxtool_db):
 					element['update_timestamp'] =  HXAPI.dt_to_str(datetime.datetime.utcnow())	
 		return transform
 	
+	def bulkWrite(self, table, operations):
+		deletes = []
+		inserts = []
+		updates = []
+		for operation in operations:
+			if operation[0] == 'delete':
+				deletes.append(operation[1])
+			elif operation[0] == 'insert':
+				inserts.append(operation[1])
+			elif operation[0] in ('update', 'upsert'):
+				updates.append(operation)
+			else:
+				raise ValueError("Unknown bulk write operation {}".format(operation[0]))
+		
+		with self._lock:
+			t = self._db.table(table)
+			if deletes:
+				delete_queries = self._db_bulk_queries([(_, None) for _ in deletes])
+				t.remove(lambda doc: self._db_bulk_match(delete_queries, doc))
+			if inserts:
+				t.insert_multiple(inserts)
+			if updates:
+				update_queries = self._db_bulk_queries([(_[1], _) for _ in updates])
+				matched = set()
+				def transform(doc):
+					for operation in self._db_bulk_match(update_queries, doc):
+						doc.update(operation[2])
+						matched.add(id(operation))
+				t.update(transform, lambda doc: bool(self._db_bulk_match(update_queries, doc)))
+				# Whatever didn't match applies, in order, to the documents upserted before it in this batch
+				upserts = []
+				upserted = { fields : {} for fields in update_queries }
+				for operation in updates:
+					if id(operation) in matched:
+						continue
+					fields = tuple(sorted(operation[1].keys()))
+					docs = upserted[fields].get(tuple(operation[1][_] for _ in fields))
+					if docs:
+						for doc in docs:
+							doc.update(operation[2])
+					elif operation[0] == 'upsert':
+						doc = dict(list(operation[3].items() if len(operation) > 3 else []) + list(operation[1].items()) + list(operation[2].items()))
+						upserts.append(doc)
+						for index_fields, index in upserted.items():
+							index.setdefault(tuple(doc.get(_) for _ in index_fields), []).append(doc)
+				if upserts:
+					t.insert_multiple(upserts)
+	
+	# Groups bulk write queries by the fields they match on, so a document is looked up once per group rather
+	# than compared against every query: {fields : {values : [operations]}}
+	@staticmethod
+	def _db_bulk_queries(queries):
+		groups = {}
+		for query, operation in queries:
+			fields = tuple(sorted(query.keys()))
+			groups.setdefault(fields, {}).setdefault(tuple(query[_] for _ in fields), []).append(operation)
+		return groups
+	
+	@staticmethod
+	def _db_bulk_match(groups, doc):
+		operations = []
+		for fields, values in groups.items():
+			operations.extend(values.get(tuple(doc.get(_) for _ in fields), []))
+		return operations
+	
 	def _db_append_to_list(self, list_name, value, update_timestamp = True):
 		def transform(element):
 			if type(value) is list:
@@ -35,7 +35,8 @@ except (ImportError, ModuleNotFoundError):
 
 import hxtool_logging
 import hxtool_vars
-from hx_lib import HXAPI
+import hxtool_global
+from hx_lib import HXAPI, HXAPITracer
 
 logger = hxtool_logging.getLogger(__name__)
 
@@ -51,15 +52,28 @@ def valid_session_required(f):
 	@wraps(f)
 	def is_session_valid(*args, **kwargs):
 		ret = redirect(url_for('login', redirect_uri = request.full_path))	
-		if (session and 'ht_user' in session and 'ht_api_object' in session):
-			o = HXAPI.deserialize(session['ht_api_object'])
-			if o.restIsSessionValid():
-				kwargs['hx_api_object'] = o
-				ret = f(*args, **kwargs)
-				session['ht_api_object'] = o.serialize()
-				return ret	
-			else:
-				logger.warn("The HX API token for the current session has expired, redirecting to the login page.")
+		if (session and 'ht_user' in session):
+			# Sessions from before the API session registry carry a pickled API object, move it over
+			if 'ht_api_object' in session and 'ht_api_session' not in session:
+				session['ht_api_session'] = hxtool_global.hxtool_api_sessions.add(HXAPI.deserialize(session.pop('ht_api_object')))
+			if 'ht_api_session' in session:
+				o = hxtool_global.hxtool_api_sessions.get(session['ht_api_session'], session.get('ht_api_state'))
+				if o:
+					kwargs['hx_api_object'] = o
+					if HXAPI.tracer is not None:
+						HXAPITracer.set_context(session.get('ht_profileid'), request.endpoint)
+					try:
+						ret = f(*args, **kwargs)
+					finally:
+						# The thread goes on to serve other requests
+						HXAPITracer.clear_context()
+					# Only touch the session, and with it the database, when the token has changed
+					state = o.session_state()
+					if state != session.get('ht_api_state'):
+						session['ht_api_state'] = state
+					return ret	
+				else:
+					logger.warn("The HX API token for the current session has expired, redirecting to the login page.")
 		return ret
 	return is_session_valid
 	
@@ -0,0 +1,101 @@
+import unittest
+
+import requests
+
+from hx_lib import HXAPI, HXAPICircuitBreaker, HXAPICircuitOpenError, HXAPIPoolTimeoutError
+
+
+class CircuitBreakerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = HXAPICircuitBreaker('breaker.test:3000', window=60, min_requests=4, error_threshold=0.5, cooldown=0)
+
+    def _trip(self):
+        for _ in range(4):
+            self.assertTrue(self.breaker.allow(background=True))
+            self.breaker.record(True)
+
+    def test_closed_open_half_open_closed(self):
+        self.breaker.cooldown = 3600
+        for failed in (False, True, False):
+            self.assertTrue(self.breaker.allow(background=True))
+            self.breaker.record(failed)
+        self.assertEqual(self.breaker.state, HXAPICircuitBreaker.CLOSED)
+
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, HXAPICircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow(background=True))
+        # A user is waiting for interactive requests, they are still sent
+        self.assertTrue(self.breaker.allow(background=False))
+        self.assertEqual(self.breaker.stats()['shed'], 1)
+
+        self.breaker.cooldown = 0
+        self.assertTrue(self.breaker.allow(background=True))
+        self.assertEqual(self.breaker.state, HXAPICircuitBreaker.HALF_OPEN)
+        # Only one probe at a time
+        self.assertFalse(self.breaker.allow(background=True))
+
+        self.breaker.record(False)
+        self.assertEqual(self.breaker.state, HXAPICircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow(background=True))
+        self.assertEqual(self.breaker.stats()['trips'], 1)
+
+    def test_failed_probe_opens_again(self):
+        self._trip()
+        self.assertTrue(self.breaker.allow(background=True))
+        self.assertEqual(self.breaker.state, HXAPICircuitBreaker.HALF_OPEN)
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, HXAPICircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.stats()['trips'], 2)
+
+    def test_release_probe(self):
+        self._trip()
+        self.assertTrue(self.breaker.allow(background=True))
+        self.assertFalse(self.breaker.allow(background=True))
+        self.breaker.release_probe()
+        self.assertEqual(self.breaker.state, HXAPICircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow(background=True))
+
+
+class SendRequestBreakerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.api = HXAPI('breaker.test', background=True)
+        self.breaker = HXAPICircuitBreaker(self.api.circuit_breaker().name, min_requests=4, cooldown=0)
+        HXAPI._circuit_breakers[self.breaker.name] = self.breaker
+        for _ in range(4):
+            self.breaker.record(True)
+        self.assertEqual(self.breaker.state, HXAPICircuitBreaker.OPEN)
+        self.request = requests.Request('GET', 'https://breaker.test:3000/hx/api/v3/hosts').prepare()
+
+    def tearDown(self):
+        HXAPI._circuit_breakers.pop(self.breaker.name, None)
+
+    def _send_raises(self, exception):
+        def send(request, stream=False):
+            raise exception
+        self.api._session.send = send
+
+    def test_pool_timeout_releases_probe(self):
+        self._send_raises(HXAPIPoolTimeoutError('no connection available'))
+        self.assertRaises(HXAPIPoolTimeoutError, self.api._send_request, self.request, False)
+        # Not a controller failure: still half open, and the next background request is the probe
+        self.assertEqual(self.breaker.state, HXAPICircuitBreaker.HALF_OPEN)
+        self.assertEqual(self.breaker.stats()['failures'], 4)
+        self.assertTrue(self.breaker.allow(background=True))
+
+    def test_unexpected_error_releases_probe(self):
+        self._send_raises(ValueError('bad request'))
+        self.assertRaises(ValueError, self.api._send_request, self.request, False)
+        self.assertTrue(self.breaker.allow(background=True))
+
+    def test_connection_error_on_probe_opens_again(self):
+        self._send_raises(requests.ConnectionError('refused'))
+        self.assertRaises(requests.ConnectionError, self.api._send_request, self.request, False)
+        self.assertEqual(self.breaker.state, HXAPICircuitBreaker.OPEN)
+        self.breaker.cooldown = 3600
+        self.assertRaises(HXAPICircuitOpenError, self.api._send_request, self.request, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
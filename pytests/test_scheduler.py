@@ -0,0 +1,220 @@
+import datetime
+import threading
+import unittest
+
+import hxtool_global
+
+
+class _NullDB(object):
+    def profileGet(self, profile_id):
+        return {'hx_name': 'unit_TEST_profile'}
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+hxtool_global.hxtool_db = _NullDB()
+hxtool_global.hxtool_config = {'scheduler': {}, 'network': {}}
+
+from hxtool_scheduler import hxtool_scheduler
+from hxtool_scheduler_task import hxtool_scheduler_task, task_states
+from hxtool_task_journal import hxtool_task_journal
+
+
+class _RecordingStep(object):
+    def __init__(self, name, ran, done=None):
+        self.name = name
+        self.ran = ran
+        self.done = done
+
+    def run(self):
+        self.ran.append(self.name)
+        if self.done:
+            self.done.set()
+        return True
+
+
+class SchedulerDispatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = hxtool_scheduler(thread_count=2, process_count=0)
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def add_task(self, name, ran, done=None, **kwargs):
+        task = hxtool_scheduler_task('unit_TEST_profile', name, **kwargs)
+        task.add_step(_RecordingStep(name, ran, done))
+        self.scheduler.add(task)
+        return task
+
+    def test_dispatchesInDeadlineOrder(self):
+        ran = []
+        done = threading.Event()
+        now = datetime.datetime.utcnow()
+        self.add_task('late', ran, done, start_time=now + datetime.timedelta(seconds=0.6))
+        self.add_task('early', ran, start_time=now + datetime.timedelta(seconds=0.3))
+        self.assertTrue(done.wait(5))
+        self.assertEqual(ran, ['early', 'late'])
+
+    def test_childWakesOnParentCompletion(self):
+        ran = []
+        done = threading.Event()
+        parent = hxtool_scheduler_task('unit_TEST_profile', 'parent',
+                                       start_time=datetime.datetime.utcnow() + datetime.timedelta(seconds=0.3))
+        parent.add_step(_RecordingStep('parent', ran))
+        child = hxtool_scheduler_task('unit_TEST_profile', 'child', parent_id=parent.task_id, defer_interval=-15)
+        child.add_step(_RecordingStep('child', ran, done))
+        self.scheduler.add(child)
+        self.scheduler.add(parent)
+        self.assertIsNone(child.next_run)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(ran, ['parent', 'child'])
+
+    def test_removedTaskNeverRuns(self):
+        ran = []
+        task = self.add_task('removed', ran, start_time=datetime.datetime.utcnow() + datetime.timedelta(seconds=0.3))
+        self.scheduler.remove(task.task_id)
+        self.add_task('kept', ran, threading.Event(), start_time=datetime.datetime.utcnow() + datetime.timedelta(seconds=0.5))
+        threading.Event().wait(1)
+        self.assertEqual(ran, ['kept'])
+        self.assertEqual(task.state, task_states.TASK_STATE_PENDING_DELETION)
+
+    def test_removeCascadesToSubtreeOnly(self):
+        later = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        parent = self.add_task('parent', [], start_time=later)
+        child = self.add_task('child', [], parent_id=parent.task_id)
+        grandchild = self.add_task('grandchild', [], parent_id=child.task_id)
+        other = self.add_task('other', [], start_time=later)
+        self.assertEqual(self.scheduler.children(parent.task_id), [child.task_id])
+        self.scheduler.remove(parent.task_id)
+        self.assertIsNone(self.scheduler.get(child.task_id))
+        self.assertIsNone(self.scheduler.get(grandchild.task_id))
+        self.assertIs(self.scheduler.get(other.task_id), other)
+        self.assertEqual(self.scheduler.children(parent.task_id), [])
+
+
+class _InputModule(object):
+    instances = 0
+
+    @staticmethod
+    def hxtool_task_module():
+        return True
+
+    @staticmethod
+    def input_args():
+        return [{'name': 'value', 'required': True}]
+
+    def __init__(self, task):
+        _InputModule.instances += 1
+        self.enabled = True
+
+    def run(self, value=None):
+        return (True, {'seen': value})
+
+
+class SchedulerTaskTests(unittest.TestCase):
+
+    def test_modulesAreLazyAndStepKwargsShared(self):
+        kwargs = {}
+        task = hxtool_scheduler_task('unit_TEST_profile', 'lazy', next_run=datetime.datetime.utcnow())
+        task.add_step(_InputModule, kwargs=kwargs)
+        task.stored_result['value'] = 'from parent'
+        self.assertEqual(_InputModule.instances, 0)
+        self.assertFalse(hasattr(task, '__dict__'))
+        scheduler = hxtool_scheduler(thread_count=1, process_count=0)
+        self.assertTrue(task.run(scheduler))
+        self.assertEqual(_InputModule.instances, 1)
+        self.assertEqual(task.stored_result['seen'], 'from parent')
+        self.assertEqual(kwargs, {})
+        self.assertIs(task.metadata(), task.metadata())
+        scheduler.stop()
+
+
+class _SlowStep(object):
+    def __init__(self, scheduler, peaks, remaining):
+        self.scheduler = scheduler
+        self.peaks = peaks
+        self.remaining = remaining
+
+    def run(self):
+        for profile_id, profile in self.scheduler.queue_stats()['profiles'].items():
+            self.peaks[profile_id] = max(self.peaks.get(profile_id, 0), profile['in_flight'])
+        threading.Event().wait(0.05)
+        self.remaining.release()
+        return True
+
+
+class SchedulerFairQueueTests(unittest.TestCase):
+
+    def test_profileCapAndFairness(self):
+        scheduler = hxtool_scheduler(thread_count=4, process_count=0, profile_thread_count=2)
+        scheduler.start()
+        peaks = {}
+        remaining = threading.Semaphore(0)
+        try:
+            for profile_id, count in (('busy', 40), ('quiet', 4)):
+                for i in range(count):
+                    task = hxtool_scheduler_task(profile_id, '{} {}'.format(profile_id, i))
+                    task.add_step(_SlowStep(scheduler, peaks, remaining))
+                    scheduler.add(task)
+            for i in range(44):
+                self.assertTrue(remaining.acquire(timeout=10))
+        finally:
+            scheduler.stop()
+        self.assertEqual(peaks['busy'], 2)
+        self.assertLessEqual(peaks['quiet'], 2)
+
+
+class _BatchDB(object):
+    def __init__(self):
+        self.batches = []
+
+    def taskWriteBatch(self, creates=[], updates=[], deletes=[]):
+        self.batches.append((creates, updates, deletes))
+
+
+class TaskJournalMergeTests(unittest.TestCase):
+
+    def merge(self, older, newer):
+        return hxtool_task_journal._merge({'op': older, 'fields': {'a': '1'}}, {'op': newer, 'fields': {'b': '2'}})
+
+    def test_mergeEveryOperationPair(self):
+        expected = {
+            ('create', 'create'): ('create', {'b': '2'}),
+            ('create', 'update'): ('create', {'a': '1', 'b': '2'}),
+            ('create', 'delete'): None,
+            ('update', 'create'): ('replace', {'b': '2'}),
+            ('update', 'update'): ('update', {'a': '1', 'b': '2'}),
+            ('update', 'delete'): ('delete', {'b': '2'}),
+            ('delete', 'create'): ('replace', {'b': '2'}),
+            ('delete', 'update'): ('delete', {'a': '1'}),
+            ('delete', 'delete'): ('delete', {'b': '2'}),
+            ('replace', 'create'): ('replace', {'b': '2'}),
+            ('replace', 'update'): ('replace', {'a': '1', 'b': '2'}),
+            ('replace', 'delete'): ('delete', {'b': '2'}),
+        }
+        for (older, newer), result in expected.items():
+            merged = self.merge(older, newer)
+            if result is None:
+                self.assertIsNone(merged, (older, newer))
+            else:
+                self.assertEqual((merged['op'], merged['fields']), result, (older, newer))
+
+    def test_replaceFlushesAsDeleteThenCreate(self):
+        db = _BatchDB()
+        journal = hxtool_task_journal(db, None)
+        with journal._lock:
+            journal._record('delete', 'p', 't1', write_journal=False)
+            journal._record('create', 'p', 't1', {'task_id': '"t1"'}, write_journal=False)
+            journal._record('delete', 'p', 't2', write_journal=False)
+            journal._record('update', 'p', 't2', {'state': '1'}, write_journal=False)
+        journal._open_segment = lambda: None
+        journal._segments = lambda: []
+        self.assertTrue(journal.flush())
+        self.assertEqual(db.batches, [([{'task_id': 't1'}], [], [('p', 't1'), ('p', 't2')])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Client benchmark for hx_lib.HXAPI
+#
+# Starts tests/mock_hx_controller.py in a separate process for each object count, so that only the client
+# shows up in the memory figures, and drives the real HXAPI against it. For each workload reports objects
+# (or MB) per second, per request latency (time to the response headers) and the peak memory allocated
+# while it ran.
+#
+#   list      restListHosts() of every host in one response
+#   stream    restListHosts(stream_entries = True) of every host in one response
+#   pages     iterHosts() over pages of --page-size
+#   alerts    restGetAlertsTime() of every alert, keeping the newest --top
+#   download  restDownloadFile() of a file of --download-bytes per object
+#
+# python tests/bench_hx_api.py --objects 10000 100000 1000000 --latency 0.005
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hx_lib import HXAPI
+
+MOCK_CONTROLLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_hx_controller.py')
+WORKLOADS = ['list', 'stream', 'pages', 'alerts', 'download']
+
+# Times each request sent by an HXAPI object up to the response headers
+class request_timer:
+	def __init__(self, hx_api_object):
+		self.latencies = []
+		send_request = hx_api_object.send_request
+		def timed_send_request(request, stream = False):
+			start = time.perf_counter()
+			try:
+				return send_request(request, stream = stream)
+			finally:
+				self.latencies.append(time.perf_counter() - start)
+		hx_api_object.send_request = timed_send_request
+
+def percentile(values, p):
+	if not values:
+		return 0.0
+	return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def start_mock(count, options):
+	args = [sys.executable, MOCK_CONTROLLER, '--port', '0', '--objects', str(count), '--latency', str(options.latency),
+			'--download-size', str(count * options.download_bytes)]
+	if options.max_page_size:
+		args += ['--max-page-size', str(options.max_page_size)]
+	process = subprocess.Popen(args, stdout = subprocess.PIPE, universal_newlines = True)
+	port = int(process.stdout.readline())
+	return (process, port)
+
+def run_list(hx_api_object, count, options):
+	(ret, response_code, response_data) = hx_api_object.restListHosts(limit = count)
+	return len(response_data['data']['entries']) if ret else 0
+
+def run_stream(hx_api_object, count, options):
+	(ret, response_code, response_data) = hx_api_object.restListHosts(limit = count, stream_entries = True)
+	return sum([1 for _ in response_data['data']['entries']]) if ret else 0
+
+def run_pages(hx_api_object, count, options):
+	return sum([1 for _ in hx_api_object.iterHosts(page_size = options.page_size)])
+
+def run_alerts(hx_api_object, count, options):
+	# Counts the alerts read from the stream, not just the ones kept
+	seen = [0]
+	def counted(alert):
+		seen[0] += 1
+		return True
+	(ret, response_code, response_data) = hx_api_object.restGetAlertsTime('2020-01-01', '2020-12-31', limit = options.top, predicate = counted)
+	return seen[0] if ret else 0
+
+def run_download(hx_api_object, count, options):
+	directory = tempfile.mkdtemp(prefix = 'bench_hx_api')
+	try:
+		(ret, response_code, response_data) = hx_api_object.restDownloadFile('/hx/api/v3/acqs/bulk/1/hosts/mockAgent0000000000000.zip', os.path.join(directory, 'package.zip'), segments = options.segments)
+		return response_data['size'] if ret else 0
+	finally:
+		shutil.rmtree(directory)
+
+def run_workload(workload, port, count, options):
+	hx_api_object = HXAPI('127.0.0.1', hx_port = port)
+	(ret, response_code, response_data) = hx_api_object.restLogin('bench', 'bench')
+	if not ret:
+		raise RuntimeError("Login to the mock controller failed: {} {}".format(response_code, response_data))
+	timer = request_timer(hx_api_object)
+
+	if options.memory:
+		tracemalloc.start()
+	start = time.perf_counter()
+	processed = globals()['run_' + workload](hx_api_object, count, options)
+	elapsed = time.perf_counter() - start
+	peak = 0
+	if options.memory:
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	latencies = sorted(timer.latencies)
+	hx_api_object.restLogout()
+
+	return {
+		'workload' : workload,
+		'objects' : count,
+		'processed' : processed,
+		'requests' : len(latencies),
+		'elapsed' : elapsed,
+		'throughput' : processed / elapsed if elapsed else 0.0,
+		'unit' : 'bytes' if workload == 'download' else 'objects',
+		'latency_ms' : {
+			'p50' : percentile(latencies, 50) * 1000,
+			'p90' : percentile(latencies, 90) * 1000,
+			'p99' : percentile(latencies, 99) * 1000,
+			'max' : (latencies[-1] if latencies else 0.0) * 1000
+		},
+		'peak_memory' : peak
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description = "hx_lib.HXAPI client benchmark")
+	parser.add_argument('--objects', type = int, nargs = '+', default = [10000, 100000, 1000000], help = "Number of objects on the mock controller, one run per value")
+	parser.add_argument('--workloads', nargs = '+', choices = WORKLOADS, default = WORKLOADS)
+	parser.add_argument('--latency', type = float, default = 0.0, help = "Seconds the mock controller adds to every request")
+	parser.add_argument('--page-size', type = int, default = HXAPI.DEFAULT_PAGE_SIZE, help = "Page size of the pages workload")
+	parser.add_argument('--max-page-size', type = int, default = None, help = "Largest page the mock controller returns")
+	parser.add_argument('--top', type = int, default = 100, help = "Alerts kept by the alerts workload")
+	parser.add_argument('--download-bytes', type = int, default = 256, help = "Size of the downloaded file per object")
+	parser.add_argument('--segments', type = int, default = None, help = "Parallel ranges of the download workload")
+	parser.add_argument('--no-memory', dest = 'memory', action = 'store_false', help = "Don't trace memory, tracing slows the client down")
+	parser.add_argument('--json', action = 'store_true', help = "Print results as JSON")
+	options = parser.parse_args()
+	HXAPI('127.0.0.1').suppress_requests_insecure_warning()
+
+	results = []
+	for count in options.objects:
+		(process, port) = start_mock(count, options)
+		try:
+			for workload in options.workloads:
+				results.append(run_workload(workload, port, count, options))
+		finally:
+			process.terminate()
+			process.wait()
+
+	if options.json:
+		print(json.dumps(results, indent = 4))
+		return
+
+	print("{:>9} {:>8} {:>9} {:>8} {:>9} {:>14} {:>9} {:>9} {:>9} {:>9} {:>10}".format(
+		'workload', 'objects', 'processed', 'requests', 'elapsed', 'throughput', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'peak MB'))
+	for r in results:
+		throughput = "{:.1f} MB/s".format(r['throughput'] / 1048576) if r['unit'] == 'bytes' else "{:.0f}/s".format(r['throughput'])
+		print("{:>9} {:>8} {:>9} {:>8} {:>9.2f} {:>14} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.1f}".format(
+			r['workload'], r['objects'], r['processed'], r['requests'], r['elapsed'], throughput,
+			r['latency_ms']['p50'], r['latency_ms']['p90'], r['latency_ms']['p99'], r['latency_ms']['max'], r['peak_memory'] / 1048576.0))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Dispatch benchmark for hxtool_scheduler
+#
+# Enqueues a synthetic mix of immediate, deferred, recurring and parent/child tasks against a no-op database
+# and reports dispatch latency (time a task was due to the time its first step runs), throughput,
+# contention on the scheduler lock and the memory cost of each queued task.
+#
+# python tests/bench_scheduler.py --tasks 1000 10000 100000 --mix immediate=40,deferred=20,recurring=20,child=20
+
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import datetime
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import hxtool_global
+
+class null_db:
+	def profileGet(self, profile_id):
+		return {'hx_name' : profile_id}
+
+	def __getattr__(self, name):
+		return lambda *args, **kwargs: None
+
+hxtool_global.hxtool_db = null_db()
+hxtool_global.hxtool_config = {'scheduler' : {}, 'network' : {}}
+
+from hxtool_scheduler import hxtool_scheduler
+from hxtool_scheduler_task import hxtool_scheduler_task
+
+TASK_KINDS = ['immediate', 'deferred', 'recurring', 'child']
+
+# Wraps the scheduler lock to count how often, and for how long, threads had to wait for it
+class timed_lock:
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.acquisitions = 0
+		self.contended = 0
+		self.wait_time = 0.0
+		self.max_wait = 0.0
+
+	def acquire(self, blocking = True, timeout = -1):
+		if self._lock.acquire(False):
+			self.acquisitions += 1
+			return True
+		if not blocking:
+			return False
+		start = time.perf_counter()
+		acquired = self._lock.acquire(True, timeout)
+		if acquired:
+			waited = time.perf_counter() - start
+			self.acquisitions += 1
+			self.contended += 1
+			self.wait_time += waited
+			self.max_wait = max(self.max_wait, waited)
+		return acquired
+
+	def release(self):
+		self._lock.release()
+
+	# Used by threading.Condition, avoids a probing acquire() being counted
+	def _is_owned(self):
+		return self._lock.locked()
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, *args):
+		self.release()
+
+class bench_run:
+	def __init__(self, expected_runs):
+		self.expected_runs = expected_runs
+		self.dispatch_start = None
+		self.latencies = {_ : [] for _ in TASK_KINDS}
+		self.parent_done = {}
+		self.runs = 0
+		self._lock = threading.Lock()
+		self.done = threading.Event()
+
+	def record(self, kind, due):
+		now = datetime.datetime.utcnow()
+		with self._lock:
+			latency = (now - max(due, self.dispatch_start)).total_seconds()
+			self.latencies[kind].append(latency)
+			self.runs += 1
+			if self.runs >= self.expected_runs:
+				self.done.set()
+
+class bench_step:
+	def __init__(self, bench, task, kind, due = None, interval = None, recurrences = 1):
+		self.bench = bench
+		self.task = task
+		self.kind = kind
+		self.due = due
+		self.interval = interval
+		self.recurrences = recurrences
+		self.last_run = None
+
+	def run(self):
+		if self.recurrences > 0:
+			if self.kind == 'child':
+				due = self.bench.parent_done[self.task.parent_id]
+			elif self.last_run:
+				due = self.last_run + self.interval
+			else:
+				due = self.due
+			self.bench.record(self.kind, due)
+			self.recurrences -= 1
+		self.last_run = self.task.last_run
+		self.bench.parent_done[self.task.task_id] = datetime.datetime.utcnow()
+		return True
+
+def percentile(values, p):
+	if not values:
+		return 0.0
+	return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def build_tasks(bench, count, mix, options):
+	now = datetime.datetime.utcnow()
+	interval = datetime.timedelta(seconds = options.recurring_interval)
+	weights = [mix.get(_, 0) for _ in TASK_KINDS]
+	kinds = random.choices(TASK_KINDS, weights = weights, k = count)
+	tasks = []
+	parents = []
+	for i, kind in enumerate(kinds):
+		profile_id = 'profile_{}'.format(i % options.profiles)
+		recurrences = 1
+		if kind == 'child' and not parents:
+			kind = 'immediate'
+		if kind == 'child':
+			parent = random.choice(parents)
+			# A negative defer interval makes the child due as soon as its parent completes
+			task = hxtool_scheduler_task(parent.profile_id, 'child {}'.format(i), parent_id = parent.task_id, defer_interval = -16, profile_name = parent.profile_id)
+			due = None
+		elif kind == 'deferred':
+			due = now + datetime.timedelta(seconds = random.uniform(0, options.defer_window))
+			task = hxtool_scheduler_task(profile_id, 'deferred {}'.format(i), start_time = due, profile_name = profile_id)
+		else:
+			due = now
+			task = hxtool_scheduler_task(profile_id, '{} {}'.format(kind, i), start_time = due, profile_name = profile_id)
+			if kind == 'recurring':
+				task.set_schedule(seconds = options.recurring_interval)
+				recurrences = options.recurrences
+			else:
+				parents.append(task)
+		task.add_step(bench_step(bench, task, kind, due = due, interval = interval, recurrences = recurrences))
+		tasks.append((kind, task))
+	return tasks
+
+def run_benchmark(count, mix, options):
+	random.seed(options.seed)
+	scheduler = hxtool_scheduler(thread_count = options.threads, process_count = 0, profile_thread_count = options.profile_threads)
+	# Swap the lock before start() so the dispatch thread and the condition both use it
+	lock = timed_lock()
+	scheduler._lock = lock
+	scheduler._run_queue_event = threading.Condition(lock)
+
+	tracemalloc.start()
+	before = tracemalloc.take_snapshot()
+	bench = bench_run(0)
+	tasks = build_tasks(bench, count, mix, options)
+	scheduler.add_list([_[1] for _ in tasks])
+	after = tracemalloc.take_snapshot()
+	tracemalloc.stop()
+	memory = sum([_.size_diff for _ in after.compare_to(before, 'filename')])
+
+	bench.expected_runs = sum([options.recurrences if kind == 'recurring' else 1 for kind, task in tasks])
+	lock.acquisitions = lock.contended = 0
+	lock.wait_time = lock.max_wait = 0.0
+
+	bench.dispatch_start = datetime.datetime.utcnow()
+	start = time.perf_counter()
+	scheduler.start()
+	completed = bench.done.wait(options.timeout)
+	elapsed = time.perf_counter() - start
+	scheduler.stop()
+
+	latencies = sorted([l for kind in TASK_KINDS for l in bench.latencies[kind]])
+	return {
+		'tasks' : count,
+		'runs' : bench.runs,
+		'expected_runs' : bench.expected_runs,
+		'completed' : completed,
+		'elapsed' : elapsed,
+		'throughput' : bench.runs / elapsed if elapsed else 0.0,
+		'latency_ms' : {
+			'p50' : percentile(latencies, 50) * 1000,
+			'p90' : percentile(latencies, 90) * 1000,
+			'p99' : percentile(latencies, 99) * 1000,
+			'max' : (latencies[-1] if latencies else 0.0) * 1000
+		},
+		'latency_p99_ms_by_kind' : { kind : percentile(sorted(bench.latencies[kind]), 99) * 1000 for kind in TASK_KINDS },
+		'lock' : {
+			'acquisitions' : lock.acquisitions,
+			'contended' : lock.contended,
+			'contended_pct' : (100.0 * lock.contended / lock.acquisitions) if lock.acquisitions else 0.0,
+			'wait_ms' : lock.wait_time * 1000,
+			'max_wait_ms' : lock.max_wait * 1000
+		},
+		'memory_per_task' : memory / count if count else 0
+	}
+
+def parse_mix(mix):
+	r = {}
+	for item in mix.split(','):
+		kind, weight = item.split('=')
+		if kind not in TASK_KINDS:
+			raise argparse.ArgumentTypeError("Unknown task kind {}, expected one of {}".format(kind, ', '.join(TASK_KINDS)))
+		r[kind] = float(weight)
+	return r
+
+def main():
+	parser = argparse.ArgumentParser(description = "hxtool_scheduler dispatch benchmark")
+	parser.add_argument('--tasks', type = int, nargs = '+', default = [1000, 10000, 100000], help = "Number of tasks to enqueue, one run per value")
+	parser.add_argument('--mix', type = parse_mix, default = parse_mix('immediate=40,deferred=20,recurring=20,child=20'), help = "Weights of each task kind")
+	parser.add_argument('--threads', type = int, default = 10, help = "Scheduler thread count")
+	parser.add_argument('--profile-threads', type = int, default = None, help = "Per profile thread cap, defaults to the thread count")
+	parser.add_argument('--profiles', type = int, default = 4, help = "Number of profiles to spread tasks over")
+	parser.add_argument('--defer-window', type = float, default = 2.0, help = "Deferred tasks start within this many seconds")
+	parser.add_argument('--recurring-interval', type = int, default = 1, help = "Interval of recurring tasks in seconds")
+	parser.add_argument('--recurrences', type = int, default = 2, help = "Runs measured per recurring task")
+	parser.add_argument('--timeout', type = float, default = 600, help = "Give up on a run after this many seconds")
+	parser.add_argument('--seed', type = int, default = 1)
+	parser.add_argument('--json', action = 'store_true', help = "Print results as JSON")
+	options = parser.parse_args()
+
+	results = [run_benchmark(count, options.mix, options) for count in options.tasks]
+
+	if options.json:
+		print(json.dumps(results, indent = 4))
+		return
+
+	print("{:>8} {:>8} {:>9} {:>10} {:>9} {:>9} {:>9} {:>9} {:>10} {:>9} {:>10}".format(
+		'tasks', 'runs', 'elapsed', 'runs/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'lock acq', 'contend%', 'bytes/task'))
+	for r in results:
+		print("{:>8} {:>8} {:>9.2f} {:>10.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10} {:>9.2f} {:>10.0f}{}".format(
+			r['tasks'], r['runs'], r['elapsed'], r['throughput'],
+			r['latency_ms']['p50'], r['latency_ms']['p90'], r['latency_ms']['p99'], r['latency_ms']['max'],
+			r['lock']['acquisitions'], r['lock']['contended_pct'], r['memory_per_task'],
+			'' if r['completed'] else ' (timed out)'))
+
+if __name__ == '__main__':
+	main()
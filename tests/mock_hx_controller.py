@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Mock HX controller for exercising hx_lib.HXAPI without a live controller
+#
+# Serves the token, version, hosts, host sysinfo, alerts, alerts/filter (multiline JSON), bulk acquisition,
+# search results and file download routes over HTTPS, using the certificate in data/. Objects are generated
+# from their index as they are written, so a million of them doesn't cost the mock a million dicts, and list
+# responses are sent with chunked encoding like the controller does for large responses.
+#
+# python tests/mock_hx_controller.py --objects 100000 --latency 0.01 --max-page-size 1000
+#
+# The port is printed on the first line of output once the server is listening, --port 0 picks a free one.
+
+import os
+import re
+import ssl
+import json
+import time
+import random
+import hashlib
+import argparse
+import datetime
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+MSO_VERSION = '5.3.0'
+ALERT_SOURCES = ['IOC', 'MAL', 'EXD']
+OS_PRODUCTS = ['Windows 10 Enterprise', 'Windows Server 2019 Standard', 'Mac OS X', 'CentOS Linux']
+# Entries written per chunk of a list response
+WRITE_BATCH = 500
+DOWNLOAD_BLOCK_SIZE = 1048576
+
+class mock_hx_data:
+	def __init__(self, object_count, seed = 1):
+		self.object_count = object_count
+		self.epoch = datetime.datetime(2020, 1, 1)
+		rng = random.Random(seed)
+		# Downloads repeat this block, so any range can be served without keeping the whole file
+		self.download_block = rng.randbytes(DOWNLOAD_BLOCK_SIZE)
+
+	def _timestamp(self, index, spread = 86400 * 30):
+		# A cheap, repeatable scatter of the timestamps so they aren't in index order
+		offset = (index * 2654435761) % spread
+		return (self.epoch + datetime.timedelta(seconds = offset)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+	def host_id(self, index):
+		return 'mockAgent{:013d}'.format(index)
+
+	def host(self, index):
+		return {
+			'_id' : self.host_id(index),
+			'agent_version' : '32.30.0',
+			'hostname' : 'HOST-{:07d}'.format(index),
+			'domain' : 'MOCK',
+			'primary_ip_address' : '10.{}.{}.{}'.format((index >> 16) & 255, (index >> 8) & 255, index & 255),
+			'last_poll_timestamp' : self._timestamp(index),
+			'last_poll_ip' : '10.0.0.1',
+			'containment_state' : 'normal',
+			'os' : {
+				'product_name' : OS_PRODUCTS[index % len(OS_PRODUCTS)],
+				'platform' : 'win' if index % len(OS_PRODUCTS) < 2 else 'linux',
+				'bitness' : '64-bit'
+			},
+			'stats' : {
+				'alerts' : index % 7,
+				'exploit_alerts' : 0,
+				'malware_alerts' : index % 3,
+				'acqs' : 0
+			},
+			'sysinfo' : { 'url' : '/hx/api/v3/hosts/{}/sysinfo'.format(self.host_id(index)) },
+			'url' : '/hx/api/v3/hosts/{}'.format(self.host_id(index))
+		}
+
+	def sysinfo(self, host_id):
+		return {
+			'_id' : host_id,
+			'hostname' : host_id,
+			'OS' : 'Windows 10 Enterprise',
+			'MalwareProtectionStatus' : 'enabled',
+			'malware' : {
+				'av' : { 'status' : 'enabled', 'engine' : { 'version' : '11.0.1.18' }, 'content' : { 'version' : '1.2.3' } },
+				'mg' : { 'status' : 'enabled', 'engine' : { 'version' : '32.30.0' }, 'content' : { 'version' : '1.2.3' } }
+			}
+		}
+
+	def alert(self, index):
+		source = ALERT_SOURCES[index % len(ALERT_SOURCES)]
+		alert = {
+			'_id' : index + 1,
+			'agent' : { '_id' : self.host_id(index % max(1, self.object_count // 10)), 'containment_state' : 'normal' },
+			'condition' : { '_id' : 'mockCondition{:07d}'.format(index % 1000) },
+			'indicator' : { '_id' : 'mockIndicator{:07d}'.format(index % 1000), 'name' : 'Mock indicator {}'.format(index % 1000) },
+			'source' : source,
+			'event_at' : self._timestamp(index),
+			'matched_at' : self._timestamp(index),
+			'reported_at' : self._timestamp(index * 7 + 3),
+			'resolution' : 'ALERT',
+			'is_false_positive' : False,
+			'event_type' : 'fileWriteEvent',
+			'event_values' : {
+				'fileWriteEvent/md5' : hashlib.md5(str(index % 5000).encode()).hexdigest(),
+				'fileWriteEvent/fullPath' : 'C:\\Users\\mock\\file{}.exe'.format(index % 5000)
+			},
+			'url' : '/hx/api/v3/alerts/{}'.format(index + 1)
+		}
+		return alert
+
+	def bulk_acquisition(self, index):
+		return {
+			'_id' : index + 1,
+			'state' : 'COMPLETE',
+			'comment' : 'Mock bulk acquisition {}'.format(index + 1),
+			'create_time' : self._timestamp(index),
+			'stats' : { 'running_state' : { 'COMPLETE' : self.object_count } },
+			'url' : '/hx/api/v3/acqs/bulk/{}'.format(index + 1)
+		}
+
+	def bulk_host(self, bulk_id, index):
+		return {
+			'host' : { '_id' : self.host_id(index), 'hostname' : 'HOST-{:07d}'.format(index) },
+			'state' : 'COMPLETE',
+			'result' : { 'url' : '/hx/api/v3/acqs/bulk/{}/hosts/{}.zip'.format(bulk_id, self.host_id(index)) }
+		}
+
+	def search_result(self, index):
+		return {
+			'_id' : index + 1,
+			'host' : { '_id' : self.host_id(index), 'hostname' : 'HOST-{:07d}'.format(index) },
+			'results' : [{
+				'id' : index + 1,
+				'type' : 'File Name',
+				'data' : { 'File Name' : 'file{}.exe'.format(index % 5000), 'File Full Path' : 'C:\\Users\\mock\\file{}.exe'.format(index % 5000) }
+			}]
+		}
+
+class mock_hx_handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	ROUTES = [
+		('GET', r'/hx/api/v\d+/version$', 'version'),
+		('GET', r'/hx/api/v\d+/token$', 'token_get'),
+		('DELETE', r'/hx/api/v\d+/token$', 'token_delete'),
+		('GET', r'/hx/api/v\d+/hosts$', 'hosts'),
+		('GET', r'/hx/api/v\d+/hosts/(?P<host_id>[^/]+)$', 'host'),
+		('GET', r'/hx/api/v\d+/hosts/(?P<host_id>[^/]+)/sysinfo$', 'host_sysinfo'),
+		('GET', r'/hx/api/v\d+/alerts$', 'alerts'),
+		('POST', r'/hx/api/v\d+/alerts/filter$', 'alerts_filter'),
+		('GET', r'/hx/api/v\d+/acqs/bulk$', 'bulk_acquisitions'),
+		('GET', r'/hx/api/v\d+/acqs/bulk/(?P<bulk_id>\d+)$', 'bulk_acquisition'),
+		('GET', r'/hx/api/v\d+/acqs/bulk/(?P<bulk_id>\d+)/hosts$', 'bulk_hosts'),
+		('GET', r'/hx/api/v\d+/acqs/bulk/(?P<bulk_id>\d+)/hosts/(?P<host_id>[^/.]+)$', 'bulk_host'),
+		('GET', r'/hx/api/v\d+/searches/(?P<search_id>\d+)/results$', 'search_results'),
+		('GET', r'.+\.zip$', 'download')
+	]
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		self._dispatch('GET')
+
+	def do_POST(self):
+		self._dispatch('POST')
+
+	def do_DELETE(self):
+		self._dispatch('DELETE')
+
+	def _dispatch(self, method):
+		controller = self.server.controller
+		url = urlsplit(self.path)
+		self.query = { k : v[-1] for k, v in parse_qs(url.query).items() }
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+
+		if controller.latency:
+			time.sleep(controller.latency)
+		controller.count_request()
+
+		for route_method, pattern, name in self.ROUTES:
+			m = re.match(pattern, url.path)
+			if m and route_method == method:
+				if name not in ('version', 'token_get') and self.headers.get('X-FeApi-Token') not in controller.tokens:
+					return self._send_json(401, { 'message' : 'Unauthorized', 'details' : [] })
+				return getattr(self, 'route_' + name)(body = body, **m.groupdict())
+		self._send_json(404, { 'message' : 'Not Found', 'details' : [] })
+
+	def _send_json(self, status, data, headers = None):
+		body = json.dumps(data).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		for k, v in (headers or {}).items():
+			self.send_header(k, v)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def _write_chunk(self, data):
+		if data:
+			self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+
+	def _start_chunked(self, status = 200):
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Transfer-Encoding', 'chunked')
+		self.end_headers()
+
+	def _end_chunked(self):
+		self.wfile.write(b'0\r\n\r\n')
+
+	def _page(self):
+		controller = self.server.controller
+		limit = int(self.query.get('limit', 50))
+		if controller.max_page_size:
+			limit = min(limit, controller.max_page_size)
+		return (int(self.query.get('offset', 0)), limit)
+
+	# A list response in the controller's envelope, entries are generated by entry(index) while writing
+	def _send_list(self, entry, total):
+		(offset, limit) = self._page()
+		indexes = range(offset, max(offset, min(total, offset + limit)))
+		self._start_chunked()
+		self._write_chunk('{{"data": {{"total": {}, "query": {{}}, "sort": {{}}, "offset": {}, "limit": {}, "entries": ['.format(total, offset, limit).encode('utf-8'))
+		for i in range(0, len(indexes), WRITE_BATCH):
+			batch = ', '.join([json.dumps(entry(_)) for _ in indexes[i:i + WRITE_BATCH]])
+			self._write_chunk(((', ' if i else '') + batch).encode('utf-8'))
+		self._write_chunk(b']}, "message": "OK", "details": []}')
+		self._end_chunked()
+
+	def route_version(self, body):
+		self._send_json(200, { 'data' : { 'msoVersion' : MSO_VERSION, 'applianceId' : 'MOCKHX' }, 'message' : 'OK', 'details' : [] })
+
+	def route_token_get(self, body):
+		if not self.headers.get('Authorization'):
+			return self._send_json(401, { 'message' : 'Unauthorized', 'details' : [] })
+		token = self.server.controller.new_token()
+		self.send_response(204)
+		self.send_header('X-FeApi-Token', token)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def route_token_delete(self, body):
+		self.server.controller.tokens.discard(self.headers.get('X-FeApi-Token'))
+		self.send_response(204)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def route_hosts(self, body):
+		data = self.server.controller.data
+		self._send_list(data.host, data.object_count)
+
+	def route_host(self, body, host_id):
+		data = self.server.controller.data
+		index = int(host_id[len('mockAgent'):]) if host_id.startswith('mockAgent') else -1
+		if not 0 <= index < data.object_count:
+			return self._send_json(404, { 'message' : 'Not Found', 'details' : [] })
+		self._send_json(200, { 'data' : data.host(index), 'message' : 'OK', 'details' : [] })
+
+	def route_host_sysinfo(self, body, host_id):
+		self._send_json(200, { 'data' : self.server.controller.data.sysinfo(host_id), 'message' : 'OK', 'details' : [] })
+
+	def route_alerts(self, body):
+		data = self.server.controller.data
+		self._send_list(data.alert, data.object_count)
+
+	# One alert per line, this is what the controller does for alerts/filter
+	def route_alerts_filter(self, body):
+		data = self.server.controller.data
+		self._start_chunked()
+		for i in range(0, data.object_count, WRITE_BATCH):
+			self._write_chunk(''.join([json.dumps(data.alert(_)) + '\n' for _ in range(i, min(data.object_count, i + WRITE_BATCH))]).encode('utf-8'))
+		self._end_chunked()
+
+	def route_bulk_acquisitions(self, body):
+		self._send_list(self.server.controller.data.bulk_acquisition, 10)
+
+	def route_bulk_acquisition(self, body, bulk_id):
+		self._send_json(200, { 'data' : self.server.controller.data.bulk_acquisition(int(bulk_id) - 1), 'message' : 'OK', 'details' : [] })
+
+	def route_bulk_hosts(self, body, bulk_id):
+		data = self.server.controller.data
+		self._send_list(lambda index: data.bulk_host(bulk_id, index), data.object_count)
+
+	def route_bulk_host(self, body, bulk_id, host_id):
+		data = self.server.controller.data
+		index = int(host_id[len('mockAgent'):]) if host_id.startswith('mockAgent') else 0
+		self._send_json(200, { 'data' : data.bulk_host(bulk_id, index), 'message' : 'OK', 'details' : [] })
+
+	def route_search_results(self, body, search_id):
+		data = self.server.controller.data
+		self._send_list(data.search_result, data.object_count)
+
+	def route_download(self, body):
+		controller = self.server.controller
+		size = controller.download_size
+		(start, end) = (0, size - 1)
+		status = 200
+		content_range = self.headers.get('Range')
+		if content_range and controller.ranges:
+			m = re.match(r'bytes=(\d+)-(\d*)$', content_range)
+			if not m or int(m.group(1)) >= size:
+				self.send_response(416)
+				self.send_header('Content-Range', 'bytes */{}'.format(size))
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+				return
+			start = int(m.group(1))
+			end = min(size - 1, int(m.group(2))) if m.group(2) else size - 1
+			status = 206
+
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/octet-stream')
+		self.send_header('Content-Length', str(end + 1 - start))
+		if status == 206:
+			self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+		self.end_headers()
+
+		block = controller.data.download_block
+		position = start
+		while position <= end:
+			offset = position % len(block)
+			data = block[offset:offset + min(len(block) - offset, end + 1 - position)]
+			self.wfile.write(data)
+			position += len(data)
+
+class mock_hx_controller:
+	def __init__(self, object_count = 10000, latency = 0.0, max_page_size = None, download_size = 16777216, ranges = True, host = '127.0.0.1', port = 0, cert = None, key = None):
+		self.data = mock_hx_data(object_count)
+		self.latency = latency
+		self.max_page_size = max_page_size
+		self.download_size = download_size
+		self.ranges = ranges
+		self.tokens = set()
+		self.requests = 0
+		self._lock = threading.Lock()
+
+		self._server = ThreadingHTTPServer((host, port), mock_hx_handler)
+		self._server.daemon_threads = True
+		self._server.controller = self
+		context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+		context.load_cert_chain(cert or os.path.join(DATA_PATH, 'hxtool.crt'), key or os.path.join(DATA_PATH, 'hxtool.key'))
+		self._server.socket = context.wrap_socket(self._server.socket, server_side = True)
+		self.host = host
+		self.port = self._server.server_address[1]
+		self._thread = threading.Thread(target = self._server.serve_forever, name = 'MockHXController', daemon = True)
+
+	def new_token(self):
+		token = 'mockToken{:x}'.format(random.getrandbits(64))
+		with self._lock:
+			self.tokens.add(token)
+		return token
+
+	def count_request(self):
+		with self._lock:
+			self.requests += 1
+
+	def start(self):
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *args):
+		self.stop()
+
+def main():
+	parser = argparse.ArgumentParser(description = "Mock HX controller")
+	parser.add_argument('--objects', type = int, default = 10000, help = "Number of hosts, alerts, bulk acquisition hosts and search results")
+	parser.add_argument('--latency', type = float, default = 0.0, help = "Seconds added to every request")
+	parser.add_argument('--max-page-size', type = int, default = None, help = "Largest limit honored by list routes")
+	parser.add_argument('--download-size', type = int, default = 16777216, help = "Size of downloaded files in bytes")
+	parser.add_argument('--no-ranges', action = 'store_true', help = "Ignore Range headers on downloads")
+	parser.add_argument('--host', default = '127.0.0.1')
+	parser.add_argument('--port', type = int, default = 3000)
+	options = parser.parse_args()
+
+	controller = mock_hx_controller(object_count = options.objects, latency = options.latency, max_page_size = options.max_page_size,
+									download_size = options.download_size, ranges = not options.no_ranges, host = options.host, port = options.port)
+	print(controller.port, flush = True)
+	controller.start()
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		controller.stop()
+
+if __name__ == '__main__':
+	main()